@@ -0,0 +1,629 @@
+"""
+Derivation Backends
+-------------------
+
+Engines that perform the image processing needed to derive images.
+
+An ImageHandle does not process pixels itself, it asks a backend to.  Every backend provides the same set of
+operations: decode, resize, crop, thumbnail, convert, strip and encode.  Each backend works upon its own native
+in-memory representation of an image, which never escapes the derivation it was created for.
+
+Two backends are provided:
+
+* ``wand``  The Wand/ImageMagick engine.  Supports every format ImageMagick does, and is always available.
+* ``numpy`` Pillow for the codecs, with NumPy vectorised area averaging and separable resampling.  JPEG sources
+  are decoded at a reduced DCT scale when only a small result is needed.  Requires the optional
+  ``Pillow`` and ``numpy`` packages.
+
+The backend used is selected per operation and per format by the configuration, falling back to ``wand``
+whenever the selected backend is unavailable or cannot read or write the formats involved.
+"""
+
+import os
+import time
+import logging
+import cStringIO
+from threading import Thread, BoundedSemaphore
+
+import wand.image
+import wand.exceptions
+
+import ImageHeaders
+import Resources
+from Exceptions import RepositoryError
+from Exceptions import RepositoryFailure
+
+try:
+    import numpy
+    from PIL import Image as PILImage
+except ImportError:
+    numpy = None
+    PILImage = None
+
+logger = logging.getLogger("image_repository")
+
+_configuration = None
+_carves = None       # Liquid rescales that may be carving at once, including those abandoned after their time budget
+
+# Unsharp mask parameters applied to thumbnails, shared so every backend sharpens alike
+sharpen_parameters = {"radius" : 0.0, "sigma" : 1.0, "amount" : 1.0, "threshold" : 1.0}
+
+# The operations a backend may be selected for
+operations = ("resize", "crop", "rotate", "thumbnail", "convert", "strip")
+
+
+def set_configuration(config):
+    """Set the configuration that governs backend selection and behaviour
+
+    :param config: The system configuration
+    :type config: Configuration
+    """
+    global _configuration, _carves
+    _configuration = config
+    _carves = BoundedSemaphore(max(1, config.thumbnail_liquid_max_carves))
+    if PILImage is not None and config.resource_limits_configuration.max_pixels:
+        PILImage.MAX_IMAGE_PIXELS = config.resource_limits_configuration.max_pixels
+
+
+def normalise_kind(kind):
+    """Fold the various spellings of a format into one lower case name
+
+    :param kind: Format name as used by Wand, ImageNames or a client
+    :type kind: string or None
+    :rtype: string or None
+    """
+    if kind is None:
+        return None
+    kind = kind.lower()
+    return {"jpeg" : "jpg", "tiff" : "tif"}.get(kind, kind)
+
+
+class DerivationBackend(object):
+    """Interface every derivation backend provides
+
+    Operations take and return the backend's native image, and may modify the image they are given.
+    ``decode`` is the only way to obtain a native image, ``encode`` and ``handle_arguments`` the only ways to
+    turn one back into something the rest of the repository understands.
+    """
+
+    name = None
+
+    def available(self):
+        """Whether the libraries the backend needs are installed
+
+        :rtype: boolean
+        """
+        return False
+
+    def supports(self, kind):
+        """Whether the backend can read and write the given format
+
+        :param kind: The format
+        :type kind: string
+        :rtype: boolean
+        """
+        return False
+
+    def decode(self, handle, reduce_to = None, copy = True):
+        """Obtain a native image from an ImageHandle
+
+        :param handle: The image to decode
+        :type handle: ImageType.ImageHandle
+        :param reduce_to: If set, the decoder may return a smaller image, but no smaller than this box
+        :type reduce_to: tuple (x_size, y_size) or None
+        :param copy: Whether the result will be modified, and so must not be shared with the handle
+        :type copy: boolean
+        :raises: RepositoryFailure
+        """
+        raise RepositoryError("Must be specialised")
+
+    def dimensions(self, image):
+        """:rtype: tuple (width, height)"""
+        raise RepositoryError("Must be specialised")
+
+    def resize(self, image, x_size, y_size, quality = "best"):
+        raise RepositoryError("Must be specialised")
+
+    def crop(self, image, x_size, y_size, x_offset, y_offset):
+        raise RepositoryError("Must be specialised")
+
+    def rotate(self, image, degrees, mirror = False):
+        """Mirror the image left to right if asked, then rotate it clockwise, enlarging it to hold the result"""
+        raise RepositoryError("Must be specialised")
+
+    def thumbnail(self, image, x_size, y_size, quality = "best", liquid = False, equalise = False, sharpen = False):
+        raise RepositoryError("Must be specialised")
+
+    def convert(self, image, kind):
+        raise RepositoryError("Must be specialised")
+
+    def strip(self, image):
+        raise RepositoryError("Must be specialised")
+
+    def encode(self, image, kind):
+        """:rtype: bytes"""
+        raise RepositoryError("Must be specialised")
+
+    def handle_arguments(self, image, kind):
+        """The ImageHandle constructor arguments that wrap a native image
+
+        :rtype: dict
+        """
+        raise RepositoryError("Must be specialised")
+
+
+class WandBackend(DerivationBackend):
+    """The Wand/ImageMagick engine.  Native images are ``wand.image.Image`` instances.
+    """
+
+    name = "wand"
+
+    def available(self):
+        return True
+
+    def supports(self, kind):
+        return True
+
+    def decode(self, handle, reduce_to = None, copy = True):
+        image = handle._get_image()
+        return image.clone() if copy else image
+
+    def dimensions(self, image):
+        return image.width, image.height
+
+    @staticmethod
+    def resample(image, x_size, y_size, quality = "best"):
+        """Resample a Wand image in place to the given dimensions using the requested tier.
+
+        :param image: The image to resample
+        :type image: wand.image.Image
+        :param x_size: Target width
+        :type x_size: integer
+        :param y_size: Target height
+        :type y_size: integer
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``
+        :type quality: string
+
+        * ``fast`` point samples when reducing and uses a triangle filter when enlarging.
+        * ``balanced`` box filters down to twice the target size, then finishes with Lanczos. The box pass is cheap
+          and the Lanczos pass then runs on a small image.
+        * ``best`` is a single Lanczos (the Wand default) resize of the full image.
+        """
+        x_size = max(1, int(x_size))
+        y_size = max(1, int(y_size))
+        if quality == "fast":
+            if x_size <= image.width and y_size <= image.height:
+                image.sample(x_size, y_size)
+            else:
+                image.resize(x_size, y_size, filter = 'triangle')
+        elif quality == "balanced":
+            if image.width > 2 * x_size and image.height > 2 * y_size:
+                image.resize(2 * x_size, 2 * y_size, filter = 'box')
+            image.resize(x_size, y_size, filter = 'lanczos')
+        else:
+            image.resize(x_size, y_size)
+
+    def resize(self, image, x_size, y_size, quality = "best"):
+        self.resample(image, x_size, y_size, quality)
+        return image
+
+    def crop(self, image, x_size, y_size, x_offset, y_offset):
+        # Wand implicitly creates a clone when creating a new sliced image
+        return image[x_offset:(x_offset+x_size), y_offset:(y_offset+y_size)]
+
+    def rotate(self, image, degrees, mirror = False):
+        if mirror:
+            image.flop()
+        if degrees % 360 != 0:
+            image.rotate(degrees)
+        return image
+
+    def liquid_rescale(self, image, x_size, y_size, quality = "best"):
+        """Liquid rescale an image to the given dimensions, working on a reduced resolution copy.
+
+        :param image: The image to rescale. It may be modified.
+        :type image: wand.image.Image
+        :param x_size: Target width
+        :type x_size: integer
+        :param y_size: Target height
+        :type y_size: integer
+        :param quality: Resampling tier used for the reduction and for any fallback resize
+        :type quality: string
+        :rtype: wand.image.Image
+
+        Seam carving costs grow faster than the pixel count, and a full resolution panorama can take tens of seconds.
+        The image is first reduced, preserving its aspect ratio, until its smaller relative dimension is
+        ``thumbnail_liquid_working_multiple`` times the target.  Seams are then carved from this working copy.
+
+        If ``thumbnail_liquid_time_budget`` is set the carving runs in a separate thread.  Should it not complete
+        within the budget its result is abandoned and a plain resize of the working copy is returned instead.
+        The abandoned thread runs to completion in the background, as ImageMagick offers no way to interrupt it.
+        No more than ``thumbnail_liquid_max_carves`` carvings, abandoned or not, run at once; when that many are
+        running the image is given a plain resize rather than waiting.
+        """
+        multiple = _configuration.thumbnail_liquid_working_multiple
+        budget = _configuration.thumbnail_liquid_time_budget
+
+        scale = max(multiple * x_size / float(image.width), multiple * y_size / float(image.height))
+        if scale < 1.0:
+            self.resample(image, image.width * scale, image.height * scale, quality)
+
+        result = []
+        def carve(work):
+            try:
+                work.liquid_rescale(x_size, y_size)
+                result.append(work)
+            except wand.image.MissingDelegateError:
+                # Liquid rescale was not built into the underlying ImageMagik library.
+                logger.info("Liquid rescale not available, using plain resize")
+            finally:
+                _carves.release()
+
+        start = time.time()
+        if not _carves.acquire(False):
+            logger.info("Liquid rescale of {} x {} to {} x {} skipped, {} already carving, using plain resize".format(
+                image.width, image.height, x_size, y_size, _configuration.thumbnail_liquid_max_carves))
+        elif budget > 0:
+            worker = Thread(target = carve, args = (image.clone(),), name = "liquid_rescale")
+            worker.daemon = True
+            worker.start()
+            worker.join(budget)
+        else:
+            carve(image)
+        if len(result) != 0:
+            return result[0]
+
+        if budget > 0 and time.time() - start >= budget:
+            logger.warning("Liquid rescale of {} x {} to {} x {} exceeded time budget of {}s, using plain resize".format(
+                image.width, image.height, x_size, y_size, budget))
+        # We will do a simple non-recilinear rescale
+        self.resample(image, x_size, y_size, quality)
+        return image
+
+    def thumbnail(self, image, x_size, y_size, quality = "best", liquid = False, equalise = False, sharpen = False):
+        if liquid and quality != "fast":
+            image = self.liquid_rescale(image, x_size, y_size, quality)
+        else:
+            self.resample(image, x_size, y_size, quality)
+        if equalise:
+            image.equalize()
+        if sharpen:
+            image.unsharp_mask(**sharpen_parameters)
+        return image
+
+    def convert(self, image, kind):
+        # Wand implicitly creates a clone when creating a new format
+        return image.convert(kind)
+
+    def strip(self, image):
+        image.strip()
+        return image
+
+    def encode(self, image, kind):
+        return image.make_blob(kind)
+
+    def handle_arguments(self, image, kind):
+        return {"image" : image}
+
+
+class PixelImage(object):
+    """Native image of the NumPy backend
+
+    * pixels = float32 array of shape (height, width, channels), values 0..255
+    """
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+
+    def channels(self):
+        return self.pixels.shape[2]
+
+
+def _lanczos3(x):
+    x = numpy.abs(x)
+    result = numpy.sinc(x) * numpy.sinc(x / 3.0)
+    result[x >= 3.0] = 0.0
+    return result
+
+def _triangle(x):
+    return numpy.maximum(0.0, 1.0 - numpy.abs(x))
+
+_kernels = {"lanczos" : (_lanczos3, 3.0), "triangle" : (_triangle, 1.0)}
+
+
+def area_average(pixels, out_size, axis):
+    """Reduce one axis of an image by exact area averaging
+
+    Each output sample is the mean of the input over the interval it covers, including fractional coverage
+    of the samples at either end.  Computed from the running sum along the axis, so the cost is linear in
+    the input and independent of the reduction ratio.
+
+    :param pixels: image samples
+    :type pixels: numpy array
+    :param out_size: number of samples along ``axis`` in the result
+    :type out_size: integer
+    :param axis: the axis to reduce
+    :type axis: integer
+    :rtype: numpy array
+    """
+    in_size = pixels.shape[axis]
+    if out_size == in_size:
+        return pixels
+    moved = numpy.moveaxis(pixels, axis, 0).astype(numpy.float64)
+    running = numpy.concatenate((numpy.zeros((1,) + moved.shape[1:]), numpy.cumsum(moved, axis = 0)))
+    edges = numpy.linspace(0.0, in_size, out_size + 1)
+    lower = numpy.minimum(numpy.floor(edges).astype(int), in_size - 1)
+    fraction = (edges - lower).reshape((-1,) + (1,) * (moved.ndim - 1))
+    # The running sum at a fractional position interpolates linearly within the sample at that position
+    at_edges = running[lower] + fraction * moved[lower]
+    result = numpy.diff(at_edges, axis = 0) * (out_size / float(in_size))
+    return numpy.moveaxis(result.astype(numpy.float32), 0, axis)
+
+
+def separable_resample(pixels, out_size, axis, kernel = "lanczos"):
+    """Resample one axis of an image with a windowed filter kernel
+
+    When reducing, the kernel is widened by the reduction ratio so it also acts as the anti-aliasing filter.
+    Samples beyond the image edge replicate the edge.
+
+    :param pixels: image samples
+    :type pixels: numpy array
+    :param out_size: number of samples along ``axis`` in the result
+    :type out_size: integer
+    :param axis: the axis to resample
+    :type axis: integer
+    :param kernel: ``lanczos`` or ``triangle``
+    :type kernel: string
+    :rtype: numpy array
+    """
+    in_size = pixels.shape[axis]
+    if out_size == in_size:
+        return pixels
+    function, support = _kernels[kernel]
+    scale = in_size / float(out_size)
+    filter_scale = max(scale, 1.0)
+    radius = support * filter_scale
+    centres = (numpy.arange(out_size) + 0.5) * scale
+    taps = int(numpy.ceil(radius)) * 2 + 1
+    first = numpy.floor(centres - radius).astype(int)
+    indices = first[:, None] + numpy.arange(taps)[None, :]
+    weights = function((indices + 0.5 - centres[:, None]) / filter_scale)
+    weights /= weights.sum(axis = 1, keepdims = True)
+    indices = numpy.clip(indices, 0, in_size - 1)
+
+    moved = numpy.moveaxis(pixels, axis, 0)
+    shape = (-1,) + (1,) * (moved.ndim - 1)
+    result = numpy.zeros((out_size,) + moved.shape[1:], dtype = numpy.float32)
+    for tap in range(taps):
+        result += weights[:, tap].astype(numpy.float32).reshape(shape) * moved[indices[:, tap]]
+    return numpy.moveaxis(result, 0, axis)
+
+
+def _gaussian_blur(pixels, sigma):
+    radius = max(1, int(numpy.ceil(3.0 * sigma)))
+    offsets = numpy.arange(-radius, radius + 1)
+    kernel = numpy.exp(-0.5 * (offsets / float(sigma)) ** 2)
+    kernel /= kernel.sum()
+    result = pixels
+    for axis in (0, 1):
+        moved = numpy.moveaxis(result, axis, 0)
+        size = moved.shape[0]
+        blurred = numpy.zeros(moved.shape, dtype = numpy.float32)
+        for offset, weight in zip(offsets, kernel):
+            blurred += weight * moved[numpy.clip(numpy.arange(size) + offset, 0, size - 1)]
+        result = numpy.moveaxis(blurred, 0, axis)
+    return result
+
+
+class NumpyBackend(DerivationBackend):
+    """Pillow codecs with NumPy resampling.  Native images are PixelImage instances.
+    """
+
+    name = "numpy"
+
+    _pillow_formats = {"jpg" : "JPEG", "png" : "PNG", "tif" : "TIFF", "bmp" : "BMP", "gif" : "GIF", "webp" : "WEBP"}
+    _alpha_formats = ("png", "tif", "gif", "webp")
+
+    def available(self):
+        return numpy is not None and PILImage is not None
+
+    def supports(self, kind):
+        return normalise_kind(kind) in self._pillow_formats
+
+    def decode(self, handle, reduce_to = None, copy = True):
+        the_bytes = handle.encoded_bytes()
+        if the_bytes is None:
+            raise RepositoryFailure("Unable to obtain image data")
+        Resources.check_dimensions(ImageHeaders.probe_bytes(the_bytes))
+        try:
+            image = PILImage.open(cStringIO.StringIO(the_bytes))
+            if reduce_to is not None and image.format == "JPEG":
+                # Let the JPEG decoder do the bulk of the reduction by DCT scaling. Never goes below reduce_to.
+                image.draft(image.mode, (int(reduce_to[0]), int(reduce_to[1])))
+            image.load()
+        except (IOError, SyntaxError, ValueError) as ex:
+            logger.error("Pillow decode fails: {}".format(ex))
+            raise RepositoryFailure("Unable to decode image")
+        if image.mode not in ("L", "RGB", "RGBA"):
+            has_alpha = "A" in image.mode or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        pixels = numpy.asarray(image, dtype = numpy.float32)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        return PixelImage(pixels)
+
+    def dimensions(self, image):
+        return image.pixels.shape[1], image.pixels.shape[0]
+
+    @staticmethod
+    def _resize_axis(pixels, out_size, axis, quality):
+        in_size = pixels.shape[axis]
+        if out_size >= in_size:
+            return separable_resample(pixels, out_size, axis, "triangle" if quality == "fast" else "lanczos")
+        if quality == "fast":
+            return area_average(pixels, out_size, axis)
+        if quality == "balanced" and in_size > 2 * out_size:
+            pixels = area_average(pixels, 2 * out_size, axis)
+        return separable_resample(pixels, out_size, axis, "lanczos")
+
+    def resize(self, image, x_size, y_size, quality = "best"):
+        pixels = self._resize_axis(image.pixels, max(1, int(y_size)), 0, quality)
+        image.pixels = self._resize_axis(pixels, max(1, int(x_size)), 1, quality)
+        return image
+
+    def crop(self, image, x_size, y_size, x_offset, y_offset):
+        return PixelImage(image.pixels[y_offset:(y_offset+y_size), x_offset:(x_offset+x_size)].copy())
+
+    def rotate(self, image, degrees, mirror = False):
+        pixels = image.pixels
+        if mirror:
+            pixels = pixels[:, ::-1]
+        degrees = degrees % 360
+        if degrees % 90 == 0:
+            pixels = numpy.rot90(pixels, -int(degrees) // 90)
+        else:
+            # Pillow rotates one channel at a time for float images
+            channels = [PILImage.fromarray(numpy.ascontiguousarray(pixels[:, :, channel]), "F").rotate(
+                            -degrees, resample = PILImage.BICUBIC, expand = True) for channel in range(pixels.shape[2])]
+            pixels = numpy.dstack([numpy.asarray(channel, dtype = numpy.float32) for channel in channels])
+        image.pixels = numpy.ascontiguousarray(pixels)
+        return image
+
+    def thumbnail(self, image, x_size, y_size, quality = "best", liquid = False, equalise = False, sharpen = False):
+        # There is no seam carving here, a liquid rescale becomes a plain (distorting) resize
+        image = self.resize(image, x_size, y_size, quality)
+        colour = image.pixels[:, :, :3] if image.channels() >= 3 else image.pixels[:, :, :1]
+        if equalise:
+            for channel in range(colour.shape[2]):
+                values = numpy.clip(colour[:, :, channel], 0, 255).astype(numpy.uint8)
+                histogram = numpy.bincount(values.ravel(), minlength = 256)
+                cumulative = numpy.cumsum(histogram).astype(numpy.float64)
+                span = cumulative[-1] - cumulative[0]
+                if span > 0:
+                    lookup = (cumulative - cumulative[0]) * 255.0 / span
+                    colour[:, :, channel] = lookup[values]
+        if sharpen and sharpen_parameters["sigma"] > 0:
+            blurred = _gaussian_blur(colour, sharpen_parameters["sigma"])
+            detail = colour - blurred
+            significant = numpy.abs(detail) >= sharpen_parameters["threshold"] * 255.0
+            colour += numpy.where(significant, sharpen_parameters["amount"] * detail, 0.0).astype(numpy.float32)
+        return image
+
+    def convert(self, image, kind):
+        # The format is only applied on encoding
+        return image
+
+    def strip(self, image):
+        # Pillow writes no metadata unless asked to
+        return image
+
+    def encode(self, image, kind):
+        kind = normalise_kind(kind)
+        pixels = numpy.clip(numpy.round(image.pixels), 0, 255).astype(numpy.uint8)
+        if pixels.shape[2] == 4 and kind not in self._alpha_formats:
+            pixels = pixels[:, :, :3]
+        if pixels.shape[2] == 1:
+            pil_image = PILImage.fromarray(pixels[:, :, 0], "L")
+        else:
+            pil_image = PILImage.fromarray(pixels, "RGBA" if pixels.shape[2] == 4 else "RGB")
+        output = cStringIO.StringIO()
+        options = {"quality" : 92} if kind == "jpg" else {}    # Match the ImageMagick default
+        pil_image.save(output, format = self._pillow_formats[kind], **options)
+        return output.getvalue()
+
+    def handle_arguments(self, image, kind):
+        return {"bytes" : self.encode(image, kind), "kind" : kind}
+
+
+backends = {"wand" : WandBackend(), "numpy" : NumpyBackend()}
+_reported_unavailable = set()
+
+
+def select(operation, kind, source_kind = None):
+    """Choose the backend for an operation
+
+    :param operation: one of ``operations``
+    :type operation: string
+    :param kind: format of the result
+    :type kind: string or None
+    :param source_kind: format of the image being operated on
+    :type source_kind: string or None
+    :rtype: DerivationBackend
+
+    The configured ``derivation_backends`` map an operation to a map of format to backend name, ``*`` matching
+    any format.  Where no entry matches ``derivation_backend_default`` is used.
+    """
+    name = "wand"
+    if _configuration is not None:
+        name = _configuration.derivation_backend_default
+        by_kind = _configuration.derivation_backends.get(operation, {})
+        name = by_kind.get(normalise_kind(kind), by_kind.get("*", name))
+    backend = backends.get(name)
+    if backend is None or not backend.available():
+        if name not in _reported_unavailable:
+            logger.warning("Derivation backend {} is not available, using wand".format(name))
+            _reported_unavailable.add(name)
+        return backends["wand"]
+    if not (backend.supports(kind) and backend.supports(source_kind)):
+        return backends["wand"]
+    return backend
+
+
+def benchmark(configuration, test_dir, repeats = 3):
+    """Compare the available backends on a corpus of images, and log the results
+
+    Each image below ``test_dir`` is decoded, derived and encoded from its original bytes by every available
+    backend.  The best of ``repeats`` timings is reported for each operation, so the numbers include decoding,
+    which is where much of the difference between the engines lies.
+
+    :param configuration: The system configuration
+    :type configuration: Configuration
+    :param test_dir: Directory holding the corpus, usually the stress test images
+    :type test_dir: string
+    :param repeats: How many times to time each operation
+    :type repeats: integer
+    """
+    from ImageType import ImageHandle
+
+    set_configuration(configuration)
+    trials = (
+        ("thumbnail 50 fast", "thumbnail", (50, 50), "fast"),
+        ("thumbnail 50 best", "thumbnail", (50, 50), "best"),
+        ("resize 400 fast", "resize", (400, 400), "fast"),
+        ("resize 400 balanced", "resize", (400, 400), "balanced"),
+        ("resize 400 best", "resize", (400, 400), "best"),
+    )
+    engines = [backend for backend in backends.itervalues() if backend.available()]
+    totals = dict(((trial[0], engine.name), 0.0) for trial in trials for engine in engines)
+    count = 0
+
+    for root, dirs, files in os.walk(test_dir):
+        for name in files:
+            if name[:1] == ".":
+                continue
+            kind = normalise_kind(os.path.splitext(name)[1][1:])
+            with open(os.path.join(root, name), 'rb') as the_file:
+                the_bytes = the_file.read()
+            count += 1
+            for label, operation, size, quality in trials:
+                for engine in engines:
+                    if not engine.supports(kind):
+                        continue
+                    best = None
+                    for _ in range(repeats):
+                        handle = ImageHandle(bytes = the_bytes, kind = kind)
+                        start = time.time()
+                        native = engine.decode(handle, reduce_to = size if quality != "best" else None)
+                        if operation == "thumbnail":
+                            native = engine.thumbnail(native, size[0], size[1], quality, equalise = True, sharpen = True)
+                        else:
+                            native = engine.resize(native, size[0], size[1], quality)
+                        engine.encode(native, "jpg")
+                        elapsed = time.time() - start
+                        best = elapsed if best is None else min(best, elapsed)
+                    totals[(label, engine.name)] += best
+
+    logger.info("Derivation backend benchmark over {} images in {}".format(count, test_dir))
+    logger.info("{:24s}".format("operation") + "".join("{:>14s}".format(engine.name) for engine in engines))
+    for label, operation, size, quality in trials:
+        logger.info("{:24s}".format(label) + "".join("{:>13.3f}s".format(totals[(label, engine.name)]) for engine in engines))
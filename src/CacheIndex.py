@@ -0,0 +1,361 @@
+"""
+Cache Indexes
+-------------
+
+Compact indexes for the cache levels backed by Swift, whose containers may hold millions of objects.
+
+Rather than an entry, an image name, a handle and an image instance for every object, the index of a Swift backed
+level holds its objects in columns:
+
+* names = the object names, sorted, in one string with an array of offsets into it
+* sizes, retention times and access times = arrays of numbers
+* flags = one byte of flag bits per object
+
+Entries are small views onto the columns, made when looked up, and the image of an entry is only made when the
+entry's image is used.  Objects added once the index is built are held as ordinary cache entries beside the
+columns, and removed objects are marked as deleted.
+
+The base images of the repository are similarly held in a mapping whose images are made when first looked up,
+and held only while they are in use.
+"""
+
+import time
+import logging
+import weakref
+from array import array
+from threading import RLock
+
+logger = logging.getLogger("image_repository")
+
+# Flag bits of an object
+_prefer_retain = 1
+_must_retain = 2
+_deleted = 4
+
+_none = float("nan")    # Retention time column value for no retention time
+
+
+class CompactEntry(object):
+    """A cache entry held in the columns of a CompactIndex
+
+    Provides the interface of ``Caches.CacheEntry``.
+    """
+    __slots__ = ("_index", "_position")
+
+    def __init__(self, index, position):
+        self._index = index
+        self._position = position
+
+    @property
+    def image(self):
+        """The image of the entry, made on first use
+
+        :rtype: ImageInstance
+        """
+        return self._index._image(self._position)
+
+    @property
+    def size(self):
+        return self._index._sizes[self._position]
+
+    @property
+    def access_time(self):
+        return self._index._access[self._position]
+
+    @access_time.setter
+    def access_time(self, value):
+        self._index._access[self._position] = value
+
+    @property
+    def _retain_until(self):
+        value = self._index._retain_until[self._position]
+        return None if value != value else value
+
+    def _flag(self, flag):
+        return self._index._flags[self._position] & flag != 0
+
+    def _set_flag(self, flag, value):
+        if value:
+            self._index._flags[self._position] |= flag
+        else:
+            self._index._flags[self._position] &= ~flag & 0xff
+
+    def set_must_retain(self, permanent):
+        self._set_flag(_must_retain, permanent)
+
+    def must_retain(self):
+        """Return whether the image must be preserved in persistent storeage.
+
+        :rtype: boolean
+        """
+        retain_until = self._retain_until
+        return self._flag(_must_retain) or (retain_until is not None and retain_until > time.time())
+
+    def set_retain(self, retain):
+        self._set_flag(_prefer_retain, retain)
+
+    def should_retain(self):
+        return self._flag(_prefer_retain)
+
+    def set_retain_until(self, retain_time):
+        """Set a time until which the object must be retained in persistent storage
+
+        :param retain_until: The time until which the object must be retained, seconds since the epoch
+        :type retain_until: int or None
+        """
+        if retain_time is not None and retain_time < time.time():
+            retain_time = 0
+        self._index._retain_until[self._position] = _none if retain_time is None else retain_time
+
+    def get_retain_until(self):
+        return self._retain_until
+
+    def has_persistence(self):
+        """Objects of the index were listed from persistent storage
+
+        :rtype: boolean
+        """
+        return True
+
+    def __str__(self):
+        the_string = "name : {}\n".format(self._index._name(self._position))
+        the_string += "size :  {} bytes\n".format(self.size)
+        the_string += "{}\n".format("Retain in cache if possible" if self.should_retain() else "No cache retention")
+        the_string += "{}\n".format("Must retain as persistent" if self._flag(_must_retain) else "No persistent retention")
+        return the_string
+
+
+class CompactIndex(object):
+    """The contents of a cache level, by name, held in columns
+
+    Behaves as the dictionary of names to cache entries used by ``Caches.ImageCache``.
+    """
+
+    def __init__(self, objects, materialise):
+        """Build the index
+
+        :param objects: The objects of the level
+        :type objects: iterable of tuples (name, size, prefer retain, must retain)
+        :param materialise: Returns the image of an object from its name
+        :type materialise: function
+        """
+        self._materialise = materialise
+        self._lock = RLock()
+        names = []
+        sizes = array('l')
+        flags = bytearray()
+        for name, size, retain, permanent in objects:
+            names.append(name)
+            sizes.append(size)
+            flags.append((_prefer_retain if retain else 0) | (_must_retain if permanent else 0))
+        order = sorted(xrange(len(names)), key = names.__getitem__)
+
+        self._offsets = array('L', [0])
+        for position in order:
+            self._offsets.append(self._offsets[-1] + len(names[position]))
+        self._names = "".join(names[position] for position in order)
+        self._sizes = array('l', (sizes[position] for position in order))
+        self._flags = bytearray(flags[position] for position in order)
+        self._retain_until = array('d', [0.0]) * len(order)
+        self._access = array('d', [0.0]) * len(order)
+        self._count = len(order)
+        self._deleted = 0
+        self._images = {}     # position : image, of the images made
+        self._added = {}      # name : CacheEntry, of the objects added once built
+
+    def _name(self, position):
+        return self._names[self._offsets[position]:self._offsets[position + 1]]
+
+    def _position(self, name):
+        """The position of a name in the columns, or None"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and not self._flags[low] & _deleted and self._name(low) == name:
+            return low
+        return None
+
+    def _image(self, position):
+        image = self._images.get(position)
+        if image is None:
+            image = self._materialise(self._name(position))
+            with self._lock:
+                image = self._images.setdefault(position, image)
+        return image
+
+    def __contains__(self, name):
+        return name in self._added or self._position(name) is not None
+
+    def __getitem__(self, name):
+        entry = self._added.get(name)
+        if entry is not None:
+            return entry
+        position = self._position(name)
+        if position is None:
+            raise KeyError(name)
+        return CompactEntry(self, position)
+
+    def get(self, name, default = None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setitem__(self, name, entry):
+        with self._lock:
+            position = self._position(name)
+            if position is not None:
+                self._remove(position)
+            self._added[name] = entry
+
+    def __delitem__(self, name):
+        with self._lock:
+            if self._added.pop(name, None) is not None:
+                return
+            position = self._position(name)
+            if position is None:
+                raise KeyError(name)
+            self._remove(position)
+
+    def _remove(self, position):
+        self._flags[position] |= _deleted
+        self._images.pop(position, None)
+        self._deleted += 1
+
+    def __len__(self):
+        return self._count - self._deleted + len(self._added)
+
+    def iterkeys(self):
+        for position in xrange(self._count):
+            if not self._flags[position] & _deleted:
+                yield self._name(position)
+        for name in self._added.keys():
+            yield name
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iterprefix(self, prefix):
+        """The names starting with a prefix, found without reading the other names
+
+        :rtype: iterator of strings
+        """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        for position in xrange(low, self._count):
+            name = self._name(position)
+            if not name.startswith(prefix):
+                break
+            if not self._flags[position] & _deleted:
+                yield name
+        for name in self._added.keys():
+            if name.startswith(prefix):
+                yield name
+
+    def iteritems(self):
+        for position in xrange(self._count):
+            if not self._flags[position] & _deleted:
+                yield self._name(position), CompactEntry(self, position)
+        for item in self._added.items():
+            yield item
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for name, entry in self.iteritems():
+            yield entry
+
+    def values(self):
+        return list(self.itervalues())
+
+
+class LazyImages(object):
+    """A mapping of names to images, made when first looked up and made again once no longer used
+
+    The images are held weakly, so an image stays in memory only while it is used elsewhere, as in the caches.
+    The function that makes each image is kept, and is called again when the image is looked up after it has gone.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._images = weakref.WeakValueDictionary()    # name : image, of the images made and still in use
+        self._deferred = {}    # name : function returning the image
+
+    def defer(self, name, function, image = None):
+        """Add a name whose image is made by a function when looked up
+
+        :param name: The name
+        :type name: string
+        :param function: Returns the image
+        :type function: function
+        :param image: The image, if it is already made
+        :type image: object or None
+        """
+        with self._lock:
+            self._images.pop(name, None)
+            self._deferred[name] = function
+            if image is not None:
+                self._images[name] = image
+
+    def __getitem__(self, name):
+        with self._lock:
+            image = self._images.get(name)
+            if image is not None:
+                return image
+            function = self._deferred[name]
+        image = function()
+        if image is None:
+            return None
+        with self._lock:
+            if self._deferred.get(name) is not function:
+                return image
+            return self._images.setdefault(name, image)
+
+    def get(self, name, default = None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __delitem__(self, name):
+        with self._lock:
+            self._images.pop(name, None)
+            del self._deferred[name]
+
+    def __contains__(self, name):
+        return name in self._deferred
+
+    def __len__(self):
+        return len(self._deferred)
+
+    def keys(self):
+        with self._lock:
+            return self._deferred.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def copy(self):
+        """A copy of the mapping, sharing its images and deferred images
+
+        :rtype: LazyImages
+        """
+        the_copy = LazyImages()
+        with self._lock:
+            the_copy._images.update(self._images)
+            the_copy._deferred.update(self._deferred)
+        return the_copy
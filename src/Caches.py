@@ -13,14 +13,27 @@ import re
 import time
 import weakref
 import os
+import itertools
 import stat
 import wand.image
 import traceback
 from threading import RLock
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 import logging
 
 import Configuration
 import ImageNames
+import Tiles
+import Sprites
+import Placeholders
+import CacheIndex
+import Startup
+import NegativeCache
+import Promotion
+import Metrics
+import SharedMemory
+import Peers
 from ImageType import *
 
 from Exceptions import RepositoryError
@@ -70,7 +83,7 @@ class CacheEntry:
 
         :rtype: boolean
         """
-        return self._must_retain or (self._retain_until is not None and self._retain_until < time.time())
+        return self._must_retain or (self._retain_until is not None and self._retain_until > time.time())
 
     def set_retain(self, retain):
         """Set the entry to indicate whether the image should be preferentially retained during cache evictions.
@@ -119,6 +132,39 @@ class CacheEntry:
         return the_string
 
         
+class DeferredCacheEntry(CacheEntry):
+    """A cache entry for an object of a persistent store, whose image is made when first used
+    """
+    def __init__(self, materialise, name, size = 0, retain = False, permanent = False):
+        """Construct a DeferredCacheEntry
+
+        :param materialise: Returns the image of the object from its name
+        :type materialise: function
+        :param name: Name of the object
+        :type name: string
+        """
+        self._materialise = materialise
+        self._name = name
+        self.access_time = time.clock()
+        self._retain_until = 0
+        self._prefer_retain = retain
+        self._must_retain = permanent
+        self.size = size
+
+    def __getattr__(self, attribute):
+        if attribute != "image":
+            raise AttributeError(attribute)
+        self.image = self._materialise(self._name)
+        return self.image
+
+    def has_persistence(self):
+        """Objects listed in a persistent store have a copy in it
+
+        :rtype: boolean
+        """
+        return True
+
+
 class ImageCache(object):
     """Provides cache semantics for a single Image via its ImageHandle
 
@@ -145,6 +191,8 @@ class ImageCache(object):
     This operation is optional, and can be configured.
     """
 
+    level_name = "cache"     # Name of the level of the hierarchy, in metrics
+
     def __init__(self, configuration):
         """Instantiate a cache
 
@@ -186,6 +234,13 @@ class ImageCache(object):
         """
         self._previous = cache
         
+    def exclusive(self):
+        """Return whether images promoted from this level to the level above are removed from this level
+
+        :rtype: boolean
+        """
+        return self._configuration.mode == 'exclusive'
+
     def contains(self, name):
         """Return whether the named element is in this cache
 
@@ -413,7 +468,7 @@ class ImageCache(object):
         index = 0
         while to_delete > 0 and size_to_delete >= 0 and index < len(kill_list):
             delete_this = kill_list[index]
-            if self.delete(delete_this[0]):   # It is possible a delete will fail
+            if self.delete(delete_this[0], demote = True):   # It is possible a delete will fail
                 to_delete -= 1
                 size_to_delete -= delete_this[1].size
             index += 1
@@ -425,7 +480,7 @@ class ImageCache(object):
         while to_delete > 0 and size_to_delete >= 0 and index < len(persistent_write_back):
             delete_this = persistent_write_back[index]
             self._async_write_back(delete_this[0])
-            if self.delete(delete_this[0]):   # It is possible a delete will fail
+            if self.delete(delete_this[0], demote = True):   # It is possible a delete will fail
                 to_delete -= 1
                 size_to_delete -= delete_this[1].size
             index += 1
@@ -438,7 +493,7 @@ class ImageCache(object):
         index = 0
         while to_delete > 0 and size_to_delete >= 0 and index < len(retained_list):
             delete_this = retained_list[index]
-            if self.delete(delete_this[0]):   # It is possible a delete will fail
+            if self.delete(delete_this[0], demote = True):   # It is possible a delete will fail
                 to_delete -= 1
                 size_to_delete -= delete_this[1].size
             index += 1
@@ -499,11 +554,13 @@ class ImageCache(object):
                 self._write_back(name)
         self._logger.info("Cache ends flush down")
                 
-    def delete(self, image_name):
+    def delete(self, image_name, demote = False):
         """Remove a specified image from the cache.
 
         :param name: name of the entry that the cache has as the key
         :type name: string
+        :param demote: whether the image is evicted, and so written to the next level if that level is exclusive
+        :type demote: boolean
 
         The cache is responsible for removing any local file, persistent, or other storage used.
         However in-memory ImageInstance objects will be removed by normal garbage collection operations.
@@ -511,19 +568,44 @@ class ImageCache(object):
 
         name = str(image_name)
         self._logger.debug("Deleting {} from {}".format(name, self.__class__.__name__))
+        demoted = None
         try:
             with self._lock:
-                if self._contents[name].must_retain():
-                    self._async_write_back(name)
                 entry = self._contents[name]
+                if entry.must_retain():
+                    self._async_write_back(name)
+                elif demote:
+                    demoted = entry
                 self._size -= entry.size
                 self._remove_actual(name)
                 del self._contents[name]
-            return True
         except (KeyError) as ex:
             self._logger.exception("Attempt to delete cache entry not in cache.  {}".format(name))
             return False
+        if demoted is not None:
+            self._demote(name, demoted)
+        return True
         
+    def _demote(self, name, entry):
+        """Add an evicted image to the next ephemeral level if that level is exclusive, as it holds no copy of the image
+
+        Called once the entry is removed and the lock of this level released, so that the write to the next level
+        does not hold up this one.
+
+        :param name: Name of the evicted image
+        :type name: string
+        :param entry: The entry of the evicted image
+        :type entry: CacheEntry
+        """
+        next_level = getattr(self, "_next_ephemeral", None)
+        if next_level is None or not next_level.exclusive():
+            return
+        try:
+            next_level.add(name, entry.image, entry.should_retain(), False)
+            Metrics.increment("hierarchy.demote.{}".format(next_level.level_name))
+        except (RepositoryError, RepositoryFailure):
+            self._logger.exception("Demotion of {} from {} fails".format(name, self.__class__.__name__))
+
     def _write_back(self, image_name):
         """Synchronously write the named element back to the next level of the heirarchy
 
@@ -537,7 +619,6 @@ class ImageCache(object):
             if not self._contents[name].must_retain():
                 if self._next_ephemeral is not None:
 #                    print "Ephemeral add for {}".format(name)
-                    print self._contents[name]
                     self._next_ephemeral.add(name, self._contents[name].image, self._contents[name].should_retain(), self._contents[name].must_retain())
             else:
                 if self._next_persistent is not None:
@@ -635,6 +716,8 @@ class MemoryImageCache(ImageCache):
     """
     Provide a cache of images that reside within the running address space
     """
+    level_name = "memory"
+
     def __init__(self, configuration):
         super(MemoryImageCache, self).__init__(configuration)
         self._base_cost = 0
@@ -658,6 +741,91 @@ class MemoryImageCache(ImageCache):
         self._contents[reference].image._image_handle.weaken_liveness()
         return True
 
+class SharedMemoryImageCache(ImageCache):
+    """Provide a cache of encoded images in memory shared by the worker processes of a host
+
+    Images are written through to this level as they are added to the memory cache, so that the other workers
+    find them without reading them from local files or Swift.  The oldest images are overwritten by the newest,
+    so images are never evicted from this level to the levels below.  Original images are not held.
+    """
+    level_name = "shared_memory"
+
+    def __init__(self, configuration):
+        """Construct a shared memory cache, open only if it is enabled
+
+        :param configuration: Configuration for the cache
+        :type configuration: Configuration.SharedMemoryCacheConfig
+        """
+        super(SharedMemoryImageCache, self).__init__(configuration)
+        self._base_cost = 0
+        self._max_object_size = configuration.max_object_size
+        self._arena = None
+        if configuration.enabled:
+            try:
+                self._arena = SharedMemory.SharedArena(configuration.path, configuration.max_size, configuration.max_elements)
+            except (OSError, IOError):
+                logger.exception("Shared memory cache {} cannot be opened, not used".format(configuration.path))
+        if self._arena is not None:
+            Metrics.gauge("shared_memory.writes", self._arena.writes)
+
+    def __str__(self):
+        the_string =  "  Shared Memory Cache:\n"
+        the_string += "    enabled    : {}".format(self._arena is not None)
+        return the_string
+
+    def contains(self, name):
+        return self._arena is not None and self._arena.contains(str(name))
+
+    def cost(self, name):
+        return self._base_cost if self.contains(name) else None
+
+    def get(self, name):
+        """Return the named image if any worker has written it
+
+        :param name: Name of the image
+        :type name: ImageName or string
+        :rtype: ImageInstance or None
+        """
+        if self._arena is None:
+            return None
+        the_bytes = self._arena.get(str(name))
+        if the_bytes is None:
+            return None
+        the_name = name if isinstance(name, ImageName) else ImageName(name)
+        # Left encoded, so that images which are only served out are never decoded
+        return GeneralImage(the_name, ImageHandle(bytes = the_bytes, kind = the_name.image_kind()), True)
+
+    def add(self, name, element, retain = False, must_retain = False):
+        """Write the encoded image for the other workers
+
+        :param name: The name by which the element is indexed
+        :type name: string
+        :param: element: The image
+        :type element:  ImageInstance or derived class
+        :rtype: boolean, whether the image is written
+        """
+        if self._arena is None or must_retain or self._is_permanent(name):
+            return False
+        the_bytes = element.get_image_handle().encoded_bytes()
+        if the_bytes is None or len(the_bytes) > self._max_object_size:
+            return False
+        return self._arena.put(str(name), the_bytes)
+
+    def delete(self, name, demote = False):
+        if self._arena is not None:
+            self._arena.discard(str(name))
+
+    def list_images(self, path = None, separator = '/'):
+        return []
+
+    def image_names(self):
+        return iter(())
+
+    def _clean(self):
+        """The arena overwrites its oldest images, there is nothing to clean"""
+        pass
+
+
 class LocalFileImageCache(ImageCache):
     """Provide a cache for images using storage on a local file system
 
@@ -665,6 +833,8 @@ class LocalFileImageCache(ImageCache):
     but are subject to removal on system reboot, or general cleaning up.
     Thus we can usefully reuse them on restart, but cannot assume that they will be there.
     """
+    level_name = "file"
+
     def __init__(self, configuration):
         """Construct a local file cache
 
@@ -850,7 +1020,7 @@ class LocalFileImageCache(ImageCache):
         Delete the refered to file from the local file cache
         """
         try:
-            os.delete(os.path.join(self._file_cache_path, ref))
+            os.remove(os.path.join(self._file_cache_path, ImageName.safe_name(ref)))
             return True
         except Exception as ex:
             self._logger.exception("Error in deleting local file cache image {}".format(os.path.join(self._file_cache_path, ref)), exc_info = ex)
@@ -885,6 +1055,73 @@ class LocalFileImageCache(ImageCache):
 
 
         
+class PeerImageCache(ImageCache):
+    """Provide the images owned by the other replicas of the repository
+
+    The level holds no images of its own.  A derived image is asked of the peer that owns it, which finds it in its
+    own caches, or derives it when asked to, and serves it.  Original images are found in the persistent store.
+    """
+    level_name = "peer"
+
+    def __init__(self, ring):
+        """Construct the peer level
+
+        :param ring: The ring of the replicas of the repository
+        :type ring: Peers.PeerRing
+        """
+        super(PeerImageCache, self).__init__(Configuration.CacheConfig(None))
+        self._base_cost = 5
+        self._ring = ring
+
+    def __str__(self):
+        the_string =  "  Peer Cache:\n"
+        the_string += "    enabled    : {}".format(self._ring.enabled())
+        return the_string
+
+    def contains(self, name):
+        return False
+
+    def get(self, name, derive = False):
+        """Return the named image from the peer that owns it
+
+        :param name: Name of the image
+        :type name: ImageName or string
+        :param derive: Whether the owner is to derive the image if it does not hold it
+        :type derive: boolean
+        :rtype: ImageInstance or None
+        """
+        the_name = name if isinstance(name, ImageName) else ImageName(name)
+        if not self._ring.enabled() or not the_name.is_derived() or the_name.is_metadata():
+            return None
+        the_bytes = self._ring.fetch(str(name), derive)
+        if the_bytes is None:
+            return None
+        # The owner sends the image encoded, it is decoded here only if something is derived from it
+        return GeneralImage(the_name, ImageHandle(bytes = the_bytes, kind = the_name.image_kind()), True)
+
+    def is_peer(self, host):
+        """Returns whether a host is one of the replicas, when peering is enabled
+
+        :rtype: boolean
+        """
+        return self._ring.enabled() and self._ring.is_peer(host)
+
+    def add(self, name, element, retain = False, must_retain = False):
+        return False
+
+    def delete(self, name, demote = False):
+        pass
+
+    def list_images(self, path = None, separator = '/'):
+        return []
+
+    def image_names(self):
+        return iter(())
+
+    def _clean(self):
+        pass
+
+
 class PersistentImageCache(ImageCache):
     """Provide a cache for images that are stored on remote persistent storeage
 
@@ -900,10 +1137,12 @@ class PersistentImageCache(ImageCache):
 
     Thumbnails are almost certainly a good idea to preferentially retain. 
     """
+    level_name = "swift_cache"
 
     def __init__(self, configuration):
         super(PersistentImageCache, self).__init__(configuration)
         self._base_cost = 10
+        self._permanent = False
         self._persistent_store_path = configuration.container
         #        self._store_kind = store_kind
         #        self._store = store_kind(configuration)
@@ -914,29 +1153,90 @@ class PersistentImageCache(ImageCache):
         self._initialise()
 
         
+    def _holds(self, name):
+        """Whether an object of the store belongs to this level"""
+        return not (Tiles.is_tile_object(name) or Placeholders.is_index_object(name) or ImageNames.is_original_name(name))
+
     def _initialise(self):
-        names = []
+        objects = []
         for name, size, kind in self._store.list_images():
-            image_name = ImageName(name)
-            if not image_name.is_original():
-                format = self.from_content_type(kind)
-                entry = CacheEntry(GeneralImage.from_persistent(self._store, path = name), size = size, retain = self._should_retain(name), permanent = False)
-                self._contents[name] = entry
+            if self._holds(name):
+                objects.append((name, size, ImageNames.is_thumbnail_name(name), False))
                 self._size += size
-                names.append(name)
-
-        logger.info("{} Starts with {} objects".format(self.__class__.__name__, len(names)))        
-        image_metadata = self._store.find_metadata(names, ['lifetime'])
-        logger.info("{} {} objects with lifetime values".format(self.__class__.__name__, len(image_metadata)))
-        for the_object, meta in image_metadata:
+                if len(objects) % 10000 == 0:
+                    Startup.advance(self.__class__.__name__, len(objects))
+        self._contents = CacheIndex.CompactIndex(objects, self._materialise)
+        Startup.advance(self.__class__.__name__, len(objects))
+        logger.info("{} Starts with {} objects".format(self.__class__.__name__, len(objects)))        
+
+    def load_lifetimes(self):
+        """Read the retention times of the cached objects, from the manifest of the container or their metadata
+
+        Without a manifest this reads the metadata of every object, so is done in the background once the server is
+        ready.  Until an object's retention time is read it is never removed.
+        """
+        names = list(self._contents.iterkeys())
+        lifetimes = self._store.lifetimes(names)
+        logger.info("{} {} objects with lifetime values".format(self.__class__.__name__, len(lifetimes)))
+        for the_object, lifetime in lifetimes:
             try:
-                self._contents[the_object].set_retain_until(float(meta['lifetime']))
-            except KeyError, ValueError:
+                self._contents[the_object].set_retain_until(lifetime)
+            except KeyError:
                 continue
             
     # In principle a Swift store can hold an arbitrary amount of metadata as key:value pairs
     # By default we get the content_type from which we can get the image type that Swift thinks it is.
             
+    def _materialise(self, name):
+        """Make the image of an object listed in the store"""
+        return GeneralImage.from_persistent(self._store, path = name)
+
+    def follow_changes(self, listener = None):
+        """Follow the changes other servers make to the store, so that this level holds the objects they add
+
+        :param listener: Also called with each change to an object of this level
+        :type listener: function (operation, name, value) or None
+        """
+        def changed(operation, name, value):
+            if self.apply_change(operation, name, value) and listener is not None:
+                listener(operation, name, value)
+        self._store.follow(changed)
+
+    def apply_change(self, operation, name, value):
+        """Apply a change another server made to the store
+
+        :param operation: One of ``put``, ``delete``, ``retain``
+        :type operation: string
+        :param name: Name of the object
+        :type name: string
+        :param value: For ``put`` [size, content type, retain until, base], for ``retain`` the time to retain until
+        :rtype: boolean, whether the object belongs to this level
+        """
+        if not self._holds(name):
+            return False
+        entry = self._contents.get(name)
+        if operation == "put" and entry is None:
+            size = value[0]
+            self._contents[name] = DeferredCacheEntry(self._materialise, name, size, retain = ImageNames.is_thumbnail_name(name),
+                                                      permanent = self._permanent)
+            self._size += size
+        elif operation == "delete" and entry is not None:
+            try:
+                del self._contents[name]
+                self._size -= entry.size
+            except KeyError:
+                pass
+        elif operation == "retain" and entry is not None:
+            entry.set_retain_until(value)
+        return True
+
+    def image_names(self):
+        """Return a list of all the ImageNames, without making their images
+
+        :rtype: list of ImageName
+        """
+        return (ImageName(name) for name in self._contents.iterkeys())
+
     @staticmethod
     def from_content_type(kind):
         is_image, format = kind.split("/")
@@ -1039,19 +1339,19 @@ class PersistentImageStore(PersistentImageCache):
 
     This can be used next to or instead of the PersisentImage Cache.
     """
+    level_name = "swift_store"
 
     def __init__(self, configuration):
+        # The store is created, and indexed, by the PersistentImageCache constructor
         super(PersistentImageStore, self).__init__(configuration)
-        self._base_cost = 10
-        self._persistent_store_path = configuration.container
-        #        self._store_kind = store_kind
-        #        self._store = store_kind(configuration)
+        self._permanent = True
 
-        swift = Stores.SwiftImageStore( configuration, self )
+    def exclusive(self):
+        """Images are never removed from the store when promoted"""
+        return False
 
-        self._store = swift        
-        
-        self._initialise()
+    def _holds(self, name):
+        return ImageNames.is_original_name(name) and not (Tiles.is_tile_object(name) or Placeholders.is_index_object(name))
 
         
     def _initialise(self, use_name = True):
@@ -1061,13 +1361,21 @@ class PersistentImageStore(PersistentImageCache):
         This is only needed if the store is shared with a cache of derived images.
         :type use_name: boolean
         """
+        objects = []
         for name, size, kind in self._store.list_images():
-            image_name = ImageName(name)
-            if not use_name or image_name.is_original():
-                format = self.from_content_type(kind)
-                entry = CacheEntry(GeneralImage.from_persistent(self._store, path = name), size = size, retain = self._should_retain(name), permanent = True)
-                self._contents[name] = entry
+            if Tiles.is_tile_object(name) or Placeholders.is_index_object(name):
+                continue
+            if not use_name or ImageNames.is_original_name(name):
+                objects.append((name, size, ImageNames.is_thumbnail_name(name), True))
                 self._size += size
+                if len(objects) % 10000 == 0:
+                    Startup.advance(self.__class__.__name__, len(objects))
+        self._contents = CacheIndex.CompactIndex(objects, self._materialise)
+        Startup.advance(self.__class__.__name__, len(objects))
+
+    def load_lifetimes(self):
+        """Objects of the store are retained regardless of their lifetimes"""
+        return
 
 
     # In principle a Swift store can hold an arbitrary amount of metadata as key:value pairs
@@ -1141,6 +1449,168 @@ class PersistentImageStore(PersistentImageCache):
         return
 #        raise RepositoryFailure()
     
+class DecodedImageCache(object):
+    """Cache of decoded base images, held as ImageMagick pixel cache (MPC) files
+
+    An MPC file pair (an ``.mpc`` header and a ``.cache`` file of raw pixels) is ImageMagick's in-memory pixel
+    layout written straight to disk.  Reading one involves no decoding, ImageMagick memory maps the pixels, so
+    derivations from a base image held here skip the JPEG/TIFF decode entirely, and many derivations of the same
+    hot image share the same mapped pages.
+
+    Pixel caches are typically several times larger than the compressed image, so this level is kept apart from
+    the other caches with its own byte budget, and evicts the least recently used base images.  It is keyed by
+    base name, and holds only base images, never derived ones.
+    """
+
+    def __init__(self, configuration):
+        """Construct the decoded image cache
+
+        :param configuration: Configuration for the cache
+        :type configuration: Configuration.DecodedCacheConfig
+        """
+        self._logger = logging.getLogger("image_repository")
+        self._configuration = configuration
+        self._cache_path = configuration.cache_path
+        self._max_size = configuration.max_size
+        self._contents = OrderedDict()    # base name : bytes used, least recently used first
+        self._size = 0
+        self._lock = RLock()
+        if configuration.enabled:
+            self._check_state()
+
+    def enabled(self):
+        """:rtype: boolean"""
+        return self._configuration.enabled
+
+    def _paths(self, base_name):
+        """The header and pixel file paths of the pixel cache for a base image
+
+        :rtype: tuple (string, string)
+        """
+        stem = os.path.join(self._cache_path, ImageName.safe_name(base_name))
+        return stem + ".mpc", stem + ".cache"
+
+    def _used_space(self, base_name):
+        """:rtype: integer"""
+        return sum(os.stat(path).st_size for path in self._paths(base_name) if os.path.exists(path))
+
+    def _check_state(self):
+        """Create the cache directory, or index the pixel caches already present within it
+
+        Pixel caches left by an earlier run are reused, least recently modified evicted first.
+        A pixel cache from an incompatible ImageMagick build is discarded when it is first read.
+
+        :raises: RepositoryError
+        """
+        path = self._cache_path
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path, 0700)
+                return
+            found = []
+            for name in os.listdir(path):
+                stem, extension = os.path.splitext(name)
+                if extension != ".mpc" or not os.path.exists(os.path.join(path, stem + ".cache")):
+                    continue
+                base_name = ImageName.unsafe_name(stem)
+                found.append((os.stat(os.path.join(path, name)).st_mtime, base_name))
+            for mtime, base_name in sorted(found):
+                size = self._used_space(base_name)
+                self._contents[base_name] = size
+                self._size += size
+            self._evict()
+        except (IOError, OSError):
+            self._logger.exception("Unable to prepare decoded image cache {}".format(path))
+            raise RepositoryError("Unable to prepare decoded image cache {}".format(path))
+
+    def _remove_actual(self, base_name):
+        for path in self._paths(base_name):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                self._logger.exception("Error in deleting decoded pixel cache {}".format(path))
+
+    def _evict(self, keep = None):
+        """Evict least recently used pixel caches until within the byte budget
+
+        Mapped pixel caches that are evicted remain valid for any image already reading them.
+
+        :param keep: Base name that must not be evicted
+        :type keep: string or None
+        """
+        if self._max_size == 0:
+            return
+        with self._lock:
+            for base_name in self._contents.keys():
+                if self._size <= self._max_size:
+                    break
+                if base_name == keep:
+                    continue
+                self._size -= self._contents.pop(base_name)
+                self._remove_actual(base_name)
+
+    def get(self, base_name, kind):
+        """Return a handle on the decoded base image, if it is held
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param kind: Format the base image is encoded in when it leaves the cache
+        :type kind: string
+        :rtype: ImageHandle or None
+        """
+        if not self.enabled():
+            return None
+        with self._lock:
+            size = self._contents.pop(base_name, None)
+            if size is None:
+                return None
+            self._contents[base_name] = size     # Now the most recently used
+        return ImageHandle.from_pixel_cache(self._paths(base_name)[0], kind)
+
+    def add(self, base_name, handle):
+        """Write a decoded base image to a pixel cache, and attach the pixel cache to its handle
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param handle: The decoded base image
+        :type handle: ImageHandle
+        :rtype: boolean
+        """
+        if not self.enabled():
+            return False
+        header_path = self._paths(base_name)[0]
+        with self._lock:
+            if base_name in self._contents:
+                handle.add_pixel_cache(header_path)
+                return True
+        try:
+            # The file extension selects the MPC coder
+            handle._get_image().save(filename = header_path)
+            size = self._used_space(base_name)
+        except Exception:
+            self._logger.exception("Unable to write decoded pixel cache for {}".format(base_name))
+            self._remove_actual(base_name)
+            return False
+        if self._max_size != 0 and size > self._max_size:
+            self._logger.info("Decoded pixel cache for {} of {} bytes exceeds budget".format(base_name, size))
+            self._remove_actual(base_name)
+            return False
+        with self._lock:
+            self._contents[base_name] = size
+            self._size += size
+            self._evict(keep = base_name)
+        handle.add_pixel_cache(header_path)
+        return True
+
+    def __str__(self):
+        the_string =  "  Decoded Image Cache:\n"
+        the_string += "    cache path : {}\n".format(self._cache_path)
+        the_string += "    elements   : {}\n".format(len(self._contents))
+        the_string += "    size       : {}".format(self._size)
+        return the_string
+
+
 class CacheMaster(ImageCache):
     """Controlling cache interface
     
@@ -1157,23 +1627,39 @@ class CacheMaster(ImageCache):
         Creates the designated caches, and binds them into a cache hierarchy.
         """
         self._logger = logging.getLogger("image_repository")
+        self._configuration = configuration
         self._base_images = None
         self._memory_cache = MemoryImageCache(configuration.memory_cache_configuration)
+        self._shared_cache = SharedMemoryImageCache(configuration.shared_memory_cache_configuration)
 
 #        print self._memory_cache
         
+        Startup.begin("LocalFileImageCache")
         self._file_cache = LocalFileImageCache(configuration.local_cache_configuration)
+        Startup.complete("LocalFileImageCache")
 
 #        print self._file_cache
 
         configuration.swift_cache_configuration._file_cache_path = configuration.local_cache_configuration.cache_path
         configuration.persistent_store_configuration._file_cache_path = configuration.local_cache_configuration.cache_path
 
+        Startup.begin("PersistentImageCache")
         self._persistent_cache = PersistentImageCache(configuration.swift_cache_configuration)
+        Startup.complete("PersistentImageCache")
 #        print self._persistent_cache
 
+        Startup.begin("PersistentImageStore")
         self._persistent_store = PersistentImageStore(configuration.persistent_store_configuration)
+        Startup.complete("PersistentImageStore")
 #        print self._persistent_store        
+
+        self._decoded_cache = DecodedImageCache(configuration.decoded_cache_configuration)
+        Startup.begin("TilePyramidCache")
+        self._tile_cache = Tiles.TilePyramidCache(configuration.tile_configuration, self._persistent_cache._store)
+        Startup.complete("TilePyramidCache")
+        Startup.begin("PlaceholderIndex")
+        self._placeholders = Placeholders.PlaceholderIndex(configuration.placeholder_configuration, self._persistent_store._store)
+        Startup.complete("PlaceholderIndex")
         
         self._memory_cache.set_next_ephemeral_level(self._file_cache)
         self._memory_cache.set_next_retained_level(self._file_cache)
@@ -1187,13 +1673,21 @@ class CacheMaster(ImageCache):
         self._persistent_store.set_previous_level(self._file_cache)
 
 
-        self._search_caches = (self._memory_cache,  self._file_cache, self._persistent_cache, self._persistent_store)
+        self._peer_cache = PeerImageCache(Peers.PeerRing(configuration.peer_configuration))
+
+        self._search_caches = (self._memory_cache, self._shared_cache, self._file_cache, self._peer_cache,
+                               self._persistent_cache, self._persistent_store)
+        self._negative = NegativeCache.NegativeCache(configuration.negative_cache_configuration)
+        self._promotion = Promotion.PromotionPolicy(configuration.promotion_configuration)
         
                         
     def cost(self, image_name):
 
         name = str(image_name)
         cost = self._memory_cache.cost(name)
+        if cost is not None:
+            return cost
+        cost = self._shared_cache.cost(name)
         if cost is not None:
             return cost
         cost = self._file_cache.cost(name)
@@ -1201,6 +1695,15 @@ class CacheMaster(ImageCache):
             return cost
         return self._persistent_cache.cost(name)
 
+    def is_peer(self, host):
+        """Returns whether a host is one of the replicas sharing derived images with this one
+
+        :param host: IP address of the host
+        :type host: string
+        :rtype: boolean
+        """
+        return self._peer_cache.is_peer(host)
+
     def use_local_master(self, image_name):
         """Returns if the most efficient way of producing the image is to derive it from a locally held
         copy of the master.
@@ -1219,28 +1722,74 @@ class CacheMaster(ImageCache):
             return True
         return image_cost > master_cost
     
-    def _get_entry(self, name):
+    def _get_entry(self, name, derive = False):
         """Implement the cache heirarchy get function
 
         :param name: name of the image to get
         :type name: string
+        :param derive: whether the peer owning the image is to derive it if it does not hold it
+        :type derive: boolean
         :rtype: ImageInstance or None
         
         """
-        image = self._memory_cache.get(name)
-        if image is not None:
-            return image
-        image = self._file_cache.get(name)
-        if image is not None:
-            return image
-        image = self._persistent_cache.get(name)
-        if image is not None:
-            return image
-        image = self._persistent_store.get(name)
-        if image is not None:
-            return image        
+        for cache in self._search_caches:
+            if cache is self._peer_cache:
+                image = cache.get(name, derive)
+            else:
+                image = cache.get(name)
+            if image is not None:
+                Metrics.increment("hierarchy.hit.{}".format(cache.level_name))
+                if cache is not self._memory_cache:
+                    self._promote(name, image, cache)
+                return image
+        Metrics.increment("hierarchy.miss")
         return None
 
+    def _promote(self, name, image, cache):
+        """Count a hit on a lower level, and promote the image if it is hit often enough
+
+        If the level it is found on is exclusive the image is removed from that level once promoted.  Images
+        promoted to the memory cache from below the shared memory cache are written to it too, for the other workers.
+
+        :param name: name of the image
+        :type name: string
+        :param image: the image found
+        :type image: ImageInstance
+        :param cache: the level the image is found on
+        :type cache: ImageCache
+        """
+        target_name = self._promotion.hit(name, cache.level_name)
+        if target_name is None:
+            return
+        target = self._memory_cache if target_name == "memory" else self._file_cache
+        permanent = self._is_permanent(name)
+        exclusive = cache.exclusive() and not permanent
+        try:
+            if exclusive or target is self._memory_cache:
+                # The image must not depend upon the copy it was read from
+                image.get_image_handle().hold_bytes()
+            if not target.add(name, image, self._should_retain(name), permanent):
+                return
+        except (RepositoryError, RepositoryFailure):
+            logger.exception("Promotion of {} from {} to {} fails".format(name, cache.level_name, target_name))
+            return
+        Metrics.increment("hierarchy.promote.{}.{}".format(cache.level_name, target_name))
+        if target is self._memory_cache and cache is not self._shared_cache:
+            self._share(name, image)
+        if exclusive:
+            cache.delete(name)
+
+    def _share(self, name, image):
+        """Write an image to the shared memory cache, for the other workers
+
+        Failure to share an image is logged, and is otherwise of no consequence.
+        """
+        try:
+            if self._shared_cache.add(str(name), image):
+                Metrics.increment("hierarchy.share")
+        except (RepositoryError, RepositoryFailure, OSError, IOError):
+            logger.exception("Sharing of {} fails".format(name))
+
     def get(self, name):
         """Get the image from its name from any cache
 
@@ -1254,7 +1803,7 @@ class CacheMaster(ImageCache):
             the_name = name
         return self._get_entry(the_name)
     
-    def get_as_defined(self, definition_name):
+    def get_as_defined(self, definition_name, found = None):
         """Get the image as defined by name
 
         The image name may or may not describe an extant derived image.  If an image with the name
@@ -1262,8 +1811,20 @@ class CacheMaster(ImageCache):
 
         :param name: Name describing the image to be returned
         :type name: ImageName
-        """
-        image = self.get(definition_name)
+        :param found: Function called with whether the image is already held, before it is made if it is not
+        :type found: callable or None
+        """
+        requested_name = str(definition_name)
+        definition_name = definition_name.normalised()
+        failure = self._negative.lookup(str(definition_name))
+        if failure is not None:
+            raise RepositoryFailure(failure[1], failure[0])
+        # A peer owning the image derives it, once for all the replicas
+        image = self._get_entry(str(definition_name), derive = True)
+        if image is None:
+            image = self._get_aliased(definition_name, requested_name)
+        if found is not None:
+            found(image is not None)
         if image is not None:
             return image
 
@@ -1272,20 +1833,29 @@ class CacheMaster(ImageCache):
             base_image = self._base_images[definition_name.base_name()].baseimage(full_name = True)
             base_kind = base_image.name.image_kind()
         except KeyError:
-            raise RepositoryError("Expected name: {} not in base image names".format(definition_name))
+            description = "Expected name: {} not in base image names".format(definition_name)
+            self._negative.record(str(definition_name), definition_name.base_name(), 404, description)
+            raise RepositoryError(description, 404)
 
         # Cope with an edge case in the naming scheme. 
         # If there is no other derivation operation we need to force the format conversion
         # so the as_defined call will process it.
-        if not definition_name.is_derived() and definition_name.image_kind() != base_kind:
-            definition_name.apply_convert(definition_name.image_kind())
+        converted_name = definition_name.converted_from(base_kind)
+        if converted_name != definition_name:
+            definition_name = converted_name
             logger.debug("Applied format conversion to base {} from {}".format(definition_name, base_image.name))
             
-        new_image = base_image.as_defined(definition_name)
+        try:
+            new_image = base_image.as_defined(definition_name)
+        except (RepositoryError, RepositoryFailure) as ex:
+            # Deriving the image again fails the same way, until the original is replaced, unless the failure is
+            # not of the request but of the stores or the server, which the negative cache does not record
+            self._negative.record(str(definition_name), definition_name.base_name(), ex.code(), ex.description())
+            raise
         self.add(definition_name, new_image)
         if new_image is None:
-            logger.error("As defined returns None image from {}".format(name))
-            raise RepositoryFailure("As defined returns None image from {}".format(name))
+            logger.error("As defined returns None image from {}".format(definition_name))
+            raise RepositoryFailure("As defined returns None image from {}".format(definition_name))
         if str(new_image.name) != str(definition_name):
             logger.error("Failure to create required defined image {}, got {} from {}".format(definition_name, new_image.name, base_image.name))
             raise RepositoryFailure("Failure to create required defined image {}, got {} from {}".format(definition_name, new_image.name, base_image.name))
@@ -1293,6 +1863,294 @@ class CacheMaster(ImageCache):
 
 
 
+    def after_start(self):
+        """Work done in the background once the server is ready, that requests do not wait for"""
+        self._persistent_cache.follow_changes()
+        self._persistent_store.follow_changes(self._original_changed)
+        Startup.begin("lifetimes")
+        self._persistent_cache.load_lifetimes()
+        Startup.complete("lifetimes")
+
+    def _original_changed(self, operation, name, value):
+        """Apply to the base images an original image another server has added or removed"""
+        the_name = ImageName(name)
+        base_images = self._get_base_images()
+        if operation == "put":
+            base_images.defer(the_name.base_name(), lambda: self._persistent_store.get(the_name))
+            self._negative.invalidate(the_name.base_name())
+            logger.info("Original {} added by another server".format(name))
+        elif operation == "delete":
+            try:
+                del base_images[the_name.base_name()]
+            except KeyError:
+                pass
+
+    def _aliases(self, image_name):
+        """The names under which the persistent caches hold an image, from before names were normalised
+
+        Only the names of the same base image are read, from the sorted indexes of the caches.
+
+        :param image_name: The normalised name
+        :type image_name: ImageName
+        :rtype: iterator of strings
+        """
+        the_name = str(image_name)
+        base_name = image_name.base_name()
+        aliases = set()
+        for cache in (self._persistent_cache, self._persistent_store):
+            for name in self._prefixed(cache, base_name):
+                if name == the_name or name in aliases:
+                    continue
+                alias = ImageName(name)
+                if alias.base_name() == base_name and str(alias.normalised()) == the_name:
+                    aliases.add(name)
+                    yield name
+
+    @staticmethod
+    def _prefixed(cache, prefix):
+        """The names held by a persistent cache that start with a prefix
+
+        :rtype: iterable of strings
+        """
+        contents = cache._contents
+        if isinstance(contents, CacheIndex.CompactIndex):
+            return contents.iterprefix(prefix)
+        return [name for name in contents.keys() if name.startswith(prefix)]
+
+    def _original_version(self, base_name):
+        """The version of an original image, which changes when the original is replaced
+
+        The version is the name and size of the original in the persistent store, read from its index.
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :rtype: string
+        """
+        for name in self._prefixed(self._persistent_store, base_name + "+original("):
+            entry = self._persistent_store._contents.get(name)
+            if entry is not None:
+                return "{}:{}".format(name, entry.size)
+        return ""
+
+    def _get_aliased(self, image_name, requested_name):
+        """Get an image cached under a name from before names were normalised, and cache it under its normalised name
+
+        :param image_name: The normalised name
+        :type image_name: ImageName
+        :param requested_name: The name as requested
+        :type requested_name: string
+        :rtype: ImageInstance or None
+        """
+        candidates = [requested_name] if requested_name != str(image_name) else []
+        for name in itertools.chain(candidates, self._aliases(image_name)):
+            image = self.get(name)
+            if image is not None and image.get_image_handle() is not None:
+                logger.debug("Moving cached image {} to its normalised name {}".format(name, image_name))
+                instance = ImageInstance(image_name = image_name, image_handle = image.get_image_handle())
+                self.add(image_name, instance)
+                return instance
+        return None
+
+    def get_resized_from(self, source_name, size, quality = None, found = None):
+        """Get an image resized from another derived image, rather than from the base image
+
+        The resized image is returned if it is held, otherwise the source image is found, or created, as defined
+        by its name.
+
+        :param source_name: Name of the image to resize
+        :type source_name: ImageName
+        :param size: Box to fit the resized image within
+        :type size: tuple (x_size, y_size)
+        :param quality: Resampling tier, or None for the configured default
+        :type quality: string or None
+        :param found: Function called with whether the resized image, or else the source image, is already held
+        :type found: callable or None
+        :rtype: ImageInstance
+        """
+        image = self.get(source_name.normalised().apply_resize(size, quality = quality))
+        if image is not None:
+            if found is not None:
+                found(True)
+            return image
+        source = self.get_as_defined(source_name, found)
+        image = source.resize(size, quality = quality)
+        self.add(image.name, image)
+        return image
+
+    def get_decoded(self, base_name, kind):
+        """Get a handle on the decoded base image from the decoded image cache
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param kind: Format of the base image
+        :type kind: string
+        :rtype: ImageHandle or None
+        """
+        return self._decoded_cache.get(base_name, kind)
+
+    def add_decoded(self, base_name, handle):
+        """Place a decoded base image into the decoded image cache
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param handle: The decoded base image
+        :type handle: ImageHandle
+        :rtype: boolean
+        """
+        return self._decoded_cache.add(base_name, handle)
+
+    def get_sprite(self, names, size, kind, quality, columns):
+        """Get the sprite holding the thumbnails of the named images, making it if need be
+
+        Thumbnails already in the caches are used as they are, missing thumbnails are derived in parallel.
+
+        :param names: Base names of the images, in sprite order
+        :type names: list of strings
+        :param size: Size of the thumbnails, and of each cell of the sprite
+        :type size: tuple (x_size, y_size)
+        :param kind: Format of the sprite and its thumbnails
+        :type kind: string
+        :param quality: Resampling tier of the thumbnails, or None for the configured default
+        :type quality: string or None
+        :param columns: Number of cells across the sprite
+        :type columns: integer
+        :rtype: tuple (ImageInstance, dict of cells, see Sprites.layout)
+        :raises: RepositoryFailure, RepositoryError
+        """
+        configuration = self._configuration
+        if len(names) > configuration.sprite_max_images:
+            raise RepositoryFailure("{} images exceed the sprite limit of {}".format(len(names), configuration.sprite_max_images), 413)
+        thumbnail_names = {}
+        for name in names:
+            thumbnail_names[name] = ImageName(name, kind = kind).apply_thumbnail(size, kind = kind, quality = quality)
+        quality = thumbnail_names[names[0]].quality() if len(names) > 0 else "best"
+        versions = [self._original_version(name) for name in names]
+        the_name = Sprites.sprite_name(names, versions, size, kind, quality, columns)
+        cells = Sprites.layout(names, size, columns)
+        sprite = self.get(the_name)
+        if sprite is not None:
+            return sprite, cells
+
+        thumbnails = {}
+        missing = []
+        for name in names:
+            thumbnail = self.get(thumbnail_names[name])
+            if thumbnail is not None:
+                thumbnails[name] = thumbnail
+            else:
+                missing.append(name)
+        if len(missing) > 0:
+            def derive(name):
+                try:
+                    return name, self.get_as_defined(thumbnail_names[name])
+                except (RepositoryError, RepositoryFailure):
+                    logger.exception("Thumbnail of {} for sprite fails".format(name))
+                    return name, None
+            pool = ThreadPool(max(1, min(configuration.sprite_workers, len(missing))))
+            try:
+                for name, thumbnail in pool.map(derive, missing):
+                    if thumbnail is not None:
+                        thumbnails[name] = thumbnail
+            finally:
+                pool.close()
+                pool.join()
+        handle = Sprites.compose(thumbnails, cells, size, columns, kind, configuration.sprite_background)
+        sprite = ImageInstance(image_name = the_name, image_handle = handle)
+        self.add(the_name, sprite)
+        return sprite, cells
+
+    def add_placeholders(self, base_name, handle):
+        """Compute and record the placeholders of a newly uploaded image, if enabled
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param handle: The uploaded image
+        :type handle: ImageHandle
+        """
+        if ImageInstance._configuration.placeholder_configuration.enabled:
+            self._placeholders.add(base_name, handle)
+
+    def placeholders(self, names):
+        """Return the placeholders of the named images, where they are known
+
+        :param names: Base names of the images
+        :type names: list of strings
+        :rtype: list of dicts, each holding the name and any placeholders
+        """
+        result = []
+        for name in names:
+            entry = {"name" : name}
+            entry.update(self._placeholders.get(name) or {})
+            result.append(entry)
+        return result
+
+    def backfill_placeholders(self):
+        """Start computing, in the background, the placeholders of originals that lack them, if enabled"""
+        if ImageInstance._configuration.placeholder_configuration.backfill:
+            self._placeholders.backfill(self._get_base_images().copy())
+
+    def original_header(self, base_name):
+        """Return the format and dimensions of an original image, read from its header where possible
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :rtype: ImageHeaders.ImageHeader
+        :raises: RepositoryFailure if there is no such image, or its dimensions cannot be found
+        """
+        try:
+            original = self._get_base_images()[base_name]
+        except KeyError:
+            raise RepositoryFailure("Image '{}' not found".format(base_name), 404)
+        header = original.get_image_handle().header()
+        if header is None:
+            raise RepositoryFailure("Dimensions of image '{}' unavailable".format(base_name))
+        return header
+
+    def _tile_source(self, base_name):
+        """A function returning the base image of a tile pyramid
+
+        :raises: RepositoryFailure if there is no such base image
+        """
+        if base_name not in self._get_base_images():
+            raise RepositoryFailure("No image {} to tile".format(base_name), 404)
+        return lambda: self._get_base_images()[base_name].baseimage(full_name = True)
+
+    def get_tile(self, base_name, level, column, row, kind):
+        """Get a single tile of the deep zoom pyramid of an image, generating its level if need be
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param level: Pyramid level, the full resolution image is the highest level
+        :type level: integer
+        :param column: Tile column
+        :type column: integer
+        :param row: Tile row
+        :type row: integer
+        :param kind: Tile format
+        :type kind: string
+        :rtype: bytes
+        :raises: RepositoryFailure, RepositoryError
+        """
+        return self._tile_cache.get_tile(base_name, self._tile_source(base_name), level, column, row, kind)
+
+    def get_tile_descriptor(self, base_name, kind):
+        """Get the DZI descriptor of the deep zoom pyramid of an image
+
+        :rtype: string
+        :raises: RepositoryFailure, RepositoryError
+        """
+        return self._tile_cache.geometry(base_name, self._tile_source(base_name), kind).dzi(kind)
+
+    def tile_on_upload(self, base_name, header):
+        """Generate the tile pyramid of a newly uploaded image in the background, if it is large enough
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param header: Header of the uploaded image
+        :type header: ImageHeaders.ImageHeader or None
+        """
+        self._tile_cache.consider(base_name, self._tile_source(base_name), header)
+
     def add_image(self, image):
         """Place the image into the cache/store heirachy
 
@@ -1318,6 +2176,8 @@ class CacheMaster(ImageCache):
         logger.debug("Adding image {} to master cache".format(name))
         
         ref = self._memory_cache.add(str(name), image, retain, must_retain)
+        if ref is not None and not must_retain:
+            self._share(name, image)
         if ref is None:
             ref = self._file_cache.add(str(name), image, retain, must_retain)
         if ref is None:
@@ -1328,7 +2188,8 @@ class CacheMaster(ImageCache):
 
         # Keep the base name list up to date
         if image.name.is_original():
-            self._get_base_images()[image.name.base_name()] = image
+            self._get_base_images().defer(image.name.base_name(), lambda name = str(image.name): self.get(name), image)
+            self._negative.invalidate(image.name.base_name())
         return ref
         
 
@@ -1403,11 +2264,11 @@ class CacheMaster(ImageCache):
         cannonical names.  Base names can contain ``/`` 
         """
         if self._base_images is None:
-            self._base_images = {}
+            self._base_images = CacheIndex.LazyImages()
             for cache in (self._memory_cache,  self._file_cache, self._persistent_store):
                 for name in cache.image_names():        
-                    if name.is_original():
-                        self._base_images[name.base_name()] = cache.get(name)
+                    if name.is_original() and not Sprites.is_sprite_object(name.base_name()):
+                        self._base_images.defer(name.base_name(), lambda cache = cache, name = name: cache.get(name))
         return self._base_images
 
 
@@ -1423,15 +2284,22 @@ class CacheMaster(ImageCache):
         if regexp is None:
             return self._get_base_images().keys()
         else:
+            # Searches that found nothing are remembered, as each scans every base name
+            search = u"search:{}:{}".format(path, regexp)
+            if self._negative.lookup(search) is not None:
+                return []
             try:
                 exp = re.compile(regexp) #, flags=re.DEBUG)
                 if path is not None:
                     base_images = [ name for name in self._get_base_images() if name.find(path) == 0 ]
                 else:
                     base_images = [ name for name in self._get_base_images().keys() ]
-                return [name for name in base_images if self._match_found(exp, name)]
+                found = [name for name in base_images if self._match_found(exp, name)]
             except re.error as ex:
                 raise RepositoryFailure("Regular expression fails {}".format(re.error))
+            if len(found) == 0:
+                self._negative.record(search, None)
+            return found
             
     def get_base_images(self, name, regexp = None):
         """Return the BaseImageInstance for which the string name is the base name
@@ -1484,7 +2352,14 @@ class CacheMaster(ImageCache):
         """
 
         if regexp is None:
-            return name in self._get_base_images()
+            key, base_name = u"original:{}".format(name), name
+        else:
+            key, base_name = u"search:{}:{}".format(None, regexp), None
+        if self._negative.lookup(key) is not None:
+            return False
+        if regexp is None:
+            if name in self._get_base_images():
+                return True
         else:
             try:
                 exp = re.compile(regexp)
@@ -1493,6 +2368,7 @@ class CacheMaster(ImageCache):
                         return True
             except re.error as ex:
                 raise RepositoryFailure("Regular expression fails {}".format(re.error))
+        self._negative.record(key, base_name)
         return False
         
     def list_images(self):
@@ -1513,6 +2389,7 @@ class CacheMaster(ImageCache):
         the_string += str(self._file_cache) + "\n"
         the_string += str(self._persistent_cache) + "\n"
         the_string += str(self._persistent_store) + "\n"
+        the_string += str(self._decoded_cache) + "\n"
         return the_string
 
 
@@ -1548,6 +2425,8 @@ def startup(configuration):
     swift_cache_contents = swift_cache.get_contents()
     swift_store_contents = swift_store.get_contents()
 
+    cache.backfill_placeholders()
+
     test_dir = "../test/image_test/images"
 
     return cache
@@ -26,6 +26,8 @@ import Caches
 import ImageNames
 import ImageType
 import Stores
+import Resources
+import Backends
 import swiftclient
 
 from Exceptions import RepositoryError
@@ -220,6 +222,7 @@ class CacheConfig(BaseConfig):
     * max_size = Maximum size of store (bytes), 0 = unlimited (integer)
     * max_elements = Maximum number of elements to store. 0 = unlimited (integer)
     * next_level = Next cache down in the heirarchy
+    * mode = Whether the level keeps images promoted to the level above, one of 'inclusive', 'exclusive' (string)
     """
     
     yaml_tag = u'!Cache_Configuration'
@@ -231,6 +234,7 @@ class CacheConfig(BaseConfig):
     max_size = "Maximum size of store (bytes), 0 = unlimited (integer)"
     max_elements = "Maximum number of elements to store. 0 = unlimited (integer)"
     next_level = "Next cache down in the heirarchy"
+    mode = "Whether the level keeps images promoted to the level above, one of 'inclusive', 'exclusive' (string)"
     
     def __init__(self, config):
         super(CacheConfig, self).__init__(config)
@@ -242,6 +246,7 @@ class CacheConfig(BaseConfig):
         self.max_size = 1 * 1024 * 1024 * 1024 # Gigabytes
         self.max_elements = 1024 * 1024
         self.next_level = None
+        self.mode = 'inclusive'
         self._previous_level = None
         self._assign_config(self, config)
 
@@ -345,6 +350,14 @@ class SwiftStoreConfig(CacheConfig):
     * url_lifetime_slack = Max additional time a URL will be allowed to last in seconds. Use to avoid constant recreation of derived images (integer)
     * url_key = Private key set for container to authenticate temporary ULRs (string)
     * url_method = Temporary URL access mechanism (usually GET)
+
+    * use_manifest = Whether to keep a manifest of the container in it, so that startup need not list the container (boolean)
+    * manifest_log_batch = Changes to the manifest written together as one log object (integer)
+    * manifest_flush_interval = Seconds between writes of changes to the manifest, 0 = only when a batch is full (integer)
+    * manifest_compact_after = Log objects written before the manifest is written whole and the log objects removed (integer)
+    * manifest_poll_interval = Seconds between reads of the changes other servers make to the container, 0 = never (integer)
+    * manifest_log_horizon = Seconds log objects are kept once included in the manifest, longer than servers' clocks differ and listings lag (integer)
+    * manifest_lease_time = Seconds a server compacting the manifest holds the lease to do so (integer)
     """
     
     yaml_tag = u'!Swift_Storage_Configuration'
@@ -359,6 +372,14 @@ class SwiftStoreConfig(CacheConfig):
     url_lifetime_slack = "Max additional time a URL will be allowed to last in seconds. Use to avoid constant recreation of derived images (integer)"
     url_key = "Private key set for container to authenticate temporary ULRs (string)"
     url_method = "Temporary URL access mechanism (usually GET)"
+
+    use_manifest = "Whether to keep a manifest of the container in it, so that startup need not list the container (boolean)"
+    manifest_log_batch = "Changes to the manifest written together as one log object (integer)"
+    manifest_flush_interval = "Seconds between writes of changes to the manifest, 0 = only when a batch is full (integer)"
+    manifest_compact_after = "Log objects written before the manifest is written whole and the log objects removed (integer)"
+    manifest_poll_interval = "Seconds between reads of the changes other servers make to the container, 0 = never (integer)"
+    manifest_log_horizon = "Seconds log objects are kept once included in the manifest, longer than servers' clocks differ and listings lag (integer)"
+    manifest_lease_time = "Seconds a server compacting the manifest holds the lease to do so (integer)"
     
     def __init__(self, config):
         super(SwiftStoreConfig, self).__init__(config)
@@ -379,6 +400,37 @@ class SwiftStoreConfig(CacheConfig):
         self.url_lifetime_slack = 3600 * 24   # 1 day  - To avoid constant thrashing of requests to the object store we give anyhting up to this amount additional life to objects
         self.url_key = "123456789"
         self.url_method = "GET"
+
+        self.use_manifest = True
+        self.manifest_log_batch = 100
+        self.manifest_flush_interval = 30
+        self.manifest_compact_after = 50
+        self.manifest_poll_interval = 5
+        self.manifest_log_horizon = 600
+        self.manifest_lease_time = 300
+        self._assign_config(self, config)
+
+class SharedMemoryCacheConfig(CacheConfig):
+    """Configuration of the cache of encoded images in memory shared by the worker processes of a host
+
+    The ring of records is ``max_size`` bytes, and the index has ``max_elements`` slots.
+
+    * enabled = Whether to share encoded images between worker processes (boolean)
+    * path = Path of the memory mapped file holding the images, normally under /dev/shm (string)
+    * max_object_size = Largest encoded image held (bytes) (integer)
+    """
+    yaml_tag = u'!Shared_Memory_Cache_Configuration'
+    enabled = "Whether to share encoded images between worker processes (boolean)"
+    path = "Path of the memory mapped file holding the images, normally under /dev/shm (string)"
+    max_object_size = "Largest encoded image held (bytes) (integer)"
+
+    def __init__(self, config):
+        super(SharedMemoryCacheConfig, self).__init__(config)
+        self.enabled = False
+        self.path = "/dev/shm/image_repo_cache"
+        self.max_size = 256 * 1024 * 1024
+        self.max_elements = 65536
+        self.max_object_size = 4 * 1024 * 1024
         self._assign_config(self, config)
 
 class LocalFileCacheConfig(CacheConfig):
@@ -405,6 +457,227 @@ class SwiftCacheConfig(SwiftStoreConfig):
     def __init__(self, config):
         super(SwiftCacheConfig, self).__init__(config)
         
+class ResourceLimitsConfig(BaseConfig):
+    """Configuration of the resources ImageMagick may use
+
+    * memory = Maximum memory ImageMagick may allocate for pixel caches (bytes), 0 = library default (integer)
+    * map = Maximum memory mapped pixel cache (bytes), 0 = library default (integer)
+    * disk = Maximum disk space for pixel caches (bytes), 0 = library default (integer)
+    * area = Maximum pixels of a single image held in memory, larger images are cached on disk, 0 = library default (integer)
+    * width = Maximum image width in pixels, wider images are refused, 0 = unlimited (integer)
+    * height = Maximum image height in pixels, taller images are refused, 0 = unlimited (integer)
+    * thread = Maximum ImageMagick threads per worker process, 0 = library default (integer)
+    * time = Maximum elapsed seconds for ImageMagick operations, 0 = unlimited (integer)
+    * max_pixels = Images with more pixels than this are refused before decoding, 0 = unlimited (integer)
+    * scratch_path = Directory for ImageMagick temporary files and disk pixel caches (string)
+    """
+
+    yaml_tag = u'!Resource_Limits_Configuration'
+    memory = "Maximum memory ImageMagick may allocate for pixel caches (bytes), 0 = library default (integer)"
+    map = "Maximum memory mapped pixel cache (bytes), 0 = library default (integer)"
+    disk = "Maximum disk space for pixel caches (bytes), 0 = library default (integer)"
+    area = "Maximum pixels of a single image held in memory, larger images are cached on disk, 0 = library default (integer)"
+    width = "Maximum image width in pixels, wider images are refused, 0 = unlimited (integer)"
+    height = "Maximum image height in pixels, taller images are refused, 0 = unlimited (integer)"
+    thread = "Maximum ImageMagick threads per worker process, 0 = library default (integer)"
+    time = "Maximum elapsed seconds for ImageMagick operations, 0 = unlimited (integer)"
+    max_pixels = "Images with more pixels than this are refused before decoding, 0 = unlimited (integer)"
+    scratch_path = "Directory for ImageMagick temporary files and disk pixel caches (string)"
+
+    def __init__(self, config):
+        super(ResourceLimitsConfig, self).__init__(config)
+        self.memory = 512 * 1024 * 1024
+        self.map = 1024 * 1024 * 1024
+        self.disk = 16 * 1024 * 1024 * 1024
+        self.area = 128 * 1024 * 1024
+        self.width = 65536
+        self.height = 65536
+        self.thread = 1
+        self.time = 0
+        self.max_pixels = 1024 * 1024 * 1024
+        self.scratch_path = "/var/tmp/image_repo_scratch"
+        self._assign_config(self, config)
+
+class DecodedCacheConfig(BaseConfig):
+    """Configuration of the cache of decoded base images
+
+    * enabled = Whether to keep decoded base images as memory mappable pixel caches (boolean)
+    * cache_path = Path to directory where decoded pixel caches are kept, must not be within the local file cache (string)
+    * max_size = Maximum space used by decoded pixel caches (bytes), 0 = unlimited (integer)
+    """
+
+    yaml_tag = u'!Decoded_Cache_Configuration'
+    enabled = "Whether to keep decoded base images as memory mappable pixel caches (boolean)"
+    cache_path = "Path to directory where decoded pixel caches are kept, must not be within the local file cache (string)"
+    max_size = "Maximum space used by decoded pixel caches (bytes), 0 = unlimited (integer)"
+
+    def __init__(self, config):
+        super(DecodedCacheConfig, self).__init__(config)
+        self.enabled = False
+        self.cache_path = "/var/tmp/image_repo_decoded"
+        self.max_size = 4 * 1024 * 1024 * 1024
+        self._assign_config(self, config)
+
+class NegativeCacheConfig(BaseConfig):
+    """Configuration of the cache of lookups that found nothing and derivations that failed
+
+    * enabled = Whether to remember lookups that found nothing and derivations that failed (boolean)
+    * max_entries = Most failures remembered, the oldest being forgotten first (integer)
+    * lifetime = Seconds a lookup that found nothing is remembered (integer)
+    * error_lifetime = Seconds a derivation refused with a 4xx code is remembered (integer)
+    """
+
+    yaml_tag = u'!Negative_Cache_Configuration'
+    enabled = "Whether to remember lookups that found nothing and derivations that failed (boolean)"
+    max_entries = "Most failures remembered, the oldest being forgotten first (integer)"
+    lifetime = "Seconds a lookup that found nothing is remembered (integer)"
+    error_lifetime = "Seconds a derivation refused with a 4xx code is remembered (integer)"
+
+    def __init__(self, config):
+        super(NegativeCacheConfig, self).__init__(config)
+        self.enabled = True
+        self.max_entries = 100000
+        self.lifetime = 60
+        self.error_lifetime = 300
+        self._assign_config(self, config)
+
+class PromotionConfig(BaseConfig):
+    """Configuration of the promotion of images found in the lower levels of the cache hierarchy
+
+    * enabled = Whether to promote images hit often on the lower levels (boolean)
+    * file_hits = Hits on the Swift levels within the window that promote an image to the local file cache, 0 = never (integer)
+    * memory_hits = Hits on the file or Swift levels within the window that promote an image to the memory cache, 0 = never (integer)
+    * window = Seconds within which hits are counted (integer)
+    * max_tracked = Most images whose hits are counted (integer)
+    """
+
+    yaml_tag = u'!Promotion_Configuration'
+    enabled = "Whether to promote images hit often on the lower levels (boolean)"
+    file_hits = "Hits on the Swift levels within the window that promote an image to the local file cache, 0 = never (integer)"
+    memory_hits = "Hits on the file or Swift levels within the window that promote an image to the memory cache, 0 = never (integer)"
+    window = "Seconds within which hits are counted (integer)"
+    max_tracked = "Most images whose hits are counted (integer)"
+
+    def __init__(self, config):
+        super(PromotionConfig, self).__init__(config)
+        self.enabled = True
+        self.file_hits = 2
+        self.memory_hits = 4
+        self.window = 300
+        self.max_tracked = 100000
+        self._assign_config(self, config)
+
+class PeerConfig(BaseConfig):
+    """Configuration of the ring of replicas of the repository, among which derived images are shared
+
+    * enabled = Whether to ask the replica owning a derived image for it rather than deriving it (boolean)
+    * peers = Addresses of the replicas, host:port, used when no dns_name is given (list)
+    * dns_name = Name resolving to the addresses of the replicas, such as their headless service, or None (string)
+    * self_address = Address of this replica, host:port, or None to use the POD_IP environment variable or host name (string)
+    * port = Port on which the replicas serve requests (integer)
+    * base_pathname = Top level name of the URL routing for requests from peers (string)
+    * virtual_nodes = Places each replica has on the ring (integer)
+    * timeout = Seconds to wait for a peer to answer, including deriving the image (real)
+    * failure_backoff = Seconds a peer that does not answer is left out of the ring (integer)
+    * refresh_interval = Seconds between resolving the replicas again (integer)
+    """
+
+    yaml_tag = u'!Peer_Configuration'
+    enabled = "Whether to ask the replica owning a derived image for it rather than deriving it (boolean)"
+    peers = "Addresses of the replicas, host:port, used when no dns_name is given (list)"
+    dns_name = "Name resolving to the addresses of the replicas, such as their headless service, or None (string)"
+    self_address = "Address of this replica, host:port, or None to use the POD_IP environment variable or host name (string)"
+    port = "Port on which the replicas serve requests (integer)"
+    base_pathname = "Top level name of the URL routing for requests from peers (string)"
+    virtual_nodes = "Places each replica has on the ring (integer)"
+    timeout = "Seconds to wait for a peer to answer, including deriving the image (real)"
+    failure_backoff = "Seconds a peer that does not answer is left out of the ring (integer)"
+    refresh_interval = "Seconds between resolving the replicas again (integer)"
+
+    def __init__(self, config):
+        super(PeerConfig, self).__init__(config)
+        self.enabled = False
+        self.peers = []
+        self.dns_name = None
+        self.self_address = None
+        self.port = 80
+        self.base_pathname = "_peer"
+        self.virtual_nodes = 64
+        self.timeout = 10.0
+        self.failure_backoff = 30
+        self.refresh_interval = 30
+        self._assign_config(self, config)
+
+class TileConfig(BaseConfig):
+    """Configuration of deep zoom tile pyramids
+
+    * cache_path = Path to directory where tile pyramid levels are kept, must not be within the local file cache (string)
+    * default_format = Format of tiles generated when an image is uploaded (string)
+    * max_size = Most bytes of pyramid levels kept in the directory, the least recently read being removed first (integer)
+    * min_pixels = Images with fewer pixels than this are not tiled (integer)
+    * overlap = Pixels each tile shares with each of its neighbours (integer)
+    * tile_size = Width and height of a tile, excluding overlap, must be even and more than twice the overlap (integer)
+    * upload_pixels = Pyramids are generated when images with at least this many pixels are uploaded, 0 = only on request (integer)
+    * use_swift = Whether to keep copies of pyramid levels in the Swift cache (boolean)
+    """
+
+    yaml_tag = u'!Tile_Configuration'
+    cache_path = "Path to directory where tile pyramid levels are kept, must not be within the local file cache (string)"
+    default_format = "Format of tiles generated when an image is uploaded (string)"
+    max_size = "Most bytes of pyramid levels kept in the directory, the least recently read being removed first (integer)"
+    min_pixels = "Images with fewer pixels than this are not tiled (integer)"
+    overlap = "Pixels each tile shares with each of its neighbours (integer)"
+    tile_size = "Width and height of a tile, excluding overlap, must be even and more than twice the overlap (integer)"
+    upload_pixels = "Pyramids are generated when images with at least this many pixels are uploaded, 0 = only on request (integer)"
+    use_swift = "Whether to keep copies of pyramid levels in the Swift cache (boolean)"
+
+    def __init__(self, config):
+        super(TileConfig, self).__init__(config)
+        self.cache_path = "/var/tmp/image_repo_tiles"
+        self.default_format = "jpg"
+        self.max_size = 10 * 1024 * 1024 * 1024
+        self.min_pixels = 1024 * 1024
+        self.overlap = 1
+        self.tile_size = 254
+        self.upload_pixels = 100 * 1024 * 1024
+        self.use_swift = True
+        self._assign_config(self, config)
+
+class PlaceholderConfig(BaseConfig):
+    """Configuration of low quality image placeholders and dominant colours
+
+    * enabled = Whether to compute placeholders when images are uploaded (boolean)
+    * backfill = Whether to compute, at startup, the placeholders of images that lack them (boolean)
+    * blurhash_components = Horizontal and vertical BlurHash components, each 1 to 9 [ int, int ]
+    * index_path = Path of the local copy of the placeholder index (string)
+    * lqip_quality = JPEG quality of the tiny placeholder image (integer)
+    * lqip_size = Largest dimension of the tiny placeholder image, from which all placeholders are computed (integer)
+    * save_interval = Seconds the changes to the index are gathered before it is written (real)
+    * use_swift = Whether to keep a copy of the index in the Swift store beside the originals (boolean)
+    """
+
+    yaml_tag = u'!Placeholder_Configuration'
+    enabled = "Whether to compute placeholders when images are uploaded (boolean)"
+    backfill = "Whether to compute, at startup, the placeholders of images that lack them (boolean)"
+    blurhash_components = "Horizontal and vertical BlurHash components, each 1 to 9 [ int, int ]"
+    index_path = "Path of the local copy of the placeholder index (string)"
+    lqip_quality = "JPEG quality of the tiny placeholder image (integer)"
+    lqip_size = "Largest dimension of the tiny placeholder image, from which all placeholders are computed (integer)"
+    save_interval = "Seconds the changes to the index are gathered before it is written (real)"
+    use_swift = "Whether to keep a copy of the index in the Swift store beside the originals (boolean)"
+
+    def __init__(self, config):
+        super(PlaceholderConfig, self).__init__(config)
+        self.enabled = True
+        self.backfill = False
+        self.blurhash_components = [4, 3]
+        self.index_path = "/var/tmp/image_repo_placeholders.json.gz"
+        self.lqip_quality = 40
+        self.lqip_size = 32
+        self.save_interval = 10.0
+        self.use_swift = True
+        self._assign_config(self, config)
+
 class PersistentStoreConfig(BaseConfig):
     """Configuration of the store system used to provide long-term resilient storage of preserved objects
     """    
@@ -423,14 +696,31 @@ class Configuration(BaseConfig):
     * pid_file = Path of the file in which the PID of a running server will be stored (string)
     * local_file_cache_path = Path to local filesystem where image files will be cached (string)
     * memory_cache_configuration = In memory cache for all images
+    * shared_memory_cache_configuration = Cache of encoded images in memory shared by the worker processes of a host
     * local_cache_configuration = Local file system cache for images, base and derived
+    * decoded_cache_configuration = Cache of decoded base images, avoiding repeated decoding of hot images
     * swift_cache_configuration = Swift cache of derived images - used to avoid regeneration
     * persisent_store_configuration = Persistent object store for permanently retained images
+    * resource_limits_configuration = Limits on the memory, disk, threads and image sizes ImageMagick may use
+    * placeholder_configuration = Low quality image placeholders and dominant colours returned with listings
+    * tile_configuration = Deep zoom tile pyramids of large images
+    * negative_cache_configuration = Lookups that found nothing and derivations that failed, answered without repeating them
+    * promotion_configuration = Promotion of images hit often on the lower levels of the cache hierarchy
+    * peer_configuration = Ring of replicas of the repository, among which derived images are shared
     * max_size = Maximum allocation of space in bytes to store all images, 0 = unlimited (integer)
     * max_images = Maximum number of any images to store, 0 = unlimited (integer)
     * alarm_threshold = Threshold of image repository use to signal an alarm at (real in range 0.0:1.0)
     * image_default_format = Default format to deliver images in. (string)
+    * negotiation_formats = Formats offered to clients that accept them when no format is requested, most preferred first (list)
+    * client_hints = Whether to size images from the DPR, Width and Save-Data client hints (boolean)
+    * client_hint_max_dpr = Greatest device pixel ratio honoured from client hints (real)
     * repository_base_pathname = Top level name of the URL routing for the server    
+    * iiif_base_pathname = Top level name of the URL routing for the IIIF Image API (string)
+    * sprite_base_pathname = Top level name of the URL routing for sprites of many thumbnails (string)
+    * sprite_background = Colour of sprite cells not covered by a thumbnail (string)
+    * sprite_columns = Default number of thumbnails across a sprite (integer)
+    * sprite_max_images = Most images that may be combined into one sprite (integer)
+    * sprite_workers = Threads deriving the missing thumbnails of a sprite in parallel (integer)
 
     * thumbnail_default_format = Default image format to generate thumbnails in (string)
     * thumbnail_default_size = Default size for thumbnails [ int, int ]
@@ -438,9 +728,24 @@ class Configuration(BaseConfig):
     * thumbnail_liquid_resize = Whether to allow distortion of the thumbnail aspect ratio for very long or very wide images (boolean)
     * thumbnail_sharpen = Whether to apply a sharpen operation to thumbnails (boolean)
     * thumbnail_liquid_cutin_ratio = If applying a distorted resize, what cutin ratio to use for a liquid rescale (real)
+    * thumbnail_liquid_working_multiple = Liquid rescale works on a copy reduced to this multiple of the thumbnail size (real)
+    * thumbnail_liquid_time_budget = Seconds a liquid rescale may take before falling back to a plain resize, 0 = unlimited (real)
+    * thumbnail_liquid_max_carves = Most liquid rescales, including those past their time budget, carving at once in a process (integer)
+    * thumbnail_use_embedded_preview = Whether to make small thumbnails from the preview embedded in a JPEG's EXIF data (boolean)
+    * thumbnail_preview_aspect_tolerance = Greatest relative difference between preview and image aspect ratios for a preview to be used (real)
+    * resample_default_quality = Resampling tier used when a request does not name one, one of 'fast', 'balanced', 'best' (string)
+    * size_ladder = Rungs, in pixels, that requested resize dimensions are raised to, empty = no snapping (list)
+    * size_ladder_exact = Whether to deliver the requested size, resized from the image at the snapped rung (boolean)
+    * derivation_backend_default = Engine used to derive images, one of 'wand', 'numpy' (string)
+    * derivation_backends = Per operation and format engine overrides, eg { thumbnail : { jpg : numpy, '*' : wand } } (dict)
     
     * cannonical_format_used = Whether to convert images to a standard intermediate format (boolean)
     * cannonical_format = If converting to a cannonical format, what format to use (string)
+    * strip_lossless = Whether to strip metadata from JPEG, PNG and TIFF images without decoding them (boolean)
+    * strip_keep_icc_profile = Whether to keep ICC colour profiles when stripping metadata without decoding (boolean)
+    * jpeg_lossless_transforms = Whether to crop, rotate and flip JPEG images without re-encoding them where possible (boolean)
+    * jpeg_lossless_crop_snap = Whether a lossless JPEG crop may move the region corner up and left to the iMCU grid (boolean)
+    * jpegtran_path = Path to the jpegtran executable used for lossless JPEG transforms (string)
     """
     
     yaml_tag = u'!Main_Image_Repo_Configuration'
@@ -450,14 +755,31 @@ class Configuration(BaseConfig):
     pid_file = "Path of the file in which the PID of a running server will be stored (string)"
     local_file_cache_path = "Path to local filesystem where image files will be cached (string)"
     memory_cache_configuration = "In memory cache for all images"
+    shared_memory_cache_configuration = "Cache of encoded images in memory shared by the worker processes of a host"
     local_cache_configuration = "Local file system cache for images, base and derived"
+    decoded_cache_configuration = "Cache of decoded base images, avoiding repeated decoding of hot images"
     swift_cache_configuration = "Swift cache of derived images - used to avoid regeneration"
     persisent_store_configuration = "Persistent object store for permanently retained images"
+    resource_limits_configuration = "Limits on the memory, disk, threads and image sizes ImageMagick may use"
+    placeholder_configuration = "Low quality image placeholders and dominant colours returned with listings"
+    tile_configuration = "Deep zoom tile pyramids of large images"
+    negative_cache_configuration = "Lookups that found nothing and derivations that failed, answered without repeating them"
+    promotion_configuration = "Promotion of images hit often on the lower levels of the cache hierarchy"
+    peer_configuration = "Ring of replicas of the repository, among which derived images are shared"
     max_size = "Maximum allocation of space in bytes to store all images, 0 = unlimited (integer)"
     max_images = "Maximum number of any images to store, 0 = unlimited (integer)"
     alarm_threshold = "Threshold of image repository use to signal an alarm at (real in range 0.0:1.0)"
     image_default_format = "Default format to deliver images in. (string)"
+    negotiation_formats = "Formats offered to clients that accept them when no format is requested, most preferred first (list)"
+    client_hints = "Whether to size images from the DPR, Width and Save-Data client hints (boolean)"
+    client_hint_max_dpr = "Greatest device pixel ratio honoured from client hints (real)"
     repository_base_pathname = "Top level name of the URL routing for the server"
+    iiif_base_pathname = "Top level name of the URL routing for the IIIF Image API (string)"
+    sprite_base_pathname = "Top level name of the URL routing for sprites of many thumbnails (string)"
+    sprite_background = "Colour of sprite cells not covered by a thumbnail (string)"
+    sprite_columns = "Default number of thumbnails across a sprite (integer)"
+    sprite_max_images = "Most images that may be combined into one sprite (integer)"
+    sprite_workers = "Threads deriving the missing thumbnails of a sprite in parallel (integer)"
     
     thumbnail_default_format = "Default image format to generate thumbnails in (string)"
     thumbnail_default_size = "Default size for thumbnails [ int, int ]"
@@ -465,20 +787,49 @@ class Configuration(BaseConfig):
     thumbnail_liquid_resize = "Whether to allow distortion of the thumbnail aspect ratio for very long or very wide images (boolean)"
     thumbnail_sharpen = "Whether to apply a sharpen operation to thumbnails (boolean)"
     thumbnail_liquid_cutin_ratio = "If applying a distorted resize, what cutin ratio to use for a liquid rescale (real)"
+    thumbnail_liquid_working_multiple = "Liquid rescale works on a copy reduced to this multiple of the thumbnail size (real)"
+    thumbnail_liquid_time_budget = "Seconds a liquid rescale may take before falling back to a plain resize, 0 = unlimited (real)"
+    thumbnail_liquid_max_carves = "Most liquid rescales, including those past their time budget, carving at once in a process (integer)"
+    thumbnail_use_embedded_preview = "Whether to make small thumbnails from the preview embedded in a JPEG's EXIF data (boolean)"
+    thumbnail_preview_aspect_tolerance = "Greatest relative difference between preview and image aspect ratios for a preview to be used (real)"
+    resample_default_quality = "Resampling tier used when a request does not name one, one of 'fast', 'balanced', 'best' (string)"
+    size_ladder = "Rungs, in pixels, that requested resize dimensions are raised to, empty = no snapping (list)"
+    size_ladder_exact = "Whether to deliver the requested size, resized from the image at the snapped rung (boolean)"
+    derivation_backend_default = "Engine used to derive images, one of 'wand', 'numpy' (string)"
+    derivation_backends = "Per operation and format engine overrides, eg { thumbnail : { jpg : numpy, '*' : wand } } (dict)"
     
     cannonical_format_used = "Whether to convert images to a standard intermediate format (boolean)"
     cannonical_format = "If converting to a cannonical format, what format to use (string)"
+    strip_lossless = "Whether to strip metadata from JPEG, PNG and TIFF images without decoding them (boolean)"
+    strip_keep_icc_profile = "Whether to keep ICC colour profiles when stripping metadata without decoding (boolean)"
+    jpeg_lossless_transforms = "Whether to crop, rotate and flip JPEG images without re-encoding them where possible (boolean)"
+    jpeg_lossless_crop_snap = "Whether a lossless JPEG crop may move the region corner up and left to the iMCU grid (boolean)"
+    jpegtran_path = "Path to the jpegtran executable used for lossless JPEG transforms (string)"
     
     def __init__(self, config_file):
         self.create_new = False
         self.owner = None
         self.repository_base_pathname = "images"        
+        self.iiif_base_pathname = "iiif"
+        self.sprite_base_pathname = "sprites"
+        self.sprite_background = "white"
+        self.sprite_columns = 10
+        self.sprite_max_images = 1000
+        self.sprite_workers = 4
         self.local_file_cache_path = "/var/tmp/image_repo"
         self.pid_file = "/var/tmp/image_repo_pid"
         self.memory_cache_configuration = CacheConfig(None)    # If we use a slab of memory to cache some images, base and derived
+        self.shared_memory_cache_configuration = SharedMemoryCacheConfig(None)    # If worker processes share encoded images
         self.local_cache_configuration = LocalFileCacheConfig(None)    # If we use a local file system to cache some images, base and derived
+        self.decoded_cache_configuration = DecodedCacheConfig(None)    # If we keep decoded base images as memory mapped pixel caches
         self.swift_cache_configuration = SwiftCacheConfig(None)    # If we cache some derived images to avoid regeneration
         self.persistent_store_configuration = SwiftStoreConfig(None)
+        self.resource_limits_configuration = ResourceLimitsConfig(None)
+        self.placeholder_configuration = PlaceholderConfig(None)
+        self.tile_configuration = TileConfig(None)
+        self.negative_cache_configuration = NegativeCacheConfig(None)
+        self.promotion_configuration = PromotionConfig(None)
+        self.peer_configuration = PeerConfig(None)
         self.max_size = 0
         self.max_images = 0
         self.alarm_threshold = 0.8
@@ -490,10 +841,28 @@ class Configuration(BaseConfig):
         self.thumbnail_liquid_resize = True
         self.thumbnail_sharpen = True
         self.thumbnail_liquid_cutin_ratio = 5.0
+        self.thumbnail_liquid_working_multiple = 3.0
+        self.thumbnail_liquid_time_budget = 2.0
+        self.thumbnail_liquid_max_carves = 2
+        self.thumbnail_use_embedded_preview = False
+        self.thumbnail_preview_aspect_tolerance = 0.02
+        self.resample_default_quality = 'best'
+        self.size_ladder = []
+        self.size_ladder_exact = False
+        self.derivation_backend_default = 'wand'
+        self.derivation_backends = {}
         
         self.cannonical_format_used = False
         self.cannonical_format = "miff"
+        self.strip_lossless = True
+        self.strip_keep_icc_profile = False
+        self.jpeg_lossless_transforms = True
+        self.jpeg_lossless_crop_snap = False
+        self.jpegtran_path = "jpegtran"
         self.image_default_format = 'jpg'
+        self.negotiation_formats = ['avif', 'jxl', 'webp']
+        self.client_hints = True
+        self.client_hint_max_dpr = 3.0
         
         config = None
         if config_file is not None:
@@ -595,6 +964,7 @@ class ImageRepository:
         parser.add_argument('-l', '--log_file',                          help = 'Log file. If not specified output goes to standard output')
         parser.add_argument('-c', '--config_log_file',                   help = 'Logging configuration file. Python logger format.')
         parser.add_argument('-i', '--intolerant', action = 'store_true', help = 'Exit on error.')
+        parser.add_argument('-b', '--benchmark',                         help = 'Compare the derivation backends on the images in this directory, logging the results at INFO level (use with -v), and exit.')
 
         control_group = parser.add_mutually_exclusive_group()        
         control_group.add_argument('-R', '--restart',    action = 'store_true', help = 'Restart any existing server process')
@@ -770,6 +1140,7 @@ class ImageRepository:
             ImageNames.ImageName.set_configuration(config)
             ImageType.ImageHandle.set_configuration(config)
             ImageType.ImageInstance.set_configuration(config)
+            Resources.apply_limits(config.resource_limits_configuration)
             
             error = Errors(0 if args.intolerant else 20, RepositoryError)
             signals = SignalHandler()
@@ -778,6 +1149,10 @@ class ImageRepository:
                 self._logger.info("Trial run. Only checking configuration")
                 exit(os.EX_OK)
 
+            if args.benchmark is not None:
+                Backends.benchmark(config, args.benchmark)
+                exit(os.EX_OK)
+
             if args.restart or args.stop:
                 # Find the running server and signal it to restart or stop
                 try:
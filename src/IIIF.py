@@ -0,0 +1,196 @@
+"""
+IIIF Image API
+--------------
+
+Translation of IIIF Image API 3.0 requests into image names.
+
+A request ``{identifier}/{region}/{size}/{rotation}/{quality}.{format}`` becomes the name of a derived image, with a
+``crop`` for the region, a ``scale`` for the size and a ``rotate`` for the rotation, so that IIIF requests are
+served, and cached, exactly as any other derived image.  Parameters that leave the image unchanged add no
+operation, so that equivalent requests share one name and one cache entry.
+
+The region is cropped first, so that lossless JPEG cropping means only the region is ever decoded.
+
+Sizes are computed here, and the region scaled to exactly that size, so ``w,h`` sizes with an aspect ratio other
+than that of the region distort it, as the specification requires.
+"""
+
+import math
+import logging
+
+from ImageNames import ImageName
+from Exceptions import RepositoryFailure
+
+logger = logging.getLogger("image_repository")
+
+qualities = ("default", "color")
+formats = ("jpg", "png", "tif")
+features = ["baseUriRedirect", "cors", "jsonldMediaType", "mirroring", "profileLinkHeader",
+            "regionByPct", "regionByPx", "regionSquare", "rotationArbitrary", "rotationBy90s",
+            "sizeByConfinedWh", "sizeByH", "sizeByPct", "sizeByW", "sizeByWh", "sizeUpscaling"]
+
+
+def _numbers(text, convert, count):
+    try:
+        values = [convert(value) for value in text.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != count:
+        raise RepositoryFailure("Malformed IIIF parameter {}".format(text), 400)
+    return values
+
+
+def region(text, width, height):
+    """The pixel region of the image selected by a IIIF region parameter
+
+    :param text: The region parameter
+    :type text: string
+    :param width: Width of the image
+    :type width: integer
+    :param height: Height of the image
+    :type height: integer
+    :rtype: tuple (x, y, w, h), or None for the full image
+    :raises: RepositoryFailure
+    """
+    if text == "full":
+        return None
+    if text == "square":
+        side = min(width, height)
+        x, y, w, h = (width - side) // 2, (height - side) // 2, side, side
+    elif text.startswith("pct:"):
+        x, y, w, h = _numbers(text[4:], float, 4)
+        if min(x, y) < 0 or min(w, h) <= 0:
+            raise RepositoryFailure("Invalid IIIF region {}".format(text), 400)
+        x, y = int(round(x * width / 100.0)), int(round(y * height / 100.0))
+        w, h = int(round(w * width / 100.0)), int(round(h * height / 100.0))
+    else:
+        x, y, w, h = _numbers(text, int, 4)
+    if x < 0 or y < 0 or w <= 0 or h <= 0 or x >= width or y >= height:
+        raise RepositoryFailure("IIIF region {} lies outside the image".format(text), 400)
+    w, h = min(w, width - x), min(h, height - y)
+    if (x, y, w, h) == (0, 0, width, height):
+        return None
+    return x, y, w, h
+
+
+def size(text, width, height):
+    """The dimensions selected by a IIIF size parameter for a region of the given dimensions
+
+    :param text: The size parameter
+    :type text: string
+    :param width: Width of the region
+    :type width: integer
+    :param height: Height of the region
+    :type height: integer
+    :rtype: tuple (w, h)
+    :raises: RepositoryFailure
+    """
+    upscale = text.startswith("^")
+    if upscale:
+        text = text[1:]
+    if text == "max":
+        w, h = width, height
+    elif text.startswith("pct:"):
+        scale = _numbers(text[4:], float, 1)[0] / 100.0
+        if scale <= 0:
+            raise RepositoryFailure("Invalid IIIF size {}".format(text), 400)
+        w, h = int(round(width * scale)), int(round(height * scale))
+    else:
+        confined = text.startswith("!")
+        if confined:
+            text = text[1:]
+        try:
+            w_text, h_text = text.split(",")
+            w = int(w_text) if w_text != "" else None
+            h = int(h_text) if h_text != "" else None
+        except ValueError:
+            raise RepositoryFailure("Malformed IIIF size {}".format(text), 400)
+        if (w is None and h is None) or (confined and (w is None or h is None)):
+            raise RepositoryFailure("Malformed IIIF size {}".format(text), 400)
+        if w is None:
+            w = int(round(width * float(h) / height))
+        elif h is None:
+            h = int(round(height * float(w) / width))
+        elif confined:
+            scale = min(float(w) / width, float(h) / height)
+            w, h = int(round(width * scale)), int(round(height * scale))
+    w, h = max(1, w), max(1, h)
+    if not upscale and (w > width or h > height):
+        raise RepositoryFailure("IIIF size {} enlarges the image without ^".format(text), 400)
+    return w, h
+
+
+def rotation(text):
+    """The rotation selected by a IIIF rotation parameter
+
+    :rtype: tuple (degrees, mirror)
+    :raises: RepositoryFailure
+    """
+    mirror = text.startswith("!")
+    if mirror:
+        text = text[1:]
+    try:
+        degrees = float(text)
+    except ValueError:
+        raise RepositoryFailure("Malformed IIIF rotation {}".format(text), 400)
+    if degrees < 0 or degrees > 360:
+        raise RepositoryFailure("IIIF rotation {} out of range".format(text), 400)
+    return degrees % 360, mirror
+
+
+def image_name(base_name, header, region_text, size_text, rotation_text, quality, kind):
+    """The name of the derived image a IIIF image request asks for
+
+    :param base_name: Base name of the image
+    :type base_name: string
+    :param header: Header of the original image, giving its dimensions
+    :type header: ImageHeaders.ImageHeader
+    :rtype: ImageName
+    :raises: RepositoryFailure
+    """
+    if quality not in qualities:
+        raise RepositoryFailure("IIIF quality {} is not supported".format(quality), 400)
+    if kind not in formats:
+        raise RepositoryFailure("IIIF format {} is not supported".format(kind), 400)
+    name = ImageName(base_name, kind = kind)
+    the_region = region(region_text, header.width, header.height)
+    width, height = header.width, header.height
+    if the_region is not None:
+        x, y, width, height = the_region
+        name = name.apply_crop((width, height), (x, y))
+    the_size = size(size_text, width, height)
+    if the_size != (width, height):
+        name = name.apply_scale(the_size)
+    degrees, mirror = rotation(rotation_text)
+    if degrees != 0 or mirror:
+        name = name.apply_rotate(degrees, mirror)
+    return name
+
+
+def info(identifier, base_url, header, tile_size):
+    """The ``info.json`` document describing an image
+
+    :param identifier: The IIIF identifier of the image
+    :type identifier: string
+    :param base_url: URL of the IIIF service, to which the identifier is appended
+    :type base_url: string
+    :param header: Header of the original image, giving its dimensions
+    :type header: ImageHeaders.ImageHeader
+    :param tile_size: Suggested width and height of tiles
+    :type tile_size: integer
+    :rtype: dict
+    """
+    levels = int(math.ceil(math.log(max(header.width, header.height, tile_size) / float(tile_size), 2)))
+    return {
+        "@context" : "http://iiif.io/api/image/3/context.json",
+        "id" : "{}/{}".format(base_url.rstrip("/"), identifier),
+        "type" : "ImageService3",
+        "protocol" : "http://iiif.io/api/image",
+        "profile" : "level1",
+        "width" : header.width,
+        "height" : header.height,
+        "tiles" : [{"width" : tile_size, "height" : tile_size, "scaleFactors" : [2 ** level for level in range(levels + 1)]}],
+        "extraQualities" : ["color"],
+        "extraFormats" : [kind for kind in formats if kind != "jpg"],
+        "extraFeatures" : features,
+    }
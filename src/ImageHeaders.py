@@ -0,0 +1,290 @@
+"""
+Image Headers
+-------------
+
+Cheap inspection of encoded images without decoding them.
+
+ImageMagick must decode an image in full before it can tell us anything about it.  For the common container
+formats the dimensions are available in the first few hundred bytes of the file, and reading them directly allows
+decisions (resource limits, which derivation path to take) to be made before any pixel data is touched.
+
+Probing never raises for malformed or unsupported data, it simply returns None and the caller falls back to Wand.
+"""
+
+import struct
+import cStringIO
+import logging
+
+logger = logging.getLogger("image_repository")
+
+
+class ImageHeader(object):
+    """The facts about an image that can be read from its header
+
+    * kind = Wand format string for the container (``JPEG``, ``PNG``, ``GIF``, ``BMP``, ``TIFF``)
+    * width, height = dimensions of the (first) frame in pixels
+    """
+
+    def __init__(self, kind, width, height):
+        self.kind = kind
+        self.width = width
+        self.height = height
+
+    def pixels(self):
+        """Number of pixels in the image
+
+        :rtype: integer
+        """
+        return self.width * self.height
+
+    def __str__(self):
+        return "{} {} x {}".format(self.kind, self.width, self.height)
+
+
+# JPEG start of frame markers.  C4 (DHT), C8 (JPG) and CC (DAC) share the range but are not frames.
+jpeg_sof_markers = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def _probe_jpeg(stream):
+    stream.seek(2)
+    while True:
+        byte = stream.read(1)
+        while byte and byte != '\xff':
+            byte = stream.read(1)
+        while byte == '\xff':       # Markers may be padded with any number of fill bytes
+            byte = stream.read(1)
+        if not byte:
+            return None
+        marker = ord(byte)
+        if marker == 0xD9 or marker == 0xDA:   # EOI or SOS before any frame header
+            return None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # Stand alone markers carry no length
+            continue
+        length_bytes = stream.read(2)
+        if len(length_bytes) != 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0]
+        if marker in jpeg_sof_markers:
+            frame = stream.read(5)
+            if len(frame) != 5:
+                return None
+            precision, height, width = struct.unpack(">BHH", frame)
+            return ImageHeader("JPEG", width, height)
+        stream.seek(length - 2, 1)
+
+
+def _probe_png(stream):
+    stream.seek(8)
+    chunk = stream.read(16)
+    if len(chunk) != 16 or chunk[4:8] != 'IHDR':
+        return None
+    width, height = struct.unpack(">II", chunk[8:16])
+    return ImageHeader("PNG", width, height)
+
+
+def _probe_gif(stream):
+    stream.seek(6)
+    screen = stream.read(4)
+    if len(screen) != 4:
+        return None
+    width, height = struct.unpack("<HH", screen)
+    return ImageHeader("GIF", width, height)
+
+
+def _probe_bmp(stream):
+    stream.seek(14)
+    info = stream.read(12)
+    if len(info) != 12:
+        return None
+    header_size = struct.unpack("<I", info[:4])[0]
+    if header_size == 12:      # OS/2 BITMAPCOREHEADER
+        width, height = struct.unpack("<HH", info[4:8])
+    else:
+        width, height = struct.unpack("<ii", info[4:12])
+    return ImageHeader("BMP", abs(width), abs(height))
+
+
+def _probe_tiff(stream):
+    stream.seek(0)
+    header = stream.read(8)
+    if len(header) != 8:
+        return None
+    endian = "<" if header[:2] == "II" else ">"
+    offset = struct.unpack(endian + "I", header[4:8])[0]
+    stream.seek(offset)
+    count_bytes = stream.read(2)
+    if len(count_bytes) != 2:
+        return None
+    count = struct.unpack(endian + "H", count_bytes)[0]
+    width = None
+    height = None
+    for _ in range(count):
+        entry = stream.read(12)
+        if len(entry) != 12:
+            return None
+        tag, field_type = struct.unpack(endian + "HH", entry[:4])
+        if field_type == 3:      # SHORT
+            value = struct.unpack(endian + "H", entry[8:10])[0]
+        else:                    # LONG
+            value = struct.unpack(endian + "I", entry[8:12])[0]
+        if tag == 256:
+            width = value
+        elif tag == 257:
+            height = value
+        if width is not None and height is not None:
+            return ImageHeader("TIFF", width, height)
+    return None
+
+
+_signatures = (
+    ('\xff\xd8', _probe_jpeg),
+    ('\x89PNG\r\n\x1a\n', _probe_png),
+    ('GIF87a', _probe_gif),
+    ('GIF89a', _probe_gif),
+    ('BM', _probe_bmp),
+    ('II*\x00', _probe_tiff),
+    ('MM\x00*', _probe_tiff),
+)
+
+
+def probe_stream(stream):
+    """Read the header of an image held in a seekable file-like object
+
+    The stream position is restored before returning.
+
+    :param stream: The encoded image
+    :type stream: seekable file-like object
+    :rtype: ImageHeader or None
+    """
+    try:
+        position = stream.tell()
+    except (AttributeError, IOError):
+        return None
+    try:
+        stream.seek(0)
+        magic = stream.read(8)
+        for signature, probe in _signatures:
+            if magic.startswith(signature):
+                return probe(stream)
+        return None
+    except (IOError, struct.error, ValueError) as ex:
+        logger.debug("Image header probe fails: {}".format(ex))
+        return None
+    finally:
+        stream.seek(position)
+
+
+def probe_bytes(the_bytes):
+    """Read the header of an image held as a blob of bytes
+
+    :param the_bytes: The encoded image
+    :type the_bytes: bytes
+    :rtype: ImageHeader or None
+    """
+    return probe_stream(cStringIO.StringIO(the_bytes))
+
+
+def _exif_segment(the_bytes):
+    """Return the TIFF structure held in the EXIF APP1 segment of a JPEG image
+
+    :rtype: bytes or None
+    """
+    position = 2
+    while position + 4 <= len(the_bytes):
+        if the_bytes[position] != '\xff':
+            return None
+        marker = ord(the_bytes[position + 1])
+        if marker == 0xFF:        # Fill byte
+            position += 1
+            continue
+        if marker in (0xD9, 0xDA) or marker in jpeg_sof_markers:   # Metadata always precedes the frame
+            return None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            position += 2
+            continue
+        length = struct.unpack(">H", the_bytes[position+2:position+4])[0]
+        if marker == 0xE1 and the_bytes[position+4:position+10] == "Exif\x00\x00":
+            return the_bytes[position+10:position+2+length]
+        position += 2 + length
+    return None
+
+
+def exif_thumbnail(the_bytes):
+    """Extract the JPEG preview embedded in the EXIF data of a JPEG image, without decoding either image
+
+    Most cameras embed a preview of about 160 x 120 pixels in the second IFD of the EXIF data.
+
+    :param the_bytes: The encoded image
+    :type the_bytes: bytes
+    :rtype: bytes or None
+    """
+    if the_bytes is None or not the_bytes.startswith('\xff\xd8'):
+        return None
+    try:
+        tiff = _exif_segment(the_bytes)
+        if tiff is None or tiff[:2] not in ("II", "MM"):
+            return None
+        endian = "<" if tiff[:2] == "II" else ">"
+        ifd0 = struct.unpack(endian + "I", tiff[4:8])[0]
+        count = struct.unpack(endian + "H", tiff[ifd0:ifd0+2])[0]
+        ifd1 = struct.unpack(endian + "I", tiff[ifd0+2+12*count:ifd0+6+12*count])[0]
+        if ifd1 == 0:
+            return None
+        count = struct.unpack(endian + "H", tiff[ifd1:ifd1+2])[0]
+        offset = None
+        length = None
+        for index in range(count):
+            entry = tiff[ifd1+2+12*index:ifd1+14+12*index]
+            tag = struct.unpack(endian + "H", entry[:2])[0]
+            if tag == 513:       # JPEGInterchangeFormat
+                offset = struct.unpack(endian + "I", entry[8:12])[0]
+            elif tag == 514:     # JPEGInterchangeFormatLength
+                length = struct.unpack(endian + "I", entry[8:12])[0]
+        if offset is None or not length or offset + length > len(tiff):
+            return None
+        preview = tiff[offset:offset+length]
+        return preview if preview.startswith('\xff\xd8') else None
+    except struct.error as ex:
+        logger.debug("EXIF thumbnail extraction fails: {}".format(ex))
+        return None
+
+
+def exif_orientation(the_bytes):
+    """Read the EXIF Orientation of a JPEG image, without decoding it
+
+    :param the_bytes: The encoded image
+    :type the_bytes: bytes
+    :rtype: integer, 1 to 8, or None if the image records no orientation
+    """
+    if the_bytes is None or not the_bytes.startswith('\xff\xd8'):
+        return None
+    try:
+        tiff = _exif_segment(the_bytes)
+        if tiff is None or tiff[:2] not in ("II", "MM"):
+            return None
+        endian = "<" if tiff[:2] == "II" else ">"
+        ifd0 = struct.unpack(endian + "I", tiff[4:8])[0]
+        count = struct.unpack(endian + "H", tiff[ifd0:ifd0+2])[0]
+        for index in range(count):
+            entry = tiff[ifd0+2+12*index:ifd0+14+12*index]
+            if struct.unpack(endian + "H", entry[:2])[0] == 274:     # Orientation
+                return struct.unpack(endian + "H", entry[8:10])[0]
+        return None
+    except struct.error as ex:
+        logger.debug("EXIF orientation extraction fails: {}".format(ex))
+        return None
+
+
+def probe_file(path):
+    """Read the header of an image held in a local file
+
+    :param path: Path to the encoded image
+    :type path: string
+    :rtype: ImageHeader or None
+    """
+    try:
+        with open(path, 'rb') as the_file:
+            return probe_stream(the_file)
+    except IOError:
+        logger.debug("Image header probe unable to open {}".format(path))
+        return None
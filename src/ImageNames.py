@@ -13,6 +13,8 @@ an image with that name, it can be guarenteed to be the image needed.
 
 import re
 import os
+import sys
+import time
 import urllib
 import logging
 from Exceptions import RepositoryError
@@ -20,7 +22,52 @@ from Exceptions import RepositoryFailure
 
 logger = logging.getLogger("image_repository")
 
-class ImageName:
+# Resampling tiers, cheapest first.  ``best`` is the historical behaviour and is never written into names,
+# so names created before tiers existed remain valid cache keys.
+resample_qualities = ("fast", "balanced", "best")
+
+# Alternative spellings of image formats, folded to the name used in image names
+format_aliases = {"jpeg" : "jpg", "jpe" : "jpg", "jfif" : "jpg", "tiff" : "tif"}
+
+
+def normalised_kind(kind):
+    """The spelling of an image format used in image names
+
+    :param kind: An image format, in any case and spelling
+    :type kind: string or None
+    :rtype: string or None
+    """
+    if kind is None:
+        return None
+    kind = kind.lower()
+    return format_aliases.get(kind, kind)
+
+
+def is_original_name(name):
+    """Whether a name is that of an original image, found without parsing the name
+
+    :param name: An image name
+    :type name: string
+    :rtype: boolean
+    """
+    return "+original(" in name and "+convert(" not in name and "+metadata(" not in name
+
+
+def is_thumbnail_name(name):
+    """Whether a name is that of a thumbnail, found without parsing the name
+
+    :param name: An image name
+    :type name: string
+    :rtype: boolean
+    """
+    return "+thumbnail(" in name
+
+
+# A derivation operation, ``operation(parameters)``
+_operation = re.compile(r"\A([^(]*)\(([^(]*)\Z")
+
+
+class ImageName(object):
     """
     Encapsulates the name an individual image will have in whatever file repository is used.
 
@@ -46,7 +93,7 @@ class ImageName:
     * Optional derivation operations
 
         -    Plus ``+``
-        -    operation: one of ``crop``, ``size``, ``thumbnail``, ``convert``, ``clone``, ``original``, ``metadata``
+        -    operation: one of ``crop``, ``size``, ``scale``, ``rotate``, ``thumbnail``, ``convert``, ``clone``, ``original``, ``metadata``
         -    open parenthesis ``(``
         -    parameters - comma separated list
         -   close parenthesis ``)``
@@ -54,8 +101,18 @@ class ImageName:
     * dot ``.``
     * image format
 
-    In principle multiple operations may be cascaded, although currently this feature isn't used by the
-    client classes.  Mathematical purity would suggest that the apppication of image derivation steps is
+    The ``size`` and ``thumbnail`` operations take an optional trailing resampling tier parameter, one of
+    ``fast`` or ``balanced``.  When absent the tier is ``best``.  Each tier is a distinct image and so has a
+    distinct name, and thus a distinct cache entry.
+
+    The ``size`` operation fits the image within a box, keeping its aspect ratio, while the ``scale`` operation
+    scales it to exactly the size given, distorting it if need be.  ``scale`` takes the same optional tier.
+
+    The ``rotate`` operation takes the clockwise rotation in degrees, and an optional trailing ``m`` when the image
+    is mirrored left to right before it is rotated.
+
+    Multiple ``crop``, ``size``, ``scale``, ``rotate`` and ``convert`` operations may be cascaded, and are applied in the order
+    they appear.  Other operations are not cascaded by the client classes.  Mathematical purity would suggest that the apppication of image derivation steps is
     done in a heirarchical manner, of function applied to function application, but currently they are simply 
     appended.
 
@@ -66,26 +123,70 @@ class ImageName:
     potential problems with aliasing of images whilst derivation steps occur.
 
     The ``metadata`` operator does not yield an image
+
+    Names are immutable.  Derivation methods, ``apply_*``, return a new name and leave the name they are applied
+    to unchanged, so names may be shared freely and their string representation and hash are made only once.
     """
 
-    #    regexp = re.parse("")
+    __slots__ = ("_base_name", "_image_kind", "_operations", "_clone", "_original_name", "_image_name",
+                 "_is_base", "_is_derived", "_is_original", "_is_thumbnail", "_is_resize", "_is_convert",
+                 "_is_crop", "_is_scale", "_is_rotate", "_is_metadata", "_liquid", "_equalise", "_sharpen", "_quality",
+                 "_image_size", "_size", "_crop_size", "_crop_origin", "_string", "_hash")
 
     _configuration = None
-    
+
+    # Interned names parsed from strings, by (name, kind), in two generations.  Names are found in either, and
+    # when the current generation fills it replaces the previous one, so the least recently used names are dropped.
+    _interned = {}
+    _interned_previous = {}
+    _interned_limit = 10000
+
     @classmethod
     def set_configuration(cls, config):
         cls._configuration = config
 
+    def __new__(cls, image_name = None, kind = None):
+        """Names are immutable, so a name already parsed from the same string is returned rather than a new one
+        """
+        if isinstance(image_name, ImageName):
+            if kind is None or kind == image_name._image_kind:
+                return image_name
+            return image_name.set_kind(kind)
+        key = (image_name, kind)
+        interned = cls._interned.get(key)
+        if interned is None:
+            interned = cls._interned_previous.get(key)
+            if interned is not None:
+                cls._interned[key] = interned
+        if interned is not None:
+            return interned
+        return super(ImageName, cls).__new__(cls)
     
     def __init__(self, image_name, kind = None):
         """
         Create a new image name.
         :param image_name: Name from which the ImageName is created
-        :type image_name: string
+        :type image_name: string or ImageName
         :param kind: An ImageMagic format string that represents the format of the image
         :type kind: string or None
         """
+        if hasattr(self, "_string"):
+            return    # An interned or derived name, already complete
+
+        self._reset(image_name, kind)
+        # parse the image name down to its constituents and fill in the operations
+        if image_name is not None:
+            try:
+                self._parse_name(image_name, kind)
+            except Exception as ex:
+                print "Failure in image name parse of {}".format(image_name)
+                print ex            
+        if len(ImageName._interned) >= self._interned_limit:
+            ImageName._interned_previous = ImageName._interned
+            ImageName._interned = {}
+        ImageName._interned[(image_name, kind)] = self
 
+    def _reset(self, image_name, kind):
         self._is_thumbnail = False
         self._is_derived = False
         self._is_base = False
@@ -97,23 +198,44 @@ class ImageName:
         self._is_metadata = False
         self._is_resize = False
         self._is_convert = False
+        self._is_crop = False
+        self._is_scale = False
+        self._is_rotate = False
+        self._quality = "best"
         
         self._base_name = None
         self._original_name = None
         self._image_kind = kind
         self._image_size = (None, None)
-        self._operations = []
+        self._size = None
+        self._crop_size = None
+        self._crop_origin = None
+        self._operations = ()
 
         self._image_name = image_name
-        
-        # parse the image name down to its constituents and fill in the operations
-        if image_name is not None:
-            try:
-                self._parse_name(image_name, kind)
-            except Exception as ex:
-                print "Failure in image name parse of {}".format(image_name)
-                print ex            
+        self._string = None
+        self._hash = None
+
+    def _copy(self, other):
+        for slot in ImageName.__slots__:
+            setattr(self, slot, getattr(other, slot))
 
+    def _derive(self, operation = None, **changes):
+        """A new name holding the state of this name, with the given changes and an added derivation operation
+
+        :rtype: ImageName
+        """
+        new_name = object.__new__(ImageName)
+        new_name._copy(self)
+        new_name._clone = False
+        for slot, value in changes.iteritems():
+            setattr(new_name, slot, value)
+        if operation is not None:
+            new_name._operations = self._operations + (operation,)
+        new_name._image_name = None
+        new_name._string = None
+        new_name._hash = None
+        return new_name
 
     @classmethod
     def from_raw(cls, raw_name):
@@ -187,20 +309,11 @@ class ImageName:
         generated and allows derivation step to be added.
         """
         if kind is None:
-            try:
-                head, ext = os.path.splitext(image_name)
-                kind = ext[1:]
-            except ValueError:
-                head = image_name
-                kind = None
+            head, ext = os.path.splitext(image_name)
+            kind = ext[1:]
         else:
             head = image_name
-            kind = kind
-        try:
-            components = re.split("\+", head)
-        except TypeError:
-            components = [head]
-            self._is_base = True
+        components = head.split("+")
         self._base_name = components[0]
         self._image_kind = kind
 
@@ -210,13 +323,14 @@ class ImageName:
         if len(components) <= 1:
             return
 
+        operations = []
         for op in components[1:]:
             self._is_base = False
-            try:
-                operation, parameters = re.split("\(",op)
-            except ValueError:
+            match = _operation.match(op)
+            if match is None:
                 print "failure in splitting operation at - {}".format(op)
                 continue
+            operation, parameters = match.group(1), match.group(2)[:-1]
             if operation == "clone":
                 self._clone = True
                 continue    # Prevent the clone operation going into the _operations list
@@ -225,32 +339,47 @@ class ImageName:
                 self._is_derived = False
                 self._is_base = False
                 # We must not let any meta characters sneak into the final name - in particular underscores or periods
-                encoded = urllib.quote(parameters[:-1], safe = "")
-                self._original_name = encoded
+                self._original_name = urllib.quote(parameters, safe = "")
             elif operation == "size":
-                self._is_base = False
                 self._is_derived = True
                 self._is_resize = True
-                x_size, y_size = re.split(",", parameters[:-1])  # Need to convert to int
+                size_parameters = parameters.split(",")
+                x_size, y_size = _integer(size_parameters[0]), _integer(size_parameters[1])
+                if len(size_parameters) > 2:
+                    self._quality = size_parameters[2]
             elif operation == "crop":
-                self._is_base = False
                 self._is_derived = True
-                x_size, y_size, x_offset, y_offset = re.split(",", parameters[:-1])
+                self._is_crop = True
+                x_size, y_size, x_offset, y_offset = [_integer(value) for value in parameters.split(",")]
+                self._crop_size = (x_size, y_size)
+                self._crop_origin = (x_offset, y_offset)
+            elif operation == "scale":
+                self._is_derived = True
+                self._is_scale = True
+                scale_parameters = parameters.split(",")
+                x_size, y_size = _integer(scale_parameters[0]), _integer(scale_parameters[1])
+                if len(scale_parameters) > 2:
+                    self._quality = scale_parameters[2]
+            elif operation == "rotate":
+                self._is_derived = True
+                self._is_rotate = True
             elif operation == "thumbnail":
-                self._is_base = False
                 self._is_derived = True
-                self._thumbnail = True
-                x_size, y_size, options = re.split(",", parameters[:-1])  # Need to convert to int
+                self._is_thumbnail = True
+                thumbnail_parameters = parameters.split(",")
+                x_size, y_size, options = thumbnail_parameters[:3]
+                x_size, y_size = _integer(x_size), _integer(y_size)
+                self._size = (x_size, y_size)
+                if len(thumbnail_parameters) > 3:
+                    self._quality = thumbnail_parameters[3]
                 self._liquid = "l" in options
                 self._equalise = "e" in options
                 self._sharpen = "s" in options
             elif operation == "convert":
-                self._is_base = False #  Maybe  can be overridden
                 self._is_derived = True
                 self._is_original = False
                 self._is_convert = True
             elif operation == "metadata":
-                self._is_base = False #  Maybe  can be overridden
                 self._is_derived = True
                 self._is_original = False
                 self._is_metadata = True
@@ -258,36 +387,31 @@ class ImageName:
             else:
                 print("Unknown operation {} in imagename {}".format(operation, image_name))
                 continue
-            self._operations.append(op)
+            operations.append(op)
 
+        self._operations = tuple(operations)
         self._image_size = (x_size, y_size)
             
     def rename(self, name):
-        """Change the entire name represented by this ImageName object.
+        """Return the name represented by another string, names are immutable.
 
         :param name: The base name to redefine the ImageName from.
         :type name: string
+        :rtype: ImageName
         """
-        self._parse_name(name)
+        return ImageName(name)
             
     def clone(self, kind = None):
         """Return a new ImageName instance that has the current state of this name as its initial name.
 
         :rtype: ImageName
 
-        We add a check component to cloned names to avoid some possible nasty outcomes.  String representations
-        of ImageNames are used to key dictionaries (typically caches) throughout the repository.  A cloned ImageName
-        is intentded to be the halfway point in creating a derived image name.  But if a string representation of a
-        cloned ImageName is used to add an entry to a dictornary prior to performing the needed dreivation steps
-        it may result in a conflict.  We add an ephemeral `clone` operation to the new ImageName that will automatically
-        vanish again once any derivation step is performed.
+        A cloned name carries an ephemeral ``clone`` operation, so that its string representation, which keys
+        dictionaries (typically caches) throughout the repository, never matches that of a real image.  The
+        operation vanishes again once any derivation step is applied.  As names are immutable, deriving from the
+        name itself is as safe, and cloning is rarely needed.
         """
-        the_string = "{}".format(self._base_name)
-        the_string += "+clone()"
-        for op in self._operations:
-            the_string += "+{}".format(op)
-            
-        return ImageName(the_string, kind if kind is not None else self._image_kind)
+        return self._derive(_clone = True, _image_kind = kind if kind is not None else self._image_kind)
 
 
     def is_cannonical_name(self):
@@ -335,7 +459,11 @@ class ImageName:
         return self._is_original
 
     def set_original(self, original):
-        self._is_original = original
+        """Return this name marked, or not, as the name of an original image
+
+        :rtype: ImageName
+        """
+        return self._derive(_is_original = original, _clone = self._clone)
 
     def is_base(self):
         """Determine if the name represents a base image
@@ -365,6 +493,23 @@ class ImageName:
         """
         return self._is_resize
     
+    def is_crop(self):
+        """
+        """
+        return self._is_crop
+
+    def is_scale(self):
+        """Determine if the name represents an image scaled to an exact size
+
+        :rtype: Boolean
+        """
+        return self._is_scale
+
+    def is_rotate(self):
+        """
+        """
+        return self._is_rotate
+
     def is_convert(self):
         """Determine if the name represents a resized image
 
@@ -374,6 +519,34 @@ class ImageName:
 
     def is_metadata(self):
         return self._is_metadata
+
+    def quality(self):
+        """Return the resampling tier used by any resize or thumbnail operation in the name
+
+        :rtype: string, one of ``resample_qualities``
+        """
+        return self._quality
+
+    def _resolve_quality(self, quality):
+        """Resolve a requested resampling tier against the configured default
+
+        :param quality: The requested tier, or None for the configured default
+        :type quality: string or None
+        :rtype: string
+        :raises: RepositoryFailure
+        """
+        if quality is None:
+            quality = self._configuration.resample_default_quality
+        quality = quality.lower()
+        if quality not in resample_qualities:
+            raise RepositoryFailure("Unknown resampling quality {}".format(quality), 400)
+        return quality
+
+    @staticmethod
+    def _quality_suffix(quality):
+        """The name encoding of a resampling tier.  The ``best`` tier is implicit.
+        """
+        return "" if quality == "best" else ",{}".format(quality)
     
     def size(self):
         """
@@ -386,30 +559,26 @@ class ImageName:
         return self._image_kind
 
     def set_kind(self, kind):
-        """Set the format of the image.
+        """Return this name with another image format.
 
+        :rtype: ImageName
         """
-        self._image_kind = kind
-        self._image_name = str(self)
+        return self._derive(_image_kind = kind, _clone = self._clone)
         
     def make_original(self, name = None):
-        """The name behaves as original image.
+        """Return the name as that of an original image.
 
         Any derivation steps are removed, and the image behaves as an original image.
 
         :param name: An optional name that overwrites the current name.
         :type name: string or None
-        
+        :rtype: ImageName
         """
-        self._clone = False
-        self._operations = []
-        self._is_original = True
-        if name is not None:
-            self._original_name = name
-        self._image_name = str(self)
+        return self._derive(_operations = (), _is_original = True,
+                            _original_name = name if name is not None else self._original_name)
     
     def apply_thumbnail(self, size = None, kind = None, **kwargs ):
-        """Apply the thumbnail creation operation to the image name
+        """Return the name with the thumbnail creation operation applied
 
         If not specified, parameters are taken from the system configuration defaults.
 
@@ -420,18 +589,14 @@ class ImageName:
         :param equalise: Whether to apply histogram equalisation to the thumbnail image to improve clarity.
         :param sharpen: Whether to apply an unshparp mask sharpening operation to improve clarity
         :param liquid: Whether to allow resizing operations that need to distort the image aspect ratio to use liquid resizing.
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``. Defaults to the system configuration.
+        :rtype: ImageName
 
         The derived name encodes the equalise, sharpen and liquid parameters via the letters ``els``.
+        A ``fast`` thumbnail never uses liquid resizing, as seam carving the full image defeats the purpose of the tier.
         """
-        self._clone = False
-        self._is_derived = True
-        self._is_thumbnail = True
-        self._is_base = False
         if size is None or (size[0] is None and size[1] is None):
             size = self._configuration.thumbnail_default_size
-            #            x_size = self._configuration.thumbnail_default_xsize
-            #            y_size = self._configuration.thumbnail_default_ysize
-            #        else:
         x_size = size[0]
         y_size = size[1]
             
@@ -443,59 +608,63 @@ class ImageName:
 
         if kind is None:
             kind = self._configuration.thumbnail_default_format
-        self._size = (x_size, y_size)
-        self._image_kind = kind
-
-        self._equalise = self._configuration.thumbnail_equalise
-        self._liquid = self._configuration.thumbnail_liquid_resize
-        self._sharpen = self._configuration.thumbnail_sharpen
 
         # Allow overriding of the config defaults
-        if "equalise" in kwargs:
-            self._equalise = kwargs["equalise"]
-
-        if "sharpen" in kwargs:
-            self._sharpen = kwargs["sharpen"]
+        equalise = kwargs.get("equalise", self._configuration.thumbnail_equalise)
+        sharpen = kwargs.get("sharpen", self._configuration.thumbnail_sharpen)
+        liquid = kwargs.get("liquid", self._configuration.thumbnail_liquid_resize)
 
-        if "liquid" in kwargs:
-            self._liquid = kwargs["liquid"]
+        quality = self._resolve_quality(kwargs.get("quality"))
+        if quality == "fast":
+            liquid = False
 
         #Place simple one letter codes in the name
         encoded_options = ""
-        if self._equalise:
+        if equalise:
             encoded_options += "e"
-        if self._liquid:
+        if liquid:
             encoded_options += "l"
-        if self._sharpen:
+        if sharpen:
             encoded_options += "s"
-        self._operations.append("thumbnail({},{},{})".format(x_size, y_size, encoded_options))
-
-        self._image_name = str(self)
+        return self._derive("thumbnail({},{},{}{})".format(x_size, y_size, encoded_options, self._quality_suffix(quality)),
+                            _is_derived = True, _is_thumbnail = True, _is_base = False, _size = (x_size, y_size),
+                            _image_kind = kind, _equalise = equalise, _liquid = liquid, _sharpen = sharpen,
+                            _quality = quality)
         
-    def apply_resize(self, size, kind = None):
-        """Apply an image resizing operation to the image
+    def apply_resize(self, size, kind = None, quality = None):
+        """Return the name with an image resizing operation applied
 
         :param scale: The size for the image
         :type size: tuple (x_size, y_size)
         :param kind: Image format for the resized image. Defaults to the current format if not specified.
         :type kind: string or None
-
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``. Defaults to the system configuration.
+        :type quality: string or None
+        :rtype: ImageName
         """
-        self._clone = False
-        self._is_derived = True
-        self._is_base = False
-        self._is_resize = True
-        self._operations.append("size({},{})".format(size[0],size[1]))
-        self._image_size = size
-        if kind is not None:
-            self._image_kind = kind
-        else:
-            kind = self._configuration.image_default_format
-        self._image_name = self.__str__()
-        self._image_size = size
+        quality = self._resolve_quality(quality)
+        return self._derive("size({},{}{})".format(size[0],size[1], self._quality_suffix(quality)),
+                            _is_derived = True, _is_base = False, _is_resize = True, _quality = quality,
+                            _image_size = size, _image_kind = kind if kind is not None else self._image_kind)
             
+    def apply_scale(self, size, kind = None, quality = None):
+        """Return the name with an operation scaling the image to exactly the given size applied
+
+        :param size: The size for the image
+        :type size: tuple (x_size, y_size)
+        :param kind: Image format for the scaled image. Defaults to the current format if not specified.
+        :type kind: string or None
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``. Defaults to the system configuration.
+        :type quality: string or None
+        :rtype: ImageName
+        """
+        quality = self._resolve_quality(quality)
+        return self._derive("scale({},{}{})".format(size[0], size[1], self._quality_suffix(quality)),
+                            _is_derived = True, _is_base = False, _is_scale = True, _quality = quality,
+                            _image_size = size, _image_kind = kind if kind is not None else self._image_kind)
+
     def apply_crop(self, size, origin, kind = None):
-        """Apply an image crop operation to the image
+        """Return the name with an image crop operation applied
 
         :param scale: The size for the image
         :type size: tuple (x_size, y_size)
@@ -503,77 +672,254 @@ class ImageName:
         :type origin: tuple (x_start, y_start)
         :param kind: Image format for the resized image. Defaults to the current format if not specified.
         :type kind: string or None
+        :rtype: ImageName
         """
-        self._clone = False
-        self._is_derived = True
-        self._is_base = False
-        self._operations.append("crop({},{},{},{})".format(size[0], size[1], origin[0], origin[1])  )
-        self._crop_size = size
-        self._crop_origin = origin
-        if kind is not None:
-            self._image_kind = kind
-        self._image_name = self.__str__()
-        self._image_size = size
+        return self._derive("crop({},{},{},{})".format(size[0], size[1], origin[0], origin[1]),
+                            _is_derived = True, _is_base = False, _is_crop = True, _crop_size = size,
+                            _crop_origin = origin, _image_size = size,
+                            _image_kind = kind if kind is not None else self._image_kind)
+
+    def apply_rotate(self, degrees, mirror = False):
+        """Return the name with an image rotation operation applied
+
+        :param degrees: Clockwise rotation in degrees
+        :type degrees: real
+        :param mirror: Whether the image is mirrored left to right before it is rotated
+        :type mirror: boolean
+        :rtype: ImageName
+        """
+        degrees = float(degrees) % 360
+        # Whole degrees are written as integers, so that equal rotations always have equal names
+        the_degrees = "{:d}".format(int(degrees)) if degrees == int(degrees) else "{!r}".format(degrees)
+        return self._derive("rotate({}{})".format(the_degrees, ",m" if mirror else ""),
+                            _is_derived = True, _is_base = False, _is_rotate = True)
+
+    def derivations(self):
+        """Return the derivation operations of the name, in the order they are applied
+
+        :rtype: list of tuples (operation, list of parameter strings)
+        """
+        result = []
+        for op in self._operations:
+            operation, parameters = op.split("(", 1)
+            parameters = parameters[:-1]
+            result.append((operation, parameters.split(",") if len(parameters) > 0 else []))
+        return result
+
+    def normalised(self):
+        """Return the unique name of the image this name describes
+
+        Requests that describe the same image may be written in several ways.  The normalised name of each of them is
+        the same, so that they share one cache entry:
+
+        * image formats are folded to one spelling, see ``format_aliases``
+        * parameters are written as the apply methods write them, with defaults implicit and thumbnail options
+          in a fixed order
+        * rotations that do nothing are removed
+        * conversions are removed unless they are the only derivation, as only the final format of an image matters
+
+        Original and metadata names are returned unchanged, as are names with operations, or parameters, that are
+        not understood.
+
+        :rtype: ImageName
+        """
+        if self._is_original or self._is_metadata or self._image_kind is None:
+            return self
+        kind = normalised_kind(self._image_kind)
+        derivations = self.derivations()
+        the_name = ImageName(self._base_name, kind = kind)
+        try:
+            for operation, parameters in derivations:
+                if operation == "size":
+                    quality = parameters[2] if len(parameters) > 2 else "best"
+                    the_name = the_name.apply_resize((_size(parameters[0]), _size(parameters[1])), quality = quality)
+                elif operation == "scale":
+                    quality = parameters[2] if len(parameters) > 2 else "best"
+                    the_name = the_name.apply_scale((int(parameters[0]), int(parameters[1])), quality = quality)
+                elif operation == "crop":
+                    the_name = the_name.apply_crop((int(parameters[0]), int(parameters[1])), (int(parameters[2]), int(parameters[3])))
+                elif operation == "rotate":
+                    degrees = float(parameters[0]) % 360
+                    mirror = len(parameters) > 1 and parameters[1] == "m"
+                    if degrees != 0 or mirror:
+                        the_name = the_name.apply_rotate(degrees, mirror)
+                elif operation == "thumbnail":
+                    options = parameters[2] if len(parameters) > 2 else ""
+                    quality = parameters[3] if len(parameters) > 3 else "best"
+                    the_name = the_name.apply_thumbnail((_size(parameters[0]), _size(parameters[1])), kind = kind,
+                                                        quality = quality, equalise = "e" in options,
+                                                        liquid = "l" in options, sharpen = "s" in options)
+                elif operation == "convert":
+                    if len(derivations) == 1:
+                        the_name = the_name.apply_convert(kind)
+                else:
+                    return self
+        except (ValueError, IndexError, RepositoryFailure):
+            return self
+        return the_name.set_kind(kind)
 
     def apply_metadata(self, kind = 'jsn'):
-        """Apply an extract metadata operation
+        """Return the name of the metadata of the image
 
+        :rtype: ImageName
         """
-        self._clone = False
-        self._is_derived = True
-        self._is_metadata = True
-        self._operations = ["metadata({})".format(kind)]
-        self._image_kind = kind
-        self._image_size = None        
-        self._image_name = self.__str__()
+        return self._derive(_is_derived = True, _is_metadata = True, _operations = ("metadata({})".format(kind),),
+                            _image_kind = kind, _image_size = None)
         
     def apply_convert(self, kind):
-        """Apply an image format conversion operation.
+        """Return the name with an image format conversion operation applied.
 
         :param kind: The new format for the image
         :type kind: string
+        :rtype: ImageName
         """
-        self._clone = False
         if self._is_derived:   # this is only needed if the original image is to be converted with no other action.
-            return
-        self._is_derived = True
-        self._operations.append("convert({})".format(kind))
-        self._image_kind = kind
-        self._image_name = self.__str__()
+            return self._derive()
+        return self._derive("convert({})".format(kind), _is_derived = True, _image_kind = kind)
+
+    def converted_from(self, kind):
+        """Return the name, with a format conversion applied if it describes its base image in another format
+
+        A name with no derivation operations describes the base image, so a request for it in a format other than
+        that of the base has to be made an explicit conversion.  Spellings of one format, such as ``jpeg`` and
+        ``jpg``, are not different formats.
+
+        :param kind: Format of the base image
+        :type kind: string or None
+        :rtype: ImageName
+        """
+        if self._is_derived or normalised_kind(self._image_kind) == normalised_kind(kind):
+            return self
+        return self.apply_convert(self._image_kind)
         
     def __str__(self):
         """String representation of the ImageName
 
-        This is the full cannonical representation of the name, and is used as the static name for images
-        """
-        the_string = "{}".format(self._base_name)
-        if self._clone:
-            the_string += "+clone()"
-        if len(self._operations) != 0:
-            for op in self._operations:
-                the_string += "+{}".format(op)
-        else:
-            if self._original_name is not None or self._is_original:
-                the_string += "+original({})".format(self._original_name)
-        
-        the_string += ".{}".format(self._image_kind)
-        return the_string
+        This is the full cannonical representation of the name, and is used as the static name for images.
+        It is made once, names being immutable.
+        """
+        if self._string is None:
+            parts = [self._base_name]
+            if self._clone:
+                parts.append("+clone()")
+            if len(self._operations) != 0:
+                for op in self._operations:
+                    parts.append("+")
+                    parts.append(op)
+            elif self._original_name is not None or self._is_original:
+                parts.append("+original({})".format(self._original_name))
+            parts.append(".{}".format(self._image_kind))
+            self._string = "".join(parts)
+        return self._string
+
+    def __eq__(self, other):
+        return isinstance(other, ImageName) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(str(self))
+        return self._hash
 
     def image_name(self):
         """Return the effective filename (including type suffix) that include all operations.
 
         :rtype: string
         """
-        return self._image_name
+        return self._image_name if self._image_name is not None else str(self)
     
+
+def _integer(value):
+    """A size parameter as an integer, or unchanged if it is not one"""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _size(value):
+    """A size parameter as an integer, or None where the size is left open
+
+    :raises: ValueError
+    """
+    return None if value in ("None", "") else int(value)
+
+
+# Forms of the names timed by the benchmark, each filled in with a running number
+benchmark_forms = ["a/b/c{}.jpg", "a/b/c{}+size(640,480).webp", "a/b/c{}+thumbnail(200,200,es,fast).jpg",
+                   "a/b/c{}+crop(100,100,20,20)+size(50,50)+rotate(90,m).png"]
+
+
+def time_names(name_class, count = 5000, rounds = 20):
+    """Time the parsing and string representation of names of each of the benchmark forms
+
+    Each name is timed as first parsed, and as parsed again when it is interned, and its string as first made and
+    as made again.
+
+    :param name_class: The class parsing the names
+    :type name_class: class
+    :param count: How many distinct names of each form to time
+    :type count: integer
+    :param rounds: How many times the names are parsed again, and their strings made again
+    :type rounds: integer
+    :rtype: list of tuples (form, microseconds per name to parse, reparse, make the string, make it again)
+    """
+    results = []
+    for form in benchmark_forms:
+        ImageName._interned.clear()
+        ImageName._interned_previous.clear()
+        strings = [form.format(index) for index in range(count)]
+        start = time.time()
+        names = [name_class(string) for string in strings]
+        first_parse = time.time() - start
+        start = time.time()
+        for name in names:
+            str(name)
+        first_string = time.time() - start
+        start = time.time()
+        for _ in range(rounds):
+            for string in strings:
+                name_class(string)
+        parse = (time.time() - start) / rounds
+        start = time.time()
+        for _ in range(rounds):
+            for name in names:
+                str(name)
+        string = (time.time() - start) / rounds
+        results.append((form.format(""),) + tuple(1e6 * value / count for value in (first_parse, parse, first_string, string)))
+    return results
+
+
+def benchmark(count = 5000, rounds = 20):
+    """Time the parsing and string representation of image names, and log the results
+
+    ``tools/name_benchmark.py`` compares these timings with those of the parser from before names were interned.
+
+    :param count: How many distinct names of each form to time
+    :type count: integer
+    :param rounds: How many times the names are parsed again, and their strings made again
+    :type rounds: integer
+    """
+    logger.info("Image name benchmark, microseconds per name over {} names".format(count))
+    logger.info("{:56s}{:>10s}{:>10s}{:>10s}{:>10s}".format("name", "parse", "reparse", "str", "str again"))
+    for result in time_names(ImageName, count, rounds):
+        logger.info("{:56s}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(*result))
+
+
 def test():
     a = ImageName("test1.jpg")
     print a
-    a.apply_crop((100,200),(300,400),'jpg')
+    a = a.apply_crop((100,200),(300,400),'jpg')
     print a
-    a.apply_resize((200,300))
+    a = a.apply_resize((200,300))
     print a
 
 
 if __name__ == "__main__":
-    test()
+    if "benchmark" in sys.argv[1:]:
+        logging.basicConfig(level = logging.INFO, format = "%(message)s")
+        benchmark()
+    else:
+        test()
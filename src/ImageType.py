@@ -19,9 +19,17 @@ import hashlib
 import uuid
 import cStringIO
 import Stores
+import ImageHeaders
+import Resources
+import Backends
+import Metrics
+import LosslessStrip
+import JpegTransform
 import wand.exceptions
 import logging
 import weakref
+import mimetypes
+from threading import Lock
 from threading import RLock
 
 from Exceptions import RepositoryError
@@ -29,6 +37,8 @@ from Exceptions import RepositoryFailure
 
 logger = logging.getLogger("image_repository")
 
+header_read_size = 64 * 1024    # Bytes read from the start of a stored image to find its dimensions
+
 class ImageHandle(object):
     """Encapsulates the notion of a handle on an image.
 
@@ -57,6 +67,7 @@ class ImageHandle(object):
         :type config: instance of Configuration
         """
         cls._configuration = config
+        Backends.set_configuration(config)
 
     _cache = None
        
@@ -102,6 +113,7 @@ class ImageHandle(object):
         self._bytes = bytes
         self._persistent_path = path
         self._persistent_store = store
+        self._pixel_cache_path = None    # Decoded copy of the image, see Caches.DecodedImageCache
         
         if image is None:
             self._kind = kind     # how the image is encoded.  String, must be a member of the Wand.images supported types
@@ -167,6 +179,36 @@ class ImageHandle(object):
         """        
         self._local_file_path = path
     
+    def add_pixel_cache(self, path):
+        """Add a decoded pixel cache to the set of mechanisms available to find this image
+
+        Once added, the in memory image may be released and will be reloaded from the pixel cache without decoding.
+
+        :param path: Full path to the ``.mpc`` header of the pixel cache
+        :type path: string
+        """
+        self._pixel_cache_path = path
+
+    def is_loadable(self):
+        """Returns whether the image is in memory, or there remains some way to load it
+
+        :rtype: boolean
+        """
+        return ((self._image is not None and self._image() is not None) or
+                self._bytes is not None or self._file_like is not None or
+                self._local_file_path is not None or self._persistent_path is not None or
+                (self._pixel_cache_path is not None and os.path.exists(self._pixel_cache_path)))
+
+    def _release_bytes(self):
+        """Free the encoded copy of the image held in memory, where the image can be had again some other way
+
+        An image that is only held encoded, as a lossless strip or a lossless JPEG transform leaves it, keeps its
+        encoded copy until it also has a Wand image, a local file or a persistent copy.
+        """
+        if ((self._image is not None and self._image() is not None) or self._persistent_path is not None or
+            (self._local_file_path is not None and os.path.exists(self._local_file_path))):
+            self._bytes = None
+
     def md5(self):
         """Compute the MD5 hash of the image
 
@@ -196,6 +238,149 @@ class ImageHandle(object):
             return None
         return ImageHandle(image = image.clone())
 
+    def encoded_bytes(self):
+        """Return the image as encoded bytes, without decoding it if that can be avoided
+
+        Unlike ``bytes()`` this reads the encoded image directly from wherever it is held, and only falls back
+        to encoding an in memory Wand image when there is no other source.
+
+        :rtype: bytes or None
+        """
+        if self._bytes is not None:
+            return self._bytes
+        if self._file_like is not None:
+            position = self._file_like.tell()
+            self._file_like.seek(0)
+            the_bytes = self._file_like.read()
+            self._file_like.seek(position)
+            return the_bytes
+        if self._local_file_path is None and self._persistent_path is not None:
+            try:
+                self._local_file_path = self._persistent_store.get_image(self._persistent_path)
+            except RepositoryError:
+                logger.error("Persistent download to local file fails for {}".format(self._persistent_path))
+                raise
+        if self._local_file_path is not None:
+            try:
+                with open(self._local_file_path, 'rb') as the_file:
+                    return the_file.read()
+            except IOError:
+                logger.exception("Unable to read image file {}".format(self._local_file_path))
+        return self.bytes()
+
+    def hold_bytes(self):
+        """Keep the encoded image in memory, so that it no longer depends upon the file or object it was read from
+
+        :rtype: boolean, whether the encoded image is held
+        """
+        if self._bytes is None:
+            the_bytes = self.encoded_bytes()
+            if the_bytes is None:
+                return False
+            self._bytes = the_bytes
+        self._size = len(self._bytes)
+        return True
+
+    def embedded_preview(self, size, tolerance):
+        """Return the preview image embedded in the EXIF data of the image, if it can stand in for the image
+
+        Neither the image nor the preview is decoded to decide.  The preview must be large enough to fill the
+        thumbnail ``size`` box without enlargement, and its aspect ratio must match that of the image.  The aspect
+        check rejects previews that are letterboxed, or that have been rotated differently to the image.  Images
+        with an EXIF Orientation other than the normal one are refused, as the preview carries no orientation and
+        would be shown rotated or mirrored relative to thumbnails derived from the image.
+
+        :param size: The thumbnail box that the preview will be reduced to fit
+        :type size: tuple (x_size, y_size)
+        :param tolerance: Greatest permitted relative difference of the aspect ratios
+        :type tolerance: real
+        :rtype: ImageHandle or None
+        """
+        if not self._has_encoded_source() or Backends.normalise_kind(self._kind) not in (None, "jpg"):
+            return None
+        the_bytes = self.encoded_bytes()
+        preview = ImageHeaders.exif_thumbnail(the_bytes)
+        if preview is None:
+            return None
+        orientation = ImageHeaders.exif_orientation(the_bytes)
+        if orientation not in (None, 1):
+            logger.debug("Embedded preview not used, image has EXIF orientation {}".format(orientation))
+            return None
+        main = ImageHeaders.probe_bytes(the_bytes)
+        small = ImageHeaders.probe_bytes(preview)
+        if main is None or small is None or main.height == 0 or small.height == 0:
+            return None
+        main_aspect = float(main.width) / main.height
+        if abs(float(small.width) / small.height - main_aspect) > tolerance * main_aspect:
+            logger.debug("Embedded preview {} does not match image {}".format(small, main))
+            return None
+        scale = min(float(size[0]) / main.width, float(size[1]) / main.height)
+        if small.width < main.width * scale or small.height < main.height * scale:
+            return None
+        return ImageHandle(bytes = preview, kind = "JPEG")
+
+    def _has_encoded_source(self):
+        """Returns whether the image is held in encoded form, rather than only as a Wand image
+
+        :rtype: boolean
+        """
+        return (self._bytes is not None or self._file_like is not None or
+                self._local_file_path is not None or self._persistent_path is not None)
+
+    def header(self):
+        """Return the format and dimensions of the image, decoding it only when they cannot be probed
+
+        :rtype: ImageHeaders.ImageHeader or None
+        """
+        if self._image is not None and self._image() is not None:
+            image = self._image()
+            return ImageHeaders.ImageHeader(image.format, image.width, image.height)
+        header = None
+        if self._bytes is not None:
+            header = ImageHeaders.probe_bytes(self._bytes)
+        elif self._file_like is not None:
+            header = ImageHeaders.probe_stream(self._file_like)
+        elif self._local_file_path is not None:
+            header = ImageHeaders.probe_file(self._local_file_path)
+        elif self._persistent_path is not None:
+            try:
+                # The header is nearly always within the first bytes, only read the whole image when it is not
+                the_bytes = self._persistent_store.get_object(self._persistent_path, 0, header_read_size)
+                header = ImageHeaders.probe_bytes(the_bytes) if the_bytes is not None else None
+                if header is None:
+                    self._local_file_path = self._persistent_store.get_image(self._persistent_path)
+                    header = ImageHeaders.probe_file(self._local_file_path)
+            except RepositoryError:
+                logger.error("Persistent download to local file fails for {}".format(self._persistent_path))
+        if header is None:
+            try:
+                image = self._get_image()
+            except (RepositoryError, RepositoryFailure):
+                return None
+            header = ImageHeaders.ImageHeader(image.format, image.width, image.height)
+        return header
+
+    def _derive(self, operation, kind, derivation, reduce_to = None, copy = True):
+        """Derive a new image using the backend configured for the operation and resulting format
+
+        :param operation: The name of the operation, used to select the backend
+        :type operation: string
+        :param kind: Format of the derived image
+        :type kind: string
+        :param derivation: Function of (backend, native image) that returns the derived native image
+        :type derivation: callable
+        :param reduce_to: Smallest box the decoder may reduce the image to, if any
+        :type reduce_to: tuple (x_size, y_size) or None
+        :param copy: Whether the derivation modifies the image it is given
+        :type copy: boolean
+        :rtype: ImageHandle
+        """
+        # Pixel caches can only be read by Wand
+        backend = Backends.select(operation, kind, "mpc" if self._pixel_cache_path is not None else self._kind)
+        native = backend.decode(self, reduce_to = reduce_to, copy = copy)
+        native = derivation(backend, native)
+        return ImageHandle(**backend.handle_arguments(native, kind))
+
     def convert(self, kind):
         """Convert the image to a different format
 
@@ -207,72 +392,158 @@ class ImageHandle(object):
         instance is returned.
         If the formats differ, the image is cloned and the clone has its format converted, and then returned.
         """
+        if Backends.normalise_kind(kind) == Backends.normalise_kind(self._kind):  # avoid unneeded conversion, or accidental cloning
+            return self
         try:
-            image = self._get_image()
+            return self._derive("convert", kind, lambda backend, image: backend.convert(image, kind), copy = False)
         except RepositoryFailure:
-            logger.error("Convert - _get_image fails")
-        # Wand implicitly creates a clone when creating a new format
-        if kind == self._kind:  # avoid unneeded conversion, or accidental cloning
-            return self
-        return ImageHandle(image = image.convert(kind), kind = kind)
+            logger.error("Convert - decode fails")
+            raise
 
     def strip(self):
         """Remove any metadata within the image
         """
         image = self._get_image()
         image.strip()
+        self._bytes = None      # Any encoded copy still holds the metadata
     
     def stripped(self):
         """Create a new image devoid of metadata
 
         :rtype: ImageHandle
+
+        JPEG, PNG and TIFF images held in encoded form are stripped by rewriting their container bytes, which
+        needs no decoding and leaves the compressed image data untouched.  Other images are stripped by a backend.
         """
-                # strip does not create a new Image, so we must
+        if self._configuration is not None and self._configuration.strip_lossless and self._has_encoded_source():
+            the_bytes = LosslessStrip.strip_bytes(self.encoded_bytes(), self._configuration.strip_keep_icc_profile)
+            if the_bytes is not None:
+                return ImageHandle(bytes = the_bytes, kind = self._kind)
         try:
-            image = self.clone()
+            return self._derive("strip", self._kind, lambda backend, image: backend.strip(image))
         except RepositoryFailure:
-            logger.error("Stripped - clone fails")
-        image.strip()
-        return image
+            logger.error("Stripped - decode fails")
+            raise
     
+    def _lossless_jpeg(self):
+        """Returns whether lossless JPEG transforms may be attempted upon the image
+
+        :rtype: boolean
+        """
+        return (self._configuration is not None and self._configuration.jpeg_lossless_transforms and
+                self._has_encoded_source() and Backends.normalise_kind(self._kind) in (None, "jpg"))
+
     def crop(self, x_size, y_size, x_offset, y_offset):
+        """Create a cropped copy of the image
+
+        JPEG images are cropped without re-encoding when the corner of the region lies on the iMCU grid, or
+        ``jpeg_lossless_crop_snap`` allows it to be moved there.  Otherwise a JPEG is first cropped losslessly to
+        the iMCU grid around the region, so that only the region is decoded before the exact crop.
+
+        :rtype: ImageHandle or None
+        """
+        if self._lossless_jpeg():
+            the_bytes = self.encoded_bytes()
+            snap = self._configuration.jpeg_lossless_crop_snap
+            cropped = JpegTransform.crop(self._configuration.jpegtran_path, the_bytes, x_size, y_size, x_offset, y_offset, snap)
+            if cropped is not None:
+                return ImageHandle(bytes = cropped, kind = self._kind)
+            block = JpegTransform.imcu_size(the_bytes)
+            if not snap and block is not None:
+                cropped = JpegTransform.crop(self._configuration.jpegtran_path, the_bytes, x_size, y_size, x_offset, y_offset, True)
+                if cropped is not None:
+                    return ImageHandle(bytes = cropped, kind = self._kind)._crop_decoded(x_size, y_size,
+                                                                                         x_offset % block[0], y_offset % block[1])
+        return self._crop_decoded(x_size, y_size, x_offset, y_offset)
+
+    def _crop_decoded(self, x_size, y_size, x_offset, y_offset):
+        """Crop the decoded image
+
+        :rtype: ImageHandle or None
+        """
+        def derivation(backend, image):
+            width, height = backend.dimensions(image)
+            return backend.crop(image, min(x_size, width), min(y_size, height), min(x_offset, width), min(y_offset, height))
         try:
-            image = self._get_image()
+            return self._derive("crop", self._kind, derivation, copy = False)
         except RepositoryFailure:
             return None
-        # Wand implicitly creates a clone when creating a new sliced image
-        x_size = min(x_size, self._image().width)
-        x_offset = min(x_offset, self._image().width)
-        y_size = min(y_size, self._image().height)
-        y_offset = min(y_offset, self._image().height)
-        
-        new_image = ImageHandle(image = image[x_offset:(x_offset+x_size), y_offset:(y_offset+y_size)])
-        return new_image
-        
-    def resize(self, size):
-        the_clone = self.clone()
-        new_image = the_clone._get_image()
-
-        desired_aspect_ratio = float(size[0])/float(size[1])
-        image_aspect_ratio = float(new_image.width)/float(new_image.height)      
-
-        if desired_aspect_ratio > image_aspect_ratio:  # Image taller, keep desired Y
-            x_size = int(size[0] * image_aspect_ratio)
-            y_size = size[1]
-        else:                                          # Image wider, keep desired X
-            x_size = size[0]
-            y_size = int(size[1] / image_aspect_ratio)
-        
-        new_image.resize(x_size, y_size)
-        return the_clone
 
+    def rotate(self, degrees, mirror = False):
+        """Create a rotated, and optionally mirrored, copy of the image
+
+        JPEG images are rotated by right angles and mirrored without re-encoding when their dimensions are whole iMCUs.
+
+        :param degrees: Clockwise rotation in degrees
+        :type degrees: real
+        :param mirror: Whether to mirror the image left to right before rotating it
+        :type mirror: boolean
+        :rtype: ImageHandle
+        """
+        if degrees % 90 == 0 and self._lossless_jpeg():
+            the_bytes = JpegTransform.transform(self._configuration.jpegtran_path, self.encoded_bytes(), int(degrees), mirror)
+            if the_bytes is not None:
+                return ImageHandle(bytes = the_bytes, kind = self._kind)
+        return self._derive("rotate", self._kind, lambda backend, image: backend.rotate(image, degrees, mirror))
+
+    def scale(self, size, quality = "best"):
+        """Create a copy of the image scaled to exactly the given size, distorting it if the aspect ratios differ
 
-    def thumbnail(self, size, kind = None, **kwargs):
+        :param size: Size of the copy
+        :type size: tuple (x_size, y_size)
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``
+        :type quality: string
+        :rtype: ImageHandle
+        """
+        return self._derive("resize", self._kind, lambda backend, image: backend.resize(image, size[0], size[1], quality),
+                            reduce_to = self._reduce_to(size, quality))
+
+    @staticmethod
+    def _reduce_to(size, quality):
+        """The box a decoder may reduce an image to before resampling it to fit ``size``
+
+        Decoder reduction is only used for the faster tiers, the ``best`` tier resamples from full resolution.
+
+        :rtype: tuple (x_size, y_size) or None
+        """
+        if quality == "fast":
+            return size
+        if quality == "balanced":
+            return (2 * size[0], 2 * size[1])
+        return None
+
+    def resize(self, size, quality = "best"):
+        """Create a resized copy of the image that fits within the given box
+
+        :param size: Box to fit the image within
+        :type size: tuple (x_size, y_size)
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``
+        :type quality: string
+        :rtype: ImageHandle
+        """
+        def derivation(backend, image):
+            width, height = backend.dimensions(image)
+            desired_aspect_ratio = float(size[0])/float(size[1])
+            image_aspect_ratio = float(width)/float(height)
+
+            if desired_aspect_ratio > image_aspect_ratio:  # Image taller, keep desired Y
+                x_size = int(size[0] * image_aspect_ratio)
+                y_size = size[1]
+            else:                                          # Image wider, keep desired X
+                x_size = size[0]
+                y_size = int(size[1] / image_aspect_ratio)
+            return backend.resize(image, x_size, y_size, quality)
+
+        return self._derive("resize", self._kind, derivation, reduce_to = self._reduce_to(size, quality))
+
+    def thumbnail(self, size, kind = None, quality = "best", **kwargs):
         """
         Create a thumbnail of the image.  
 
         :param size: Box to fit the thumbnail within.  The thumbnaill may be smaller than this, but will fill one dimension, if not both.
         :type size: tuple (x_size, y_size)
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``
+        :type quality: string
         :param options: set of options that may govern exactly how the thumbnail is created. These override the global configuration options
         :type options: dict
         :rtype: ImageHandle instance
@@ -281,54 +552,40 @@ class ImageHandle(object):
         allow liquid resize to preserve information in the case of very wide or tall images, and we allow some sharpening and brightness correction of the image
         to make it generally easier to view at reduced scale.
         """
-
-        the_clone = self.clone()
-        clone_image = the_clone._get_image()
-        
-        desired_aspect_ratio = float(size[0])/float(size[1])
-        image_aspect_ratio = float(clone_image.width)/float(clone_image.height)
-
-        try_liquid = True
-        liquid_limit = self._configuration.thumbnail_liquid_cutin_ratio
-        
-        if desired_aspect_ratio / image_aspect_ratio < 1/liquid_limit:  # original too wide
-            try_liquid = "liquid" in kwargs and kwargs["liquid"]
-            image_aspect_ratio = liquid_limit   # Limit how wide
-
-        if  desired_aspect_ratio / image_aspect_ratio > liquid_limit:   # original too tall
-            try_liquid = "liquid" in kwargs and kwargs["liquid"]
-            image_aspect_ratio = 1/liquid_limit  # Limit how tall
-            
-        if desired_aspect_ratio > image_aspect_ratio:  # Image taller, keep desired Y
-            x_size = int(size[0] * image_aspect_ratio)
-            y_size = size[1]
-        else:                                          # Image wider, keep desired X
-            x_size = size[0]
-            y_size = int(size[1] / image_aspect_ratio)
-                        
-        if try_liquid:
-            try:
-                clone_image.liquid_rescale(x_size, y_size)
-            except wand.image.MissingDelegateError:
-                # Liquid rescale was not built into the underlying ImageMagik library.
-                # We will do a simple non-recilinear rescale
-                clone_image.resize(x_size, y_size)
-        else:
-            clone_image.resize(x_size, y_size)
-
-        if "equalise" in kwargs and kwargs["equalise"] :
-            clone_image.equalize()
-            
-        if "sharpen" in kwargs and kwargs["sharpen"] :        
-            clone_image.unsharp_mask(radius = 0.0, sigma = 1.0, amount = 1.0, threshold = 1.0)
-
         if kind is None:
             kind = self._configuration.thumbnail_default_format
-        if self._kind != kind:
-            clone_image.convert(kind)
-            the_clone._kind = kind
-            
-        return the_clone
+
+        def derivation(backend, image):
+            width, height = backend.dimensions(image)
+            desired_aspect_ratio = float(size[0])/float(size[1])
+            image_aspect_ratio = float(width)/float(height)
+
+            try_liquid = True
+            liquid_limit = self._configuration.thumbnail_liquid_cutin_ratio
+
+            if desired_aspect_ratio / image_aspect_ratio < 1/liquid_limit:  # original too wide
+                try_liquid = "liquid" in kwargs and kwargs["liquid"]
+                image_aspect_ratio = liquid_limit   # Limit how wide
+
+            if  desired_aspect_ratio / image_aspect_ratio > liquid_limit:   # original too tall
+                try_liquid = "liquid" in kwargs and kwargs["liquid"]
+                image_aspect_ratio = 1/liquid_limit  # Limit how tall
+
+            if desired_aspect_ratio > image_aspect_ratio:  # Image taller, keep desired Y
+                x_size = int(size[0] * image_aspect_ratio)
+                y_size = size[1]
+            else:                                          # Image wider, keep desired X
+                x_size = size[0]
+                y_size = int(size[1] / image_aspect_ratio)
+
+            image = backend.thumbnail(image, x_size, y_size, quality, liquid = try_liquid,
+                                      equalise = "equalise" in kwargs and kwargs["equalise"],
+                                      sharpen = "sharpen" in kwargs and kwargs["sharpen"])
+            if self._kind != kind:
+                image = backend.convert(image, kind)
+            return image
+
+        return self._derive("thumbnail", kind, derivation, reduce_to = self._reduce_to(size, quality))
             
     
     def _get_image(self):
@@ -341,6 +598,10 @@ class ImageHandle(object):
         one mechanism to create the Image.
 
         This function is usefully called by other routines to ensure that there is a Wand Image present before proceeding.
+
+        Before decoding, the image header is probed and the decode is governed by the configured resource limits.
+        Images that are too large are refused with a RepositoryFailure, very large images are decoded to a disk
+        backed pixel cache.
         """
         # This is the core lazy evaluation of the handle. In order to make any other type we need to convert the input
         # In order to do any processing we want a Wand Image as well
@@ -349,14 +610,23 @@ class ImageHandle(object):
             if self._image() is None:
                 self._image = None
         if self._image is None:
+            if self._pixel_cache_path is not None:
+                image = self._get_pixel_cache_image()
             # go through the list in easiest to hardest order
-            if self._bytes is not None:
-                image = wand.image.Image(blob = self._bytes, format = self._kind)
+            if image is not None:
+                pass
+            elif self._bytes is not None:
+                with Resources.governed(ImageHeaders.probe_bytes(self._bytes)):
+                    image = wand.image.Image(blob = self._bytes, format = self._kind)
             elif self._file_like is not None:
-                image = wand.image.Image(file = self._file_like)
+                with Resources.governed(ImageHeaders.probe_stream(self._file_like)):
+                    image = wand.image.Image(file = self._file_like)
             elif self._local_file_path is not None:
                 try:
-                    image = wand.image.Image(filename = self._local_file_path)
+                    with Resources.governed(ImageHeaders.probe_file(self._local_file_path)):
+                        image = wand.image.Image(filename = self._local_file_path)
+                except RepositoryFailure:
+                    raise
                 except (wand.exceptions.CoderError) as ex:
                     logger.exception("Wand image create fails for {} of {}".format(self._local_file_path, self._kind))
                     raise RepositoryFailure("Unable to build image")
@@ -370,7 +640,10 @@ class ImageHandle(object):
                     logger.error("Persistent download to local file fails for {}".format(self._persistent_path))
                     raise
                 try:
-                    image = wand.image.Image(filename = self._local_file_path, format = self._kind)
+                    with Resources.governed(ImageHeaders.probe_file(self._local_file_path)):
+                        image = wand.image.Image(filename = self._local_file_path, format = self._kind)
+                except RepositoryFailure:
+                    raise
                 except (wand.exceptions.CoderError):
                     logger.error("Wand image create from uploaded file fails for {} of {}".format(self._local_file_path, self._kind))
                     raise RepositoryFailure("Unable to create image")
@@ -390,6 +663,24 @@ class ImageHandle(object):
         return self._image()
 
 
+    def _get_pixel_cache_image(self):
+        """Open the decoded pixel cache of the image, if it remains usable
+
+        The pixels are memory mapped rather than decoded.  A pixel cache that has been evicted, or that was written
+        by an incompatible ImageMagick build, is forgotten and the image is loaded from its other sources.
+
+        :rtype: wand.image.Image or None
+        """
+        try:
+            image = wand.image.Image(filename = self._pixel_cache_path)
+        except Exception:
+            logger.warning("Decoded pixel cache {} unusable, loading from source".format(self._pixel_cache_path))
+            self._pixel_cache_path = None
+            return None
+        if self._kind is not None:
+            image.format = self._kind    # Otherwise the image would be encoded as MPC
+        return image
+
     def allocated_memory(self):
         """Estimate of the memory consumed by this image
         """
@@ -412,7 +703,7 @@ class ImageHandle(object):
         # Wand can create a byte blob, and we just use the C implemented StringIO to get an efficient file-like object
         bytes = self.bytes()
         strio = cStringIO.StringIO(bytes)
-        self._bytes = None   # wipe the reference again to free memory
+        self._release_bytes()   # wipe the reference again to free memory
         return strio
 
         
@@ -437,11 +728,16 @@ class ImageHandle(object):
             mangled_name = ImageName.safe_name(name)
             
             file_path = os.path.join(dir_path, mangled_name)
-            try:
-                image = self._get_image()
-            except RepositoryFailure:
-                return None        
-            image.save(filename = file_path)   # Use the Wand file save capability - we may want to use a proper write to allow mode bits.
+            if self._bytes is not None:
+                # Already encoded, by a backend other than Wand or by a lossless strip.  Avoid encoding it again.
+                with open(file_path, 'wb') as the_file:
+                    the_file.write(self._bytes)
+            else:
+                try:
+                    image = self._get_image()
+                except RepositoryFailure:
+                    return None
+                image.save(filename = file_path)   # Use the Wand file save capability - we may want to use a proper write to allow mode bits.
             logger.debug("File saved to local file cache at {}".format(file_path))
             if mode is not None:
                 try:
@@ -452,7 +748,8 @@ class ImageHandle(object):
         except IOError:
             logger.exception("Image save to local file {} fails".format(file_path))
             raise RepositoryFailure
-        self._bytes = None
+        self.add_file_path(file_path)
+        self._release_bytes()
         return file_path
 
 
@@ -487,7 +784,7 @@ class ImageHandle(object):
         if self._persistent_path is None:
             self._persistent_path = self._persistent_store.store_image(self.as_filelike(), name = str(name))
 
-        self._bytes = None
+        self._release_bytes()
             
         return self._persistent_path
     
@@ -510,9 +807,16 @@ class ImageHandle(object):
     def mimetype(self):
         """Return the mimetype of the image
 
+        Determined from the format where possible, so that the image need not be decoded.
+
+        :rtype: string
         """
-        # This isn't good.
-        return self._get_image().mimetype()
+        kind = self.kind()
+        if kind is not None:
+            mimetype = mimetypes.guess_type("image." + kind.lower())[0]
+            if mimetype is not None:
+                return mimetype
+        return self._get_image().mimetype
         
     def bytes(self):
         """Return a blob of bytes encapsulating the image, as provided by Wand.image
@@ -588,6 +892,20 @@ class ImageHandle(object):
         """
         return cls(bytes = the_bytes, kind = kind, eager = True)
 
+    @classmethod
+    def from_pixel_cache(cls, path, kind):
+        """Create an ImageHandle from a decoded pixel cache
+
+        :param path: Path to the ``.mpc`` header of the pixel cache
+        :type path: string
+        :param kind: Format of the image as a Wand image format string
+        :type kind: string
+        :rtype: ImageHandle
+        """
+        handle = cls(kind = kind)
+        handle.add_pixel_cache(path)
+        return handle
+
     @classmethod
     def from_image(cls, the_image):
         """Create an ImageHandle from an wand.image.Image object
@@ -631,6 +949,50 @@ class ImageSet:
         self._instances[instance.get_name()] = instance
         
 
+class InstanceRegistry(object):
+    """The live ImageInstances, by name
+
+    Instances are held weakly, so an instance is kept only while something else, usually a cache, refers to it,
+    and is collected once nothing does.  The names are spread over several independently locked stripes, so
+    that the creation of differently named instances is seldom serialised.
+
+    The number of live instances is the gauge ``instances.live``, and the counters ``instances.created`` and
+    ``instances.contended`` count new instances and waits for a stripe lock.
+    """
+
+    def __init__(self, stripes = 16):
+        """:param stripes: Number of independently locked stripes
+        :type stripes: integer
+        """
+        self._stripes = [(Lock(), weakref.WeakValueDictionary()) for _ in range(stripes)]
+
+    def get_or_create(self, name, create):
+        """Return the live instance of a name, or a new one
+
+        :param name: Name of the instance
+        :type name: string
+        :param create: Returns a new instance
+        :type create: function
+        :rtype: ImageInstance
+        """
+        lock, instances = self._stripes[hash(name) % len(self._stripes)]
+        if not lock.acquire(False):
+            Metrics.increment("instances.contended")
+            lock.acquire()
+        try:
+            instance = instances.get(name)
+            if instance is None:
+                instance = create()
+                instances[name] = instance
+                Metrics.increment("instances.created")
+            return instance
+        finally:
+            lock.release()
+
+    def __len__(self):
+        return sum(len(instances) for _, instances in self._stripes)
+
+
 class ImageInstance(object):
     """
     Encapsulates a single image 
@@ -648,32 +1010,26 @@ class ImageInstance(object):
     """
 
     _cache = None          # The master cache to use for caching operations
-    _image_instances = {}  # The class static list of all instances
+    _image_instances = InstanceRegistry()  # The class static registry of all live instances
     _configuration = None
-    _lock = RLock()        # Protects use of _image_instances
     
     def __new__(klass, image_name, image_handle, *args, **kwargs):
         """Override __new__ so as to provide a unique ImageInstance for each image.
     
         Uniqueness is determined by the name of the image, as it contains the derivation history.
-        A class static dictionary is used to maintain uniqueness. If the named image has not already
-        been created, it will be created, otherwise the existing one will be returned.
+        A class static registry is used to maintain uniqueness. If a live image of the name exists it is
+        returned, otherwise a new one is created.
 
         :param image_name: name of the image being created
         :type image_name: ImageName
         :param image_handle: The image being bound to the name
         :type image_handle: ImageHandle
         """
-
-        with klass._lock:
-            if image_name is not None and image_name.image_name in klass._image_instances:
-                new_image = klass._image_instances[image_name.image_name]
-            else:
-                new_image = super(ImageInstance, klass).__new__(klass, image_name, image_handle, *args, **kwargs)
-                if image_name is not None:
-                    # None is allowed if we are building a name via BaseImage  --- TODO change this
-                    klass._image_instances[image_name.image_name] = new_image
-        return new_image
+        create = lambda: super(ImageInstance, klass).__new__(klass, image_name, image_handle, *args, **kwargs)
+        if image_name is None:
+            # None is allowed if we are building a name via BaseImage  --- TODO change this
+            return create()
+        return klass._image_instances.get_or_create(str(image_name), create)
 
     def __init__(self, image_name = None, image_handle = None, kind = None, size = None):
         """Construct an ImageInstance or derived class
@@ -684,10 +1040,11 @@ class ImageInstance(object):
         In order to cope with instance uniqueness we must cope with ``__init__`` being called on
         already extant, and thus initialised objects.
         Since ``__init__`` is allowed to create new object variables, and newly constructed objects start with an empty ``__dict__``
-        it is as simple as checking to see if a variable exists or not.
+        it is as simple as checking to see if a variable exists or not, see ``_live``.  A live object is only given
+        what it lacks, never reset.
         """
         
-        if "_name" in self.__dict__:  # We are modifying an existing object, update as approriate
+        if self._live():  # We are modifying an existing object, update as approriate
             if image_handle is not None and self._image_handle is None:        
                 self._image_handle = image_handle
                 self._size = image_handle.size()
@@ -709,6 +1066,13 @@ class ImageInstance(object):
             self._persistent_url = None    # URL for the image instance that is essentially infinite - if there is one
 
 
+    def _live(self):
+        """Return whether the object is already initialised, having been returned by the registry for a live name
+
+        :rtype: boolean
+        """
+        return "name" in self.__dict__
+
     @classmethod
     def set_configuration(cls, config):
         """Set the run-time configuration for ImageInstances and derived classes
@@ -814,13 +1178,11 @@ class ImageInstance(object):
 
         :rtype: ImageInstance
         """
-        the_name = self.name.clone(kind)        
-        the_name.apply_convert(kind)
+        the_name = self.name.set_kind(kind).apply_convert(kind)
         return ImageInstance(image_name = the_name, image_handle = self._image_handle.convert(kind))
     
     def crop(self, size, offset = (0,0), kind = None):
-        the_name = self.name.clone()
-        the_name.apply_crop(size, offset, kind)
+        the_name = self.name.apply_crop(size, offset, kind)
         handle = self._cache.get(the_name)
         if handle is not None:
             return handle
@@ -829,19 +1191,48 @@ class ImageInstance(object):
             handle = handle.convert(kind)
         return ImageInstance(image_name = the_name, image_handle = handle)
 
-    def resize(self, size, kind = None):
-        the_name = self.name.clone()
-        the_name.apply_resize(size, kind = kind)
+    def rotate(self, degrees, mirror = False):
+        """Returns a new ImageInstance holding a rotated, and optionally mirrored, copy of this image
+
+        :param degrees: Clockwise rotation in degrees
+        :type degrees: real
+        :param mirror: Whether to mirror the image left to right before rotating it
+        :type mirror: boolean
+        :rtype: ImageInstance
+        """
+        the_name = self.name.apply_rotate(degrees, mirror)
+        instance = self._cache.get(the_name)
+        if instance is not None:
+            return instance
+        return ImageInstance(image_name = the_name, image_handle = self._image_handle.rotate(degrees, mirror))
+
+    def scale(self, size, quality = None):
+        """Returns a new ImageInstance holding a copy of this image scaled to exactly the given size
+
+        :param size: Size of the copy
+        :type size: tuple (x_size, y_size)
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``
+        :type quality: string or None
+        :rtype: ImageInstance
+        """
+        the_name = self.name.apply_scale(size, quality = quality)
+        instance = self._cache.get(the_name)
+        if instance is not None:
+            return instance
+        return ImageInstance(image_name = the_name, image_handle = self._image_handle.scale(size, the_name.quality()))
+
+    def resize(self, size, kind = None, quality = None):
+        the_name = self.name.apply_resize(size, kind = kind, quality = quality)
         instance = self._cache.get(the_name)
         if instance is not None:
             return instance
-        instance = ImageInstance(image_name = the_name, image_handle = self._image_handle.resize(size))
+        instance = ImageInstance(image_name = the_name, image_handle = self._image_handle.resize(size, the_name.quality()))
         if kind is not None:
             instance = instance.convert(kind)
         return instance
 
 
-    def thumbnail(self, size, options = None, kind = None):
+    def thumbnail(self, size, options = None, kind = None, quality = None):
         """
         Returns a new ImageInstance that contains a thumbnail image of this image.
 
@@ -859,19 +1250,28 @@ class ImageInstance(object):
         :type options: dict
         :param kind: Wnad image format to create the thumbnail in
         :type kind: string
+        :param quality: Resampling tier, one of ``fast``, ``balanced``, ``best``. Defaults to the system configuration.
+        :type quality: string or None
         """
-        the_name = self.name.clone()
         if options is None:
             options = {"liquid": True, "equalize" : True, "sharpen": True}
-        the_name.apply_thumbnail(size, kind, **options)
+        the_name = self.name.apply_thumbnail(size, kind, quality = quality, **options)
         instance = self._cache.get(the_name)
         if instance is not None:
             return instance
-        handle = self._image_handle.thumbnail(the_name.size(), the_name.image_kind(), **options)
+        options = dict(options, liquid = the_name._liquid)
+        handle = self._thumbnail_source(the_name.size()).thumbnail(the_name.size(), the_name.image_kind(), the_name.quality(), **options)
         if kind is not None:
             handle =  handle.convert(kind)
         return ImageInstance(image_name = the_name, image_handle = handle)
     
+    def _thumbnail_source(self, size):
+        """The handle from which a thumbnail that fits ``size`` should be made
+
+        :rtype: ImageHandle
+        """
+        return self._image_handle
+
     def get_name(self):
         """Return the ImageName object for this instance.
 
@@ -924,7 +1324,7 @@ class ImageInstance(object):
 
         :rtype: string
         """
-        return self.get_image_handle()._image().mimetype
+        return self.get_image_handle().mimetype()
 
     def as_bytes(self):
         return self.get_image_handle().bytes()
@@ -949,19 +1349,52 @@ class ImageInstance(object):
         
         if name.is_metadata():
             return self.get_image_handle().metadata()
+
+        if len(name.derivations()) > 1 or name.is_crop() or name.is_rotate() or name.is_scale():
+            return self._apply_derivations(name)
         
         if name.is_thumbnail():
             options = {"liquid": name._liquid, "equalize" : name._equalise, "sharpen": name._sharpen}
-            return self.thumbnail(name.size(), options)
+            return self.thumbnail(name.size(), options, quality = name.quality())
         
         if name.is_resize():
-            return self.resize(name._image_size, kind = name.image_kind())
+            return self.resize(name._image_size, kind = name.image_kind(), quality = name.quality())
 
         if name.image_kind() != self.kind():
             return self.convert(name.image_kind())
 
         raise RepositoryError("Consistency error in name {}".format(name))
 
+    def _apply_derivations(self, name):
+        """Apply the derivation steps of a name one after another, each yielding an intermediate image
+
+        :param name: Image name holding a chain of crop, size, scale, rotate and convert operations
+        :type name: ImageName
+        :rtype: ImageInstance
+        :raises: RepositoryFailure
+        """
+        image = self
+        for operation, parameters in name.derivations():
+            if operation == "crop":
+                image = image.crop((int(parameters[0]), int(parameters[1])), (int(parameters[2]), int(parameters[3])))
+            elif operation == "size":
+                quality = parameters[2] if len(parameters) > 2 else "best"
+                image = image.resize((int(parameters[0]), int(parameters[1])), quality = quality)
+            elif operation == "scale":
+                quality = parameters[2] if len(parameters) > 2 else "best"
+                image = image.scale((int(parameters[0]), int(parameters[1])), quality = quality)
+            elif operation == "rotate":
+                image = image.rotate(float(parameters[0]), mirror = len(parameters) > 1 and parameters[1] == "m")
+            elif operation == "convert":
+                image = image.convert(parameters[0])
+            else:
+                raise RepositoryFailure("Operation {} cannot be chained in {}".format(operation, name), 400)
+            if image is None or image.get_image_handle() is None:
+                raise RepositoryFailure("Derivation {} fails for {}".format(operation, name))
+        if name.image_kind() != image.name.image_kind():
+            image = image.convert(name.image_kind())
+        return image
+
     
     def __str__(self):
         the_string = "Name : {}\n".format(self.name)
@@ -969,6 +1402,8 @@ class ImageInstance(object):
         the_string += "Handle : {}".format(self._image_handle)
         return the_string
     
+Metrics.gauge("instances.live", lambda: len(ImageInstance._image_instances))
+
 class BaseImageInstance(ImageInstance):
     """The image instance from which all the derived images are created
 
@@ -982,6 +1417,7 @@ class BaseImageInstance(ImageInstance):
     """
 
     master_format = "miff"
+    _original_handle = None    # Handle of the original image, set by OriginalImage.baseimage()
 
 
     def __new__(klass, image_name, image_handle, *args, **kwargs):
@@ -995,6 +1431,9 @@ class BaseImageInstance(ImageInstance):
         return super(BaseImageInstance, klass).__new__(klass, image_name, image_handle, *args, **kwargs)
     
     def __init__(self, image_name, image_handle):
+        if self._live():
+            super(BaseImageInstance, self).__init__(image_handle = image_handle)
+            return
         # Currently this is where the cannonical name is created. So we must do this
         # before we call the super constructor.
         if image_name is None:
@@ -1021,6 +1460,18 @@ class BaseImageInstance(ImageInstance):
         """
         return image_handle.md5()
                 
+    def _thumbnail_source(self, size):
+        """Use the preview embedded in the original image, where configured and where it will serve
+
+        :rtype: ImageHandle
+        """
+        if self._original_handle is not None and self._configuration.thumbnail_use_embedded_preview:
+            preview = self._original_handle.embedded_preview(size, self._configuration.thumbnail_preview_aspect_tolerance)
+            if preview is not None:
+                logger.debug("Thumbnail of {} made from embedded preview".format(self.name))
+                return preview
+        return self._image_handle
+
     def get_base_name(self):
         """
         Return the base name component for this image.
@@ -1094,6 +1545,9 @@ class OriginalImage(ImageInstance):
         :param full_name: Whether the provided name has already been turned into a cannonical name
         :type full_name: boolean
         """        
+        if self._live():
+            ImageInstance.__init__(self, image_handle = image_handle, kind = kind)
+            return
         super(OriginalImage, self).__init__(image_name, image_handle)
 
         self._base_image = None
@@ -1102,8 +1556,7 @@ class OriginalImage(ImageInstance):
             self.baseimage()
             base, ext = os.path.splitext(image_name.image_name())            
             new_name = ImageName(self._base_image.name.base_name(), kind = ext[1:])
-            new_name.make_original(str(new_name))
-            image_name = new_name
+            image_name = new_name.make_original(str(new_name))
             
         self.name = image_name
 
@@ -1136,8 +1589,7 @@ class OriginalImage(ImageInstance):
         """
         handle = ImageHandle.from_file(filename)
         base, name = os.path.split(filename)
-        image_name = ImageName.from_safe(name)
-        image_name.make_original(name)
+        image_name = ImageName.from_safe(name).make_original(name)
         return cls(image_name = image_name, image_handle = handle, full_name = False )
 
     @classmethod
@@ -1199,20 +1651,51 @@ class OriginalImage(ImageInstance):
 
         BaseImages have no meta-data, and may be stored in a universal format.
         They are otherwise identical in content to the OriginalImage
+
+        When the decoded image cache is enabled, base images for cannonical names are held there as
+        pixel caches, and are not decoded again while they remain in it.
         """
+        if self._base_image is not None and not self._base_image.get_image_handle().is_loadable():
+            # The base image was only held in an evicted pixel cache
+            self._base_image._image_handle = self._base_handle(full_name)
         if self._base_image is None:
-            self.get_image_handle()._get_image()
-            if self._configuration.cannonical_format_used:
-                handle = self._image_handle.convert(self._configuration.cannonical_format)
-                handle.strip()                     # We do not let metadata leak into derived images.
-            else:
-                handle = self._image_handle.stripped()
+            handle = self._base_handle(full_name)
             if full_name:
                 self._base_image = BaseImageInstance.from_image(name = ImageName(self.name.base_name(), self.name.image_kind()), image = handle)
             else:
                 self._base_image = BaseImageInstance.from_image(name = None, image = handle)
+            self._base_image._original_handle = self._image_handle
         return self._base_image
         
+    def _base_handle(self, use_decoded_cache = False):
+        """Create the handle holding the base image
+
+        :param use_decoded_cache: Whether the decoded image cache may be used, only valid with cannonical names
+        :type use_decoded_cache: boolean
+        :rtype: ImageHandle
+        """
+        if self._configuration.cannonical_format_used:
+            kind = self._configuration.cannonical_format
+        else:
+            kind = self._kind
+        use_decoded_cache = use_decoded_cache and self._cache is not None
+        if use_decoded_cache:
+            handle = self._cache.get_decoded(self.name.base_name(), kind)
+            if handle is not None:
+                return handle
+
+        # The original is not decoded here.  A lossless strip works from its encoded bytes, as do embedded previews
+        # used for thumbnails, and the conversion or backend strip otherwise needed decodes it when it runs.
+        if self._configuration.cannonical_format_used:
+            handle = self._image_handle.convert(self._configuration.cannonical_format)
+            handle.strip()                     # We do not let metadata leak into derived images.
+        else:
+            handle = self._image_handle.stripped()
+
+        if use_decoded_cache and self._cache.add_decoded(self.name.base_name(), handle):
+            handle.weaken_liveness()           # Later derivations map the pixel cache rather than hold a copy
+        return handle
+
     # Metadata is never stored in derived images.  We extract it here and nowhere else.
         
     def _get_metadata(self):
@@ -0,0 +1,164 @@
+"""
+Lossless JPEG Transforms
+------------------------
+
+Crop, rotate and flip JPEG images in the DCT domain, without decoding and re-encoding them.
+
+A JPEG image is a grid of iMCUs (interleaved minimum coded units, 8 or 16 pixels square depending upon the chroma
+subsampling), each compressed independently of the pixels around it.  Crops whose top left corner lies on the iMCU
+grid, and rotations and flips of images whose dimensions are whole iMCUs, can be performed by rearranging the
+compressed blocks.  There is no generation loss, and the cost is that of entropy coding rather than of a full
+decode, resample and encode, so region extraction from large JPEGs becomes bound by I/O rather than CPU.
+
+The transforms are performed by ``jpegtran`` (from libjpeg or libjpeg-turbo), which must be installed for them
+to be used.  Every function returns None when the transform cannot be done losslessly, or ``jpegtran`` is not
+available, and the caller falls back to Wand.
+"""
+
+import os
+import struct
+import logging
+import subprocess
+import cStringIO
+
+import ImageHeaders
+
+logger = logging.getLogger("image_repository")
+
+_available = {}    # jpegtran path : whether it can be run
+
+
+def available(jpegtran_path):
+    """Whether the ``jpegtran`` at the given path can be run
+
+    :param jpegtran_path: Path to, or name on ``PATH`` of, the ``jpegtran`` executable
+    :type jpegtran_path: string
+    :rtype: boolean
+    """
+    if jpegtran_path not in _available:
+        try:
+            with open(os.devnull, 'wb') as null:
+                process = subprocess.Popen([jpegtran_path, "-copy", "none"], stdin = subprocess.PIPE,
+                                           stdout = null, stderr = null)
+                process.communicate("")
+            _available[jpegtran_path] = True
+        except OSError:
+            logger.info("jpegtran not found at {}, lossless JPEG transforms are disabled".format(jpegtran_path))
+            _available[jpegtran_path] = False
+    return _available[jpegtran_path]
+
+
+def imcu_size(the_bytes):
+    """The dimensions of an iMCU of a JPEG image, read from its frame header
+
+    :param the_bytes: The encoded image
+    :type the_bytes: bytes
+    :rtype: tuple (x_size, y_size) or None
+    """
+    stream = cStringIO.StringIO(the_bytes)
+    if stream.read(2) != '\xff\xd8':
+        return None
+    try:
+        while True:
+            byte = stream.read(1)
+            while byte and byte != '\xff':
+                byte = stream.read(1)
+            while byte == '\xff':
+                byte = stream.read(1)
+            if not byte:
+                return None
+            marker = ord(byte)
+            if marker in (0xD9, 0xDA):
+                return None
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+                continue
+            length = struct.unpack(">H", stream.read(2))[0]
+            if marker in ImageHeaders.jpeg_sof_markers:
+                frame = stream.read(length - 2)
+                components = ord(frame[5])
+                if components == 1:
+                    return 8, 8      # Greyscale images are never subsampled
+                sampling = [ord(frame[6 + 3 * index + 1]) for index in range(components)]
+                return 8 * max(factor >> 4 for factor in sampling), 8 * max(factor & 0x0F for factor in sampling)
+            stream.seek(length - 2, 1)
+    except (struct.error, IndexError):
+        return None
+
+
+def _run(jpegtran_path, arguments, the_bytes):
+    if not available(jpegtran_path):
+        return None
+    try:
+        process = subprocess.Popen([jpegtran_path, "-copy", "none"] + arguments, stdin = subprocess.PIPE,
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        output, errors = process.communicate(the_bytes)
+    except OSError:
+        logger.exception("jpegtran {} fails to run".format(" ".join(arguments)))
+        return None
+    if process.returncode != 0 or len(output) == 0:
+        logger.debug("jpegtran {} declines: {}".format(" ".join(arguments), errors.strip()))
+        return None
+    return output
+
+
+def crop(jpegtran_path, the_bytes, x_size, y_size, x_offset, y_offset, snap = False):
+    """Crop a JPEG image without re-encoding it
+
+    The region is clamped to the image, as Wand would.  The right and bottom edges of the region may lie anywhere,
+    but the top left corner must lie on the iMCU grid.  If it does not, and ``snap`` is set, the corner is moved up
+    and left to the grid, and the region enlarged to still include everything requested.
+
+    :param jpegtran_path: Path to the ``jpegtran`` executable
+    :type jpegtran_path: string
+    :param the_bytes: The encoded JPEG image
+    :type the_bytes: bytes
+    :param snap: Whether a corner off the iMCU grid may be snapped to it
+    :type snap: boolean
+    :rtype: bytes or None
+    """
+    header = ImageHeaders.probe_bytes(the_bytes)
+    block = imcu_size(the_bytes)
+    if header is None or header.kind != "JPEG" or block is None:
+        return None
+    x_offset = min(x_offset, header.width)
+    y_offset = min(y_offset, header.height)
+    x_size = min(x_size, header.width - x_offset)
+    y_size = min(y_size, header.height - y_offset)
+    if x_size <= 0 or y_size <= 0:
+        return None
+    x_snap = x_offset % block[0]
+    y_snap = y_offset % block[1]
+    if (x_snap or y_snap) and not snap:
+        return None
+    geometry = "{}x{}+{}+{}".format(x_size + x_snap, y_size + y_snap, x_offset - x_snap, y_offset - y_snap)
+    return _run(jpegtran_path, ["-crop", geometry], the_bytes)
+
+
+def transform(jpegtran_path, the_bytes, rotate = 0, mirror = False):
+    """Rotate and/or mirror a JPEG image without re-encoding it
+
+    Only images whose dimensions are whole iMCUs can be transformed exactly, others return None.
+
+    :param jpegtran_path: Path to the ``jpegtran`` executable
+    :type jpegtran_path: string
+    :param the_bytes: The encoded JPEG image
+    :type the_bytes: bytes
+    :param rotate: Clockwise rotation in degrees, one of 0, 90, 180, 270
+    :type rotate: integer
+    :param mirror: Whether to mirror the image left to right before rotating it
+    :type mirror: boolean
+    :rtype: bytes or None
+    """
+    rotate = rotate % 360
+    if rotate not in (0, 90, 180, 270):
+        return None
+    arguments = ["-perfect"]
+    if mirror:
+        # A mirror followed by a rotation is a single transform in jpegtran's vocabulary
+        arguments += {0 : ["-flip", "horizontal"], 90 : ["-transverse"],
+                      180 : ["-flip", "vertical"], 270 : ["-transpose"]}[rotate]
+    elif rotate != 0:
+        arguments += ["-rotate", str(rotate)]
+    else:
+        return the_bytes
+    return _run(jpegtran_path, arguments, the_bytes)
@@ -0,0 +1,206 @@
+"""
+Lossless Metadata Stripping
+---------------------------
+
+Removal of metadata from encoded images by rewriting the container, without decoding the image.
+
+Stripping with Wand decodes the image and encodes it again, which is slow and, for JPEG, loses quality.  For the
+common container formats the metadata lives in segments, chunks or tags that are separate from the compressed
+image data, and can simply be dropped:
+
+* JPEG  APP1 to APP15 segments (EXIF, XMP, IPTC, Photoshop, ...) and comments are removed.  APP0 (JFIF) and
+  the Adobe APP14 segment, which decoders need to interpret the colour transform, are kept.
+* PNG   Text, EXIF and time chunks are removed.
+* TIFF  Descriptive tags, and the EXIF, GPS, XMP, IPTC and Photoshop blocks, are removed from every image in
+  the file.  The space they occupied is zeroed so that all offsets within the file remain valid.
+
+ICC colour profiles are removed unless asked to be kept, matching Wand's ``strip()``.  The compressed image data
+is never touched.  Anything that cannot be handled returns None, and the caller falls back to Wand.
+"""
+
+import struct
+import logging
+
+logger = logging.getLogger("image_repository")
+
+
+# JPEG markers that carry no length field
+_jpeg_standalone = set([0x01] + range(0xD0, 0xD8))
+_jpeg_icc_signature = "ICC_PROFILE\x00"
+
+
+def _strip_jpeg(the_bytes, keep_icc):
+    output = ['\xff\xd8']
+    position = 2
+    length = len(the_bytes)
+    while position < length:
+        if the_bytes[position] != '\xff':
+            return None
+        marker_start = position
+        while position < length and the_bytes[position] == '\xff':   # Fill bytes
+            position += 1
+        if position >= length:
+            return None
+        marker = ord(the_bytes[position])
+        position += 1
+        if marker in _jpeg_standalone:
+            output.append(the_bytes[marker_start:position])
+            continue
+        if marker == 0xD9:      # EOI without a scan
+            return None
+        if position + 2 > length:
+            return None
+        segment_length = struct.unpack(">H", the_bytes[position:position+2])[0]
+        segment_end = position + segment_length
+        if segment_length < 2 or segment_end > length:
+            return None
+        if marker == 0xDA:      # Start of scan, the rest of the file is entropy coded data and is kept as is
+            output.append(the_bytes[marker_start:])
+            return "".join(output)
+        payload = the_bytes[position+2:segment_end]
+        keep = True
+        if marker == 0xFE:
+            keep = False
+        elif 0xE1 <= marker <= 0xEF:
+            keep = ((marker == 0xEE and payload.startswith("Adobe")) or
+                    (keep_icc and marker == 0xE2 and payload.startswith(_jpeg_icc_signature)))
+        if keep:
+            output.append(the_bytes[marker_start:segment_end])
+        position = segment_end
+    return None
+
+
+_png_signature = '\x89PNG\r\n\x1a\n'
+_png_metadata_chunks = set(['tEXt', 'iTXt', 'zTXt', 'eXIf', 'tIME'])
+
+
+def _strip_png(the_bytes, keep_icc):
+    output = [_png_signature]
+    position = len(_png_signature)
+    length = len(the_bytes)
+    while position + 12 <= length:
+        chunk_length = struct.unpack(">I", the_bytes[position:position+4])[0]
+        chunk_type = the_bytes[position+4:position+8]
+        chunk_end = position + 12 + chunk_length
+        if chunk_end > length:
+            return None
+        drop = chunk_type in _png_metadata_chunks or (chunk_type == 'iCCP' and not keep_icc)
+        if not drop:
+            output.append(the_bytes[position:chunk_end])
+        if chunk_type == 'IEND':
+            return "".join(output)
+        position = chunk_end
+    return None
+
+
+_tiff_type_sizes = {1 : 1, 2 : 1, 3 : 2, 4 : 4, 5 : 8, 6 : 1, 7 : 1, 8 : 2, 9 : 4, 10 : 8, 11 : 4, 12 : 8, 13 : 4}
+# ImageDescription, Make, Model, Software, DateTime, Artist, HostComputer, XMP, Copyright, IPTC, Photoshop, ImageSourceData
+_tiff_metadata_tags = set([270, 271, 272, 305, 306, 315, 316, 700, 33432, 33723, 34377, 37724])
+# EXIF, GPS and Interoperability IFDs, whose contents are removed entirely
+_tiff_metadata_ifd_tags = set([34665, 34853, 40965])
+_tiff_icc_tag = 34675
+
+
+class _Tiff(object):
+    """A TIFF file being rewritten in place"""
+
+    def __init__(self, the_bytes):
+        self.data = bytearray(the_bytes)
+        self.endian = "<" if the_bytes[:2] == "II" else ">"
+
+    def unpack(self, form, offset):
+        size = struct.calcsize(self.endian + form)
+        if offset < 0 or offset + size > len(self.data):
+            raise ValueError("TIFF offset out of range")
+        return struct.unpack(self.endian + form, bytes(self.data[offset:offset+size]))
+
+    def zero(self, offset, size):
+        if offset < 0 or offset + size > len(self.data):
+            raise ValueError("TIFF offset out of range")
+        self.data[offset:offset+size] = bytearray(size)
+
+    def entries(self, offset):
+        """:rtype: list of (tag, type, count, raw entry, offset of the value or None if held inline, value size)"""
+        count = self.unpack("H", offset)[0]
+        result = []
+        for index in range(count):
+            entry_offset = offset + 2 + 12 * index
+            tag, field_type, value_count = self.unpack("HHI", entry_offset)
+            size = _tiff_type_sizes.get(field_type, 1) * value_count
+            value_offset = self.unpack("I", entry_offset + 8)[0] if size > 4 else None
+            result.append((tag, field_type, value_count, bytes(self.data[entry_offset:entry_offset+12]), value_offset, size))
+        return result
+
+    def zero_ifd(self, offset, depth = 0):
+        """Zero an IFD, everything it refers to, and any IFDs nested within it"""
+        if depth > 4:
+            raise ValueError("TIFF IFDs nested too deeply")
+        entries = self.entries(offset)
+        for index, (tag, field_type, value_count, raw, value_offset, size) in enumerate(entries):
+            if tag in _tiff_metadata_ifd_tags:
+                self.zero_ifd(self.unpack("I", offset + 2 + 12 * index + 8)[0], depth + 1)
+            if value_offset is not None:
+                self.zero(value_offset, size)
+        self.zero(offset, 2 + 12 * len(entries) + 4)
+
+    def strip_ifd(self, offset, keep_icc):
+        """Remove the metadata entries from an IFD, compacting the entries that remain
+
+        :rtype: integer offset of the next IFD
+        """
+        entries = self.entries(offset)
+        next_ifd = self.unpack("I", offset + 2 + 12 * len(entries))[0]
+        kept = []
+        for index, (tag, field_type, value_count, raw, value_offset, size) in enumerate(entries):
+            if tag in _tiff_metadata_ifd_tags:
+                self.zero_ifd(self.unpack("I", offset + 2 + 12 * index + 8)[0], 1)
+            elif tag in _tiff_metadata_tags or (tag == _tiff_icc_tag and not keep_icc):
+                if value_offset is not None:
+                    self.zero(value_offset, size)
+            else:
+                kept.append(raw)
+        table = struct.pack(self.endian + "H", len(kept)) + "".join(kept) + struct.pack(self.endian + "I", next_ifd)
+        self.zero(offset, 2 + 12 * len(entries) + 4)
+        self.data[offset:offset+len(table)] = table
+        return next_ifd
+
+
+def _strip_tiff(the_bytes, keep_icc):
+    tiff = _Tiff(the_bytes)
+    offset = tiff.unpack("I", 4)[0]
+    visited = set()
+    while offset != 0:
+        if offset in visited:
+            return None
+        visited.add(offset)
+        offset = tiff.strip_ifd(offset, keep_icc)
+    return bytes(tiff.data)
+
+
+_signatures = (
+    ('\xff\xd8', _strip_jpeg),
+    (_png_signature, _strip_png),
+    ('II*\x00', _strip_tiff),
+    ('MM\x00*', _strip_tiff),
+)
+
+
+def strip_bytes(the_bytes, keep_icc = False):
+    """Remove the metadata from an encoded image without decoding it
+
+    :param the_bytes: The encoded image
+    :type the_bytes: bytes
+    :param keep_icc: Whether to keep any ICC colour profile
+    :type keep_icc: boolean
+    :rtype: bytes, or None if the format is not handled or the image is malformed
+    """
+    if the_bytes is None:
+        return None
+    for signature, strip in _signatures:
+        if the_bytes.startswith(signature):
+            try:
+                return strip(the_bytes, keep_icc)
+            except (struct.error, ValueError, IndexError) as ex:
+                logger.debug("Lossless metadata strip fails: {}".format(ex))
+                return None
+    return None
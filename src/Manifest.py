@@ -0,0 +1,638 @@
+"""
+Manifest
+--------
+
+A manifest of the objects of a Swift container, kept in the container, so that a new server learns the contents
+of the container without listing it or reading the metadata of every object.
+
+For each object the manifest records:
+
+* size = Size of the object in bytes
+* content_type = The content type of the object
+* retain_until = Time until which the object must be retained, seconds since the epoch, or None
+
+The base name of the image a derived object is made from is found from its name when needed.  The objects are held
+in columns, see ``ManifestEntries``, rather than as an entry per object.
+
+Changes are recorded as they are made, and written in batches by a background thread as log objects.  Once enough
+log objects have been written the manifest is compacted, written whole as a snapshot that records the names of the
+log objects it includes, and the included log objects are removed once they are older than the log horizon.
+
+Log objects are named by the time they are written, by the clock of the server writing them, so their names do not
+show the order in which they appear in the container: a server whose clock runs behind, an upload that is slow, or
+a listing of the container that is late, all make a log object appear after others whose names follow it.  Each
+server therefore remembers the names of the log objects it has applied, rather than a position among them, and
+applies every log object it has not yet applied, whatever its name.  Log objects are only removed once they have
+been applied by the server compacting the manifest, and are older than the horizon, by which time every server
+following the changes has seen them.  Only one server compacts the manifest at a time, holding a lease object
+created by a conditional write, which lapses if the server holding it fails.
+
+A new server reads the snapshot in one request, then lists the log objects and applies those the snapshot does not
+include.  If the number and size of the objects then differ from those of the container, objects have been written
+without the manifest, and the container is listed in full to reconcile it, reading the metadata only of objects the
+manifest did not know.
+
+The log objects also serve as a feed of the changes made by every server sharing the container.  A server following
+the feed lists the log objects every few seconds, and passes each change another server made to the cache levels, so
+that an image uploaded through one server is found by all of them within seconds.  Log objects recording an original
+image are written as soon as the background thread can write them, rather than batched.
+"""
+
+import gzip
+import json
+import time
+import uuid
+import logging
+import cStringIO
+from array import array
+from threading import RLock
+from threading import Thread
+from threading import Event
+
+import Metrics
+import ImageNames
+from Exceptions import RepositoryError
+
+logger = logging.getLogger("image_repository")
+
+# Objects of the manifest within the container
+manifest_prefix = "_manifest/"
+snapshot_object = manifest_prefix + "snapshot.json.gz"
+lease_object = manifest_prefix + "lease"
+log_prefix = manifest_prefix + "log/"
+
+version = 2
+
+_none = float("nan")    # Retention time column value for no retention time
+
+
+def is_manifest_object(name):
+    """Returns whether a Swift object is part of the manifest
+
+    :param name: Name of the object
+    :type name: string
+    :rtype: boolean
+    """
+    return name.startswith(manifest_prefix)
+
+
+def base_of(name):
+    """The base name of the image a derived object is made from, found without parsing the name
+
+    :param name: Name of the object
+    :type name: string
+    :rtype: string or None if the object is not a derived image
+    """
+    if "+" not in name or "+original(" in name:
+        return None
+    return name.split("+", 1)[0]
+
+
+def _log_name(at):
+    """The name of a log object written at a time"""
+    return "{}{:017.6f}-{}".format(log_prefix, at, uuid.uuid4().hex[:8])
+
+
+def _written_at(log_name):
+    """The time a log object was written, by the clock of the server writing it, from its name"""
+    try:
+        return float(log_name[len(log_prefix):].split("-", 1)[0])
+    except ValueError:
+        return 0.0
+
+
+def _compress(document):
+    buffer = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj = buffer, mode = 'wb') as the_file:
+        the_file.write(json.dumps(document, separators = (',', ':')))
+    return buffer.getvalue()
+
+
+def _decompress(the_bytes):
+    return json.loads(gzip.GzipFile(fileobj = cStringIO.StringIO(the_bytes)).read())
+
+
+def _key(name):
+    """Names are held as UTF-8 encoded strings"""
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+class ManifestEntries(object):
+    """The objects of a container held in columns
+
+    * names = the object names, sorted, in one string with an array of offsets into it
+    * sizes and retention times = arrays of numbers
+    * content types = an array of indexes into a table of the content types
+
+    Changes made once the columns are built are held beside them, by name, until the columns are built again.
+    """
+
+    def __init__(self, objects = ()):
+        """Build the columns
+
+        :param objects: The objects
+        :type objects: iterable of tuples (name, size, content type, retain until)
+        """
+        self._types = []
+        self._type_index = {}
+        names = []
+        sizes = array('l')
+        kinds = array('H')
+        retains = array('d')
+        for name, size, content_type, retain_until in objects:
+            names.append(_key(name))
+            sizes.append(size)
+            kinds.append(self._type(content_type))
+            retains.append(_none if retain_until is None else retain_until)
+        order = sorted(xrange(len(names)), key = names.__getitem__)
+
+        self._offsets = array('L', [0])
+        for position in order:
+            self._offsets.append(self._offsets[-1] + len(names[position]))
+        self._names = "".join(names[position] for position in order)
+        self._sizes = array('l', (sizes[position] for position in order))
+        self._kinds = array('H', (kinds[position] for position in order))
+        self._retains = array('d', (retains[position] for position in order))
+        self._count = len(order)
+        self._changes = {}    # name : (size, content type, retain until), or None if removed
+        self._length = self._count
+        self._bytes = sum(self._sizes)
+
+    def _type(self, content_type):
+        index = self._type_index.get(content_type)
+        if index is None:
+            index = len(self._types)
+            self._types.append(content_type)
+            self._type_index[content_type] = index
+        return index
+
+    def _name(self, position):
+        return self._names[self._offsets[position]:self._offsets[position + 1]]
+
+    def _position(self, name):
+        """The position of a name in the columns, or None"""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._name(low) == name:
+            return low
+        return None
+
+    def _column(self, position):
+        retain_until = self._retains[position]
+        return (self._sizes[position], self._types[self._kinds[position]], None if retain_until != retain_until else retain_until)
+
+    def get(self, name):
+        """The record of an object
+
+        :param name: Name of the object
+        :type name: string
+        :rtype: tuple (size, content type, retain until), or None
+        """
+        name = _key(name)
+        if name in self._changes:
+            return self._changes[name]
+        position = self._position(name)
+        return None if position is None else self._column(position)
+
+    def put(self, name, size, content_type, retain_until = None):
+        name = _key(name)
+        self._forget(name)
+        self._changes[name] = (size, content_type, retain_until)
+        self._length += 1
+        self._bytes += size
+
+    def delete(self, name):
+        name = _key(name)
+        self._forget(name)
+        self._changes[name] = None
+
+    def retain(self, name, retain_until):
+        name = _key(name)
+        entry = self.get(name)
+        if entry is not None:
+            self._changes[name] = (entry[0], entry[1], retain_until)
+
+    def _forget(self, name):
+        entry = self.get(name)
+        if entry is not None:
+            self._length -= 1
+            self._bytes -= entry[0]
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def total_size(self):
+        """:rtype: integer sum of the sizes of the objects"""
+        return self._bytes
+
+    def changes(self):
+        """:rtype: integer count of the changes held beside the columns"""
+        return len(self._changes)
+
+    def iteritems(self):
+        """The objects
+
+        :rtype: iterator of tuples (name, (size, content type, retain until))
+        """
+        for position in xrange(self._count):
+            name = self._name(position)
+            if name not in self._changes:
+                yield name, self._column(position)
+        for name, entry in self._changes.items():
+            if entry is not None:
+                yield name, entry
+
+    def rebuilt(self):
+        """The objects, with the changes built into the columns
+
+        :rtype: ManifestEntries
+        """
+        return ManifestEntries((name, entry[0], entry[1], entry[2]) for name, entry in self.iteritems())
+
+    def document(self):
+        """The objects as a JSON document, of columns
+
+        :rtype: dict
+        """
+        names = []
+        sizes = []
+        kinds = []
+        retains = []
+        types = []
+        type_index = {}
+        for name, (size, content_type, retain_until) in self.iteritems():
+            names.append(name)
+            sizes.append(size)
+            if content_type not in type_index:
+                type_index[content_type] = len(types)
+                types.append(content_type)
+            kinds.append(type_index[content_type])
+            retains.append(retain_until)
+        return {"names" : names, "sizes" : sizes, "types" : types, "kinds" : kinds, "retain" : retains}
+
+    @classmethod
+    def from_document(cls, document):
+        """Build the columns from a JSON document made by ``document``
+
+        :rtype: ManifestEntries
+        """
+        types = document["types"]
+        return cls((name, size, types[kind], retain_until) for name, size, kind, retain_until in
+                   zip(document["names"], document["sizes"], document["kinds"], document["retain"]))
+
+
+class ContainerManifest(object):
+    """The manifest of the objects of one Swift container
+    """
+
+    def __init__(self, store, configuration):
+        """Make the manifest of a store, which is read by ``load``
+
+        :param store: The store of the container
+        :type store: Stores.SwiftImageStore
+        :param configuration: Configuration of the store
+        :type configuration: Configuration.SwiftStoreConfig
+        """
+        self._store = store
+        self._configuration = configuration
+        self._lock = RLock()
+        self._entries = ManifestEntries()
+        self._pending = []      # changes not yet written, [operation, name, value]
+        self._applied = {}      # names of the log objects applied, or written by this server : time written
+        self._logs = 0          # log objects written since the last snapshot
+        self._loaded = False
+        self._writer = None
+        self._wake = Event()    # set to have the writer write the pending changes at once
+        self._listeners = []    # functions called with each change made by other servers
+        self._poller = None
+        self._polled = None     # when the log objects were last listed
+
+    def loaded(self):
+        """:rtype: boolean"""
+        return self._loaded
+
+    def load(self):
+        """Read the manifest from the container, reconciling it with the container if needed
+
+        :raises: RepositoryError
+        """
+        started = time.time()
+        headers, manifest_objects = self._store.list_objects(prefix = manifest_prefix)
+        the_bytes = self._store.get_object(snapshot_object)
+        if the_bytes is not None:
+            try:
+                snapshot = _decompress(the_bytes)
+                if snapshot.get("version") == version:
+                    self._entries = ManifestEntries.from_document(snapshot["entries"])
+                    self._applied = dict((_key(name), _written_at(name)) for name in snapshot["applied"])
+                elif snapshot.get("version") == 1:
+                    # Snapshots of version 1 include the log objects up to a marker
+                    self._entries = ManifestEntries((name, entry[0], entry[1], entry[2])
+                                                    for name, entry in snapshot["entries"].iteritems())
+                    self._applied = dict((_key(element["name"]), _written_at(element["name"])) for element in manifest_objects
+                                         if element["name"].startswith(log_prefix) and element["name"] <= snapshot["marker"])
+                else:
+                    logger.warning("Manifest of {} has version {}, rebuilding".format(self._store._store, snapshot.get("version")))
+            except (IOError, ValueError, KeyError, TypeError):
+                logger.exception("Manifest of {} is unreadable, rebuilding".format(self._store._store))
+                self._entries = ManifestEntries()
+                self._applied = {}
+
+        self._apply_logs(manifest_objects, notify = False)
+        self._polled = time.time()
+        if not self._consistent(headers, manifest_objects):
+            self._reconcile()
+        self._loaded = True
+        logger.info("Manifest of {} loaded with {} objects in {:.1f} seconds".format(self._store._store, len(self._entries),
+                                                                                      time.time() - started))
+        self._start_writer()
+
+    def _apply_logs(self, manifest_objects, notify = True):
+        """Apply the log objects not yet applied, in the order of their names
+
+        :param manifest_objects: Listing of objects of the manifest, holding the log objects
+        :type manifest_objects: list of dicts
+        :param notify: Whether to pass the changes to the listeners
+        :type notify: boolean
+        """
+        logs = sorted(_key(element["name"]) for element in manifest_objects if element["name"].startswith(log_prefix))
+        for name in logs:
+            if name in self._applied:
+                continue
+            the_bytes = self._store.get_object(name)
+            if the_bytes is None:
+                continue
+            try:
+                changes = _decompress(the_bytes)
+            except (IOError, ValueError):
+                logger.exception("Manifest log {} is unreadable".format(name))
+                continue
+            with self._lock:
+                for operation, the_name, value in changes:
+                    self._apply(operation, the_name, value)
+                self._applied[name] = _written_at(name)
+                listeners = list(self._listeners) if notify else []
+            for operation, the_name, value in changes:
+                for listener in listeners:
+                    listener(operation, the_name, value)
+            if notify:
+                Metrics.increment("manifest.changes_followed", len(changes))
+        # Names of log objects since removed are forgotten, other than those that may not yet be listed
+        listed = set(logs)
+        horizon = time.time() - self._configuration.manifest_log_horizon
+        with self._lock:
+            self._applied = dict((name, written) for name, written in self._applied.iteritems()
+                                 if name in listed or written > horizon)
+
+    def _apply(self, operation, name, value):
+        if operation == "put":
+            self._entries.put(name, value[0], value[1], value[2])
+        elif operation == "delete":
+            self._entries.delete(name)
+        elif operation == "retain":
+            self._entries.retain(name, value)
+
+    def _consistent(self, headers, manifest_objects):
+        """Whether the manifest holds as many objects, of the same total size, as the container"""
+        manifest_bytes = sum(element["bytes"] for element in manifest_objects)
+        try:
+            count = int(headers["x-container-object-count"]) - len(manifest_objects)
+            size = int(headers["x-container-bytes-used"]) - manifest_bytes
+        except (KeyError, ValueError):
+            return False
+        with self._lock:
+            return count == len(self._entries) and size == self._entries.total_size()
+
+    def _reconcile(self):
+        """List the container in full, keeping what the manifest knows of the objects it still holds"""
+        logger.info("Manifest of {} differs from the container, listing it".format(self._store._store))
+        headers, listing = self._store.list_objects()
+        objects = []
+        unknown = {}
+        for element in listing:
+            name = element["name"]
+            if is_manifest_object(name):
+                continue
+            known = self._entries.get(name)
+            if known is None:
+                unknown[name] = len(objects)
+            objects.append([name, element["bytes"], element["content_type"], known[2] if known is not None else None])
+        if len(unknown) > 0:
+            for name, meta in self._store.find_metadata(unknown.keys(), ['lifetime']):
+                try:
+                    objects[unknown[name]][3] = float(meta['lifetime'])
+                except (KeyError, ValueError):
+                    continue
+        with self._lock:
+            self._entries = ManifestEntries(objects)
+        self.compact()
+
+    def _start_writer(self):
+        """Start the thread writing the changes, and compacting the manifest"""
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._writer = Thread(target = self._write_changes, name = "manifest")
+            self._writer.daemon = True
+        self._writer.start()
+
+    def _write_changes(self):
+        interval = self._configuration.manifest_flush_interval
+        while True:
+            self._wake.wait(interval if interval > 0 else None)
+            self._wake.clear()
+            try:
+                self.flush()
+                if self._logs >= self._configuration.manifest_compact_after:
+                    self.compact()
+                self._settle()
+            except RepositoryError:
+                logger.exception("Manifest of {} cannot be written".format(self._store._store))
+
+    def _settle(self):
+        """Build the changes held beside the columns into them, once there are many"""
+        with self._lock:
+            if self._entries.changes() > max(10000, len(self._entries) // 10):
+                self._entries = self._entries.rebuilt()
+
+    def follow(self, listener):
+        """Follow the changes other servers make to the container
+
+        :param listener: Called with the operation, ``put``, ``delete`` or ``retain``, the name of the object and the
+                         value recorded, for each change
+        :type listener: function
+        """
+        with self._lock:
+            self._listeners.append(listener)
+        if self._poller is not None or self._configuration.manifest_poll_interval <= 0:
+            return
+        def background():
+            while True:
+                time.sleep(self._configuration.manifest_poll_interval)
+                if not self._loaded:
+                    continue
+                try:
+                    self.poll()
+                    self._settle()
+                except Exception:
+                    logger.exception("Changes to {} cannot be followed".format(self._store._store))
+        self._poller = Thread(target = background, name = "manifest-follow")
+        self._poller.daemon = True
+        self._poller.start()
+
+    def poll(self):
+        """Apply the log objects not yet applied, by listing the log objects
+
+        The log objects are few, as those older than the horizon are removed, so all of them are listed.
+
+        :raises: RepositoryError
+        """
+        now = time.time()
+        if self._polled is not None and now - self._polled > self._configuration.manifest_log_horizon:
+            logger.warning("Changes to {} not followed for {:.0f} seconds, some may have been missed".format(self._store._store,
+                                                                                                       now - self._polled))
+        headers, manifest_objects = self._store.list_objects(prefix = log_prefix)
+        self._apply_logs(manifest_objects)
+        self._polled = now
+
+    def _record(self, operation, name, value, urgent = False):
+        if is_manifest_object(name):
+            return
+        with self._lock:
+            self._apply(operation, name, value)
+            self._pending.append([operation, name, value])
+            full = urgent or len(self._pending) >= self._configuration.manifest_log_batch
+        self._start_writer()
+        if full:
+            self._wake.set()
+
+    def put(self, name, size, content_type):
+        """Record an object written to the container"""
+        self._record("put", name, [size, content_type, None], urgent = ImageNames.is_original_name(name))
+
+    def delete(self, name):
+        """Record an object removed from the container"""
+        self._record("delete", name, None, urgent = ImageNames.is_original_name(name))
+
+    def retain(self, name, retain_until):
+        """Record the time until which an object must be retained"""
+        self._record("retain", name, retain_until)
+
+    def flush(self):
+        """Write the changes not yet written as a log object
+
+        :raises: RepositoryError
+        """
+        with self._lock:
+            changes, self._pending = self._pending, []
+        if len(changes) == 0:
+            return
+        written = time.time()
+        name = _log_name(written)
+        try:
+            self._store.store_image(cStringIO.StringIO(_compress(changes)), name)
+        except RepositoryError:
+            with self._lock:
+                self._pending = changes + self._pending
+            raise
+        with self._lock:
+            self._applied[name] = written
+            self._logs += 1
+
+    def _acquire_lease(self):
+        """Take the lease to compact the manifest, unless another server holds it
+
+        A lease whose holder has not removed it in time is removed, the holder having failed.
+
+        :rtype: string identifying the lease, or None if another server holds it
+        :raises: RepositoryError
+        """
+        lease_time = self._configuration.manifest_lease_time
+        holder = uuid.uuid4().hex
+        for attempt in range(2):
+            lease = json.dumps({"holder" : holder, "expires" : time.time() + lease_time})
+            if self._store.create_object(lease_object, lease, delete_after = lease_time):
+                return holder
+            the_bytes = self._store.get_object(lease_object)
+            try:
+                expires = json.loads(the_bytes)["expires"] if the_bytes is not None else 0
+            except (ValueError, KeyError, TypeError):
+                expires = 0
+            if expires > time.time():
+                return None
+            self._store.delete_images([lease_object])
+        return None
+
+    def compact(self):
+        """Write the manifest whole as a snapshot, and remove the log objects that are included and older than the horizon
+
+        Changes not yet written, and log objects written by other servers and not yet applied, are included first.
+        Nothing is done while another server compacts the manifest.
+
+        :raises: RepositoryError
+        """
+        holder = self._acquire_lease()
+        if holder is None:
+            logger.info("Manifest of {} is being compacted by another server".format(self._store._store))
+            return
+        try:
+            self.flush()
+            self.poll()
+            with self._lock:
+                self._entries = self._entries.rebuilt()
+                applied = dict(self._applied)
+                snapshot = {"version" : version, "written" : time.time(), "applied" : sorted(applied.keys()),
+                            "entries" : self._entries.document()}
+            self._store.store_image(cStringIO.StringIO(_compress(snapshot)), snapshot_object)
+            # Log objects are kept until every server following the changes has seen them
+            horizon = time.time() - self._configuration.manifest_log_horizon
+            removable = [name for name, written in applied.iteritems() if written < horizon]
+            if len(removable) > 0:
+                self._store.delete_images(removable)
+            with self._lock:
+                self._logs = 0
+            logger.info("Manifest of {} compacted with {} objects".format(self._store._store, len(snapshot["entries"]["names"])))
+        finally:
+            self._store.delete_images([lease_object])
+
+    def listing(self):
+        """The objects of the container
+
+        :rtype: list of tuples (name, size, content type)
+        """
+        with self._lock:
+            return [(name, entry[0], entry[1]) for name, entry in self._entries.iteritems()]
+
+    def lifetimes(self, names):
+        """The retention times of objects
+
+        :param names: Names of the objects
+        :type names: iterable of strings
+        :rtype: list of pairs (name, retain until)
+        """
+        results = []
+        with self._lock:
+            for name in names:
+                entry = self._entries.get(name)
+                if entry is not None and entry[2] is not None:
+                    results.append((name, entry[2]))
+        return results
+
+    def derived(self, base_name):
+        """The objects derived from an image
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :rtype: list of strings
+        """
+        base_name = _key(base_name)
+        with self._lock:
+            return [name for name, entry in self._entries.iteritems() if base_of(name) == base_name]
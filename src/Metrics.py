@@ -0,0 +1,60 @@
+"""
+Metrics
+-------
+
+Counters of repository events, used to tune caches and derivation policies.
+
+Counters are named with dotted paths, eg ``ladder.512x512.hit``, are created on first use, and only ever
+increase while the server runs.  Gauges are values, such as the number of live objects, read when metrics are
+taken.  A snapshot of every counter and gauge is served at ``/metrics``.
+"""
+
+from threading import Lock
+from collections import defaultdict
+
+_lock = Lock()
+_counters = defaultdict(int)
+_gauges = {}
+
+
+def increment(name, amount = 1):
+    """Add to a counter
+
+    :param name: Dotted name of the counter
+    :type name: string
+    :param amount: Amount to add
+    :type amount: integer
+    """
+    with _lock:
+        _counters[name] += amount
+
+
+def value(name):
+    """:rtype: integer"""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def gauge(name, function):
+    """Register a gauge
+
+    :param name: Dotted name of the gauge
+    :type name: string
+    :param function: Returns the current value of the gauge
+    :type function: function
+    """
+    with _lock:
+        _gauges[name] = function
+
+
+def snapshot(prefix = None):
+    """The current value of every counter and gauge, or of those whose names start with ``prefix``
+
+    :rtype: dict of name : integer
+    """
+    with _lock:
+        result = dict((name, count) for name, count in _counters.iteritems() if prefix is None or name.startswith(prefix))
+        gauges = [(name, function) for name, function in _gauges.iteritems() if prefix is None or name.startswith(prefix)]
+    for name, function in gauges:
+        result[name] = function()
+    return result
@@ -0,0 +1,114 @@
+"""
+Negative Cache
+--------------
+
+A record of recent lookups that found nothing, and of derivations that failed, so that repeated requests for images
+that do not exist, or cannot be made, are answered without searching the cache hierarchy or deriving them again.
+
+Only failures that recur until the original is replaced are recorded: images not found, and derivations refused
+with a 4xx code, such as an operation the image does not allow.  Failures with a 5xx code, of the stores or of the
+server, may pass, and are never recorded.
+
+Each entry is kept for a limited time, and only so many entries are kept, the oldest being dropped first.  Entries
+are recorded against the base name of the image they concern, and are dropped when an original with that base name
+is added, here or by another server.  Entries for searches by regular expression concern no single image, and are
+dropped when any original is added.
+
+Lookups are counted in the metrics as ``negative.hit`` and ``negative.miss``, and the number of entries is the gauge
+``negative.entries``.
+"""
+
+import time
+import logging
+from threading import RLock
+from collections import OrderedDict
+
+import Metrics
+
+logger = logging.getLogger("image_repository")
+
+
+class NegativeCache(object):
+    """Recent lookups that found nothing and derivations that failed, by key
+    """
+
+    def __init__(self, configuration):
+        """
+        :param configuration: Configuration of the negative cache
+        :type configuration: Configuration.NegativeCacheConfig
+        """
+        self._enabled = configuration.enabled
+        self._max_entries = configuration.max_entries
+        self._lifetime = configuration.lifetime
+        self._error_lifetime = configuration.error_lifetime
+        self._lock = RLock()
+        self._entries = OrderedDict()    # key : (expiry, base name, http code, description), oldest first
+        self._by_base = {}               # base name : set of keys, None for searches
+        Metrics.gauge("negative.entries", lambda: len(self._entries))
+
+    def lookup(self, key):
+        """Find a recorded failure
+
+        :param key: The lookup or derivation, usually the cannonical name of an image
+        :type key: string
+        :rtype: tuple (http code, description), or None if no failure is recorded
+        """
+        if not self._enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+        if entry is None:
+            Metrics.increment("negative.miss")
+            return None
+        Metrics.increment("negative.hit")
+        return entry[2], entry[3]
+
+    def record(self, key, base_name, http_code = 404, description = None):
+        """Record a lookup that found nothing, or a derivation that failed
+
+        :param key: The lookup or derivation
+        :type key: string
+        :param base_name: Base name of the image concerned, or None for a search
+        :type base_name: string or None
+        :param http_code: The response to give, 404 for images not found, otherwise the code of the failure
+        :type http_code: integer
+        :param description: Description of the failure
+        :type description: string
+        :rtype: boolean, whether the failure is recorded, only failures with 4xx codes being recorded
+        """
+        if not self._enabled or not 400 <= http_code < 500:
+            return False
+        lifetime = self._lifetime if http_code == 404 else self._error_lifetime
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + lifetime, base_name, http_code, description)
+            self._by_base.setdefault(base_name, set()).add(key)
+            while len(self._entries) > self._max_entries:
+                self._remove(next(iter(self._entries)))
+        Metrics.increment("negative.recorded")
+        return True
+
+    def invalidate(self, base_name):
+        """Drop the failures recorded for an image, and for searches, once an original is added
+
+        :param base_name: Base name of the original added
+        :type base_name: string
+        """
+        with self._lock:
+            keys = self._by_base.pop(base_name, set()) | self._by_base.pop(None, set())
+            for key in keys:
+                self._entries.pop(key, None)
+        if len(keys) > 0:
+            Metrics.increment("negative.invalidated", len(keys))
+
+    def _remove(self, key):
+        expiry, base_name, http_code, description = self._entries.pop(key)
+        keys = self._by_base.get(base_name)
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._by_base[base_name]
@@ -0,0 +1,170 @@
+"""
+Content Negotiation
+-------------------
+
+Choice of the format and size of a delivered image from the request headers, when the request does not fix them.
+
+When no format is requested the smallest format the client accepts, and that the ImageMagick build can write, is
+chosen from the ``Accept`` header.  Modern formats (AVIF, JPEG XL, WebP) are preferred in the configured order,
+falling back to the default format.
+
+Client hints adjust the size of the delivered image:
+
+* ``DPR`` scales requested sizes, given in CSS pixels, to device pixels
+* ``Width`` gives the width in device pixels to deliver when no size is requested
+* ``Save-Data: on`` limits the device pixel ratio to 1
+
+Hinted sizes are held within the bounds on requested sizes.  Responses that depend upon these headers name them in
+``Vary``, whether or not the request carried them, so that shared caches keep them apart.
+"""
+
+import logging
+import mimetypes
+
+import wand.version
+
+logger = logging.getLogger("image_repository")
+
+# Formats that may be offered, by repository name: (ImageMagick format, mimetype)
+negotiable_formats = {
+    "avif" : ("AVIF", "image/avif"),
+    "jxl" : ("JXL", "image/jxl"),
+    "webp" : ("WEBP", "image/webp"),
+}
+
+for _kind, (_format, _mimetype) in negotiable_formats.iteritems():
+    mimetypes.add_type(_mimetype, "." + _kind)
+
+client_hint_headers = ("DPR", "Width", "Save-Data")
+
+_writable = {}    # ImageMagick format : whether the build can write it
+
+
+def writable(kind):
+    """Whether the ImageMagick build has a delegate able to write the format
+
+    :param kind: Repository format name
+    :type kind: string
+    :rtype: boolean
+    """
+    magick_format = negotiable_formats[kind][0] if kind in negotiable_formats else kind.upper()
+    if magick_format not in _writable:
+        try:
+            _writable[magick_format] = len(wand.version.formats(magick_format)) > 0
+        except Exception:
+            _writable[magick_format] = False
+        if not _writable[magick_format]:
+            logger.info("ImageMagick cannot write {}, it will not be offered".format(magick_format))
+    return _writable[magick_format]
+
+
+def available_formats(preferences):
+    """The negotiable formats this server can deliver, in order of preference
+
+    :param preferences: Repository format names, most preferred first
+    :type preferences: list of strings
+    :rtype: list of strings
+    """
+    return [kind for kind in preferences if kind in negotiable_formats and writable(kind)]
+
+
+def _accepted(accept):
+    """The mimetypes of an ``Accept`` header, with their quality values
+
+    :rtype: dict of mimetype : quality
+    """
+    result = {}
+    for part in (accept or "").split(","):
+        fields = [field.strip() for field in part.split(";")]
+        if fields[0] == "":
+            continue
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith("q="):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        result[fields[0].lower()] = quality
+    return result
+
+
+def negotiate_kind(accept, preferences, default):
+    """Choose the format to deliver from an ``Accept`` header
+
+    Only formats the client names explicitly are chosen, a wildcard never selects a modern format.
+
+    :param accept: The ``Accept`` header, or None
+    :type accept: string or None
+    :param preferences: Negotiable formats, most preferred first
+    :type preferences: list of strings
+    :param default: Format to deliver when nothing better is accepted
+    :type default: string
+    :rtype: string
+    """
+    accepted = _accepted(accept)
+    for kind in available_formats(preferences):
+        if accepted.get(negotiable_formats[kind][1], 0.0) > 0.0:
+            return kind
+    return default
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number > 0 else None
+
+
+def hinted_size(x_size, y_size, headers, max_dpr, max_size):
+    """Apply the client hints of a request to the requested size
+
+    The hinted size is held below ``max_size``, the bound on requested sizes, keeping its aspect ratio.
+
+    :param x_size: Requested width in CSS pixels, or None
+    :type x_size: integer or None
+    :param y_size: Requested height in CSS pixels, or None
+    :type y_size: integer or None
+    :param headers: The request headers
+    :type headers: dict like
+    :param max_dpr: Greatest device pixel ratio honoured
+    :type max_dpr: real
+    :param max_size: Sizes must be less than this
+    :type max_size: integer
+    :rtype: tuple (x_size, y_size)
+    """
+    dpr = _number(headers.get("DPR"))
+    width = _number(headers.get("Width"))
+    save_data = headers.get("Save-Data", "").strip().lower() == "on"
+    if dpr is None and width is None:
+        return x_size, y_size
+    limit = 1.0 if save_data else max_dpr
+    if x_size is None and y_size is None:
+        if width is None:
+            return x_size, y_size
+        if dpr is not None and dpr > limit:
+            width = width * limit / dpr    # Width is in device pixels at the client's full ratio
+        return min(int(round(width)), max_size - 1), None
+    scale = min(dpr or 1.0, limit)
+    largest = max(size for size in (x_size, y_size) if size is not None)
+    scale = min(scale, float(max_size - 1) / largest)
+    scaled = lambda size: min(max(int(round(size * scale)), 1), max_size - 1) if size is not None else None
+    return scaled(x_size), scaled(y_size)
+
+
+def vary(negotiated_kind, hinted):
+    """The ``Vary`` header for a response
+
+    :param negotiated_kind: Whether the format was negotiated from ``Accept``
+    :type negotiated_kind: boolean
+    :param hinted: Whether the size was open to client hints, whether or not the request carried any
+    :type hinted: boolean
+    :rtype: string or None
+    """
+    headers = []
+    if negotiated_kind:
+        headers.append("Accept")
+    if hinted:
+        headers.extend(client_hint_headers)
+    return ", ".join(headers) if len(headers) > 0 else None
@@ -0,0 +1,287 @@
+"""
+Peers
+-----
+
+A ring of the replicas of the repository, among which derived images are shared rather than each replica deriving
+and caching them separately, after the manner of groupcache.
+
+Each replica, a peer, is placed on a ring by hashing its address many times, as virtual nodes, and each image name
+is owned by the peer whose virtual node follows the hash of the name around the ring.  A replica missing a derived
+image in its own memory and local file caches asks the owner for it.  The owner finds the image in its own caches, or
+derives it, once for the whole cluster, and serves it.  As replicas are added each owns a smaller part of the ring,
+so the images held by the cluster grow with the number of replicas instead of being repeated by each of them.
+
+The peers are listed in the configuration, or found by resolving a DNS name, such as that of the headless service
+of the replicas in Kubernetes, which is resolved again every so often, in the background, as replicas come and go.
+Addresses are compared once resolved to IP addresses, so that a replica recognises itself among them.  A peer that
+does not answer is left out of the ring for a while, its images being owned by the next peers around the ring.
+Connections to the peers are kept open and reused.
+
+Requests from peers are served at ``/<base_pathname>/<image name>``, only to the replicas, and only when peering is
+enabled.  An image asked for by a peer is never asked of another peer, so that replicas whose views of the ring
+differ do not pass requests around between them.
+
+Requests are counted in the metrics as ``peer.hit``, ``peer.miss``, ``peer.error`` and ``peer.served``, and the
+number of peers in the ring is the gauge ``peer.members``.
+"""
+
+import os
+import time
+import bisect
+import hashlib
+import socket
+import urllib
+import httplib
+import logging
+import threading
+from threading import RLock
+
+import Metrics
+
+logger = logging.getLogger("image_repository")
+
+# Header marking requests made by a peer
+peer_header = "X-Image-Repository-Peer"
+
+_serving = threading.local()
+
+
+def _hash(key):
+    """Position of a key on the ring"""
+    return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+def serving():
+    """Returns whether the thread is serving a request from a peer
+
+    :rtype: boolean
+    """
+    return getattr(_serving, "peer", False)
+
+
+class ServingPeer(object):
+    """Marks the thread as serving a request from a peer, for the duration of a ``with`` block
+    """
+    def __enter__(self):
+        _serving.peer = True
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        _serving.peer = False
+        return False
+
+
+def _normalised(address):
+    """An address, host:port, with the host resolved to its IP address
+
+    :rtype: string, or None if the host cannot be resolved
+    """
+    host, _, port = address.rpartition(":")
+    try:
+        return "{}:{}".format(socket.gethostbyname(host), int(port))
+    except (socket.error, ValueError):
+        return None
+
+
+class PeerRing(object):
+    """The consistent hash ring of the replicas of the repository
+
+    The peers are resolved, and the ring built, by a background thread, so that finding the owner of an image only
+    reads the ring.
+    """
+
+    _idle_connections = 4    # Connections to each peer kept open for reuse
+
+    def __init__(self, configuration):
+        """
+        :param configuration: Configuration of the peers
+        :type configuration: Configuration.PeerConfig
+        """
+        self._configuration = configuration
+        self._enabled = configuration.enabled
+        self._lock = RLock()
+        self._members = []        # addresses of the replicas, including this one, resolved to IP addresses
+        self._peers = []          # addresses in the ring, those of the members that have not recently failed
+        self._ring = []           # sorted positions of the virtual nodes
+        self._owners = {}         # position : address
+        self._failed = {}         # address : time until which it is left out of the ring
+        self._connections = {}    # address : list of idle connections
+        self._self = None
+        self._refresher = None
+        if self._enabled:
+            self._self = self._own_address()
+            self._refresh()
+            Metrics.gauge("peer.members", lambda: len(self._peers))
+            self._refresher = threading.Thread(target = self._refresh_periodically, name = "peers")
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def enabled(self):
+        """:rtype: boolean"""
+        return self._enabled
+
+    def _own_address(self):
+        """The address of this replica, from the configuration, the environment of its pod or the name of its host"""
+        if self._configuration.self_address is not None:
+            address = self._configuration.self_address
+        else:
+            address = "{}:{}".format(os.environ.get("POD_IP") or socket.gethostname(), self._configuration.port)
+        return _normalised(address) or address
+
+    def _resolve(self):
+        """The addresses of the replicas, from the configuration or the DNS, resolved to IP addresses
+
+        :rtype: list of strings
+        """
+        if self._configuration.dns_name is None:
+            return [address for address in (_normalised(peer) for peer in self._configuration.peers) if address is not None]
+        try:
+            addresses = socket.getaddrinfo(self._configuration.dns_name, self._configuration.port, socket.AF_INET,
+                                           socket.SOCK_STREAM)
+        except socket.error:
+            logger.exception("Peers cannot be found from {}".format(self._configuration.dns_name))
+            return list(self._members)
+        return ["{}:{}".format(address[4][0], address[4][1]) for address in addresses]
+
+    def _refresh_periodically(self):
+        while True:
+            time.sleep(self._configuration.refresh_interval)
+            try:
+                self._refresh()
+            except Exception:
+                logger.exception("Peers cannot be refreshed")
+
+    def _refresh(self):
+        """Resolve the replicas again, and build the ring from them"""
+        members = self._resolve()
+        if self._self not in members:
+            members.append(self._self)
+        with self._lock:
+            self._members = sorted(set(members))
+        self._build()
+
+    def _build(self):
+        """Build the ring from the replicas, leaving out those that recently failed"""
+        now = time.time()
+        with self._lock:
+            self._failed = dict((address, until) for address, until in self._failed.iteritems() if until > now)
+            peers = [address for address in self._members if address not in self._failed]
+            if peers == self._peers:
+                return
+            members = self._members
+        owners = {}
+        for address in peers:
+            for node in range(self._configuration.virtual_nodes):
+                owners[_hash("{}#{}".format(address, node))] = address
+        ring = sorted(owners.keys())
+        with self._lock:
+            if self._members is not members:
+                return    # Resolved again while building, the newer ring is built by that refresh
+            self._owners = owners
+            self._ring = ring
+            self._peers = peers
+        logger.info("Peer ring of {} replicas: {}".format(len(peers), ", ".join(peers)))
+
+    def is_peer(self, host):
+        """Returns whether a host is one of the replicas
+
+        :param host: IP address of the host
+        :type host: string
+        :rtype: boolean
+        """
+        with self._lock:
+            return any(address.rpartition(":")[0] == host for address in self._members)
+
+    def owner(self, name):
+        """The peer that owns an image
+
+        :param name: Cannonical name of the image
+        :type name: string
+        :rtype: string address of the peer, or None if this replica owns the image
+        """
+        if not self._enabled:
+            return None
+        with self._lock:
+            if len(self._ring) == 0:
+                return None
+            index = bisect.bisect(self._ring, _hash(name)) % len(self._ring)
+            address = self._owners[self._ring[index]]
+        return None if address == self._self else address
+
+    def _fail(self, address):
+        """Leave a peer that does not answer out of the ring for a while"""
+        with self._lock:
+            self._failed[address] = time.time() + self._configuration.failure_backoff
+            idle = self._connections.pop(address, [])
+        for connection in idle:
+            connection.close()
+        Metrics.increment("peer.error")
+        self._build()
+
+    def _connection(self, address, reuse = True):
+        """An idle connection to a peer, or a new one
+
+        :rtype: tuple of the connection and whether it was idle
+        """
+        if reuse:
+            with self._lock:
+                idle = self._connections.get(address)
+                if idle:
+                    return idle.pop(), True
+        return httplib.HTTPConnection(address, timeout = self._configuration.timeout), False
+
+    def _release(self, address, connection):
+        """Keep a connection whose response is read for reuse"""
+        with self._lock:
+            idle = self._connections.setdefault(address, [])
+            if len(idle) < self._idle_connections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def fetch(self, name, derive = False):
+        """Ask the owner of an image for it
+
+        :param name: Cannonical name of the image
+        :type name: string
+        :param derive: Whether the owner is to derive the image if it does not hold it
+        :type derive: boolean
+        :rtype: bytes, the encoded image, or None if this replica owns it, or the owner does not have it
+        """
+        if not self._enabled or serving():
+            return None
+        address = self.owner(name)
+        if address is None:
+            return None
+        path = "/{}/{}".format(self._configuration.base_pathname, urllib.quote(name))
+        if derive:
+            path += "?derive=1"
+        reuse = True
+        while True:
+            connection, idle = self._connection(address, reuse)
+            try:
+                connection.request("GET", path, headers = {peer_header : self._self})
+                response = connection.getresponse()
+                the_bytes = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if idle:
+                    reuse = False    # The peer may have closed the idle connection, try a new one
+                    continue
+                logger.warning("Peer {} does not answer for {}".format(address, name))
+                self._fail(address)
+                return None
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(address, connection)
+        if response.status == 200:
+            Metrics.increment("peer.hit")
+            return the_bytes
+        if response.status in (404, 503):
+            Metrics.increment("peer.miss")
+            return None
+        logger.warning("Peer {} answers {} for {}".format(address, response.status, name))
+        Metrics.increment("peer.error")
+        return None
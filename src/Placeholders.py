@@ -0,0 +1,321 @@
+"""
+Placeholders
+------------
+
+Low quality image placeholders and dominant colours, so that a gallery can paint every image at once from a
+single listing, before any thumbnail arrives.
+
+For each original image three values are kept:
+
+* blurhash = A BlurHash string, a few dozen characters from which a blurred image can be painted
+* lqip = A tiny JPEG of the image, as a ``data:`` URL
+* colour = The dominant colour of the image, as ``#rrggbb``
+
+All three are computed together from one heavily reduced copy of the image.  When the image is already decoded
+that copy is made from it, otherwise JPEG images are decoded at a reduced DCT scale, so computing placeholders
+never costs a second full decode.
+
+The values of every image are held in one compact index, a gzipped JSON document kept in a local file and copied
+to the Swift store beside the originals.  The index is written by a background thread, which gathers the changes
+made within ``save_interval`` seconds into one write, so uploads never wait for it.
+"""
+
+import os
+import math
+import gzip
+import json
+import base64
+import logging
+import time
+import cStringIO
+from threading import Lock
+from threading import RLock
+from threading import Event
+from threading import Thread
+
+import wand.image
+import wand.exceptions
+
+import ImageHeaders
+import Resources
+from Exceptions import RepositoryError
+from Exceptions import RepositoryFailure
+
+logger = logging.getLogger("image_repository")
+
+# Name of the index within the Swift store
+index_object = "_placeholders/index.json.gz"
+
+_base83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+_srgb_to_linear = [((value / 255.0 + 0.055) / 1.055) ** 2.4 if value / 255.0 > 0.04045 else value / 255.0 / 12.92
+                   for value in range(256)]
+
+
+def is_index_object(name):
+    """Returns whether a Swift object is the placeholder index
+
+    :rtype: boolean
+    """
+    return name == index_object
+
+
+def _encode83(value, length):
+    return "".join(_base83[(value // (83 ** (length - index - 1))) % 83] for index in range(length))
+
+
+def _linear_to_srgb(value):
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * math.pow(value, 1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exponent):
+    return math.copysign(math.pow(abs(value), exponent), value)
+
+
+def blurhash(pixels, width, height, x_components = 4, y_components = 3):
+    """Encode an image as a BlurHash string
+
+    :param pixels: 8 bit RGB pixel values, row by row
+    :type pixels: bytes
+    :param width: Width of the image, which should be small
+    :type width: integer
+    :param height: Height of the image, which should be small
+    :type height: integer
+    :param x_components: Number of horizontal components, 1 to 9
+    :type x_components: integer
+    :param y_components: Number of vertical components, 1 to 9
+    :type y_components: integer
+    :rtype: string
+    """
+    linear = [_srgb_to_linear[ord(value)] for value in pixels]
+    x_cosines = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(x_components)]
+    y_cosines = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(y_components)]
+    factors = []
+    for j in range(y_components):
+        for i in range(x_components):
+            scale = (1.0 if i == 0 and j == 0 else 2.0) / (width * height)
+            red = green = blue = 0.0
+            for y in range(height):
+                row = y * width * 3
+                y_basis = y_cosines[j][y]
+                for x in range(width):
+                    basis = x_cosines[i][x] * y_basis
+                    red += basis * linear[row + 3 * x]
+                    green += basis * linear[row + 3 * x + 1]
+                    blue += basis * linear[row + 3 * x + 2]
+            factors.append((red * scale, green * scale, blue * scale))
+
+    dc, ac = factors[0], factors[1:]
+    result = _encode83((x_components - 1) + (y_components - 1) * 9, 1)
+    if len(ac) > 0:
+        quantised_maximum = max(0, min(82, int(math.floor(max(abs(value) for factor in ac for value in factor) * 166 - 0.5))))
+        maximum = (quantised_maximum + 1) / 166.0
+        result += _encode83(quantised_maximum, 1)
+    else:
+        maximum = 1.0
+        result += _encode83(0, 1)
+    result += _encode83((_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8) + _linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        quantised = [max(0, min(18, int(math.floor(_sign_pow(value / maximum, 0.5) * 9 + 9.5)))) for value in factor]
+        result += _encode83(quantised[0] * 19 * 19 + quantised[1] * 19 + quantised[2], 2)
+    return result
+
+
+def dominant_colour(pixels):
+    """The dominant colour of an image, the mean of the most populous cell of a coarse colour histogram
+
+    :param pixels: 8 bit RGB pixel values
+    :type pixels: bytes
+    :rtype: string ``#rrggbb``
+    """
+    cells = {}
+    for index in range(0, len(pixels) - 2, 3):
+        red, green, blue = ord(pixels[index]), ord(pixels[index + 1]), ord(pixels[index + 2])
+        cell = cells.setdefault((red >> 5, green >> 5, blue >> 5), [0, 0, 0, 0])
+        cell[0] += 1
+        cell[1] += red
+        cell[2] += green
+        cell[3] += blue
+    if len(cells) == 0:
+        return "#000000"
+    count, red, green, blue = max(cells.values())
+    return "#{:02x}{:02x}{:02x}".format(red // count, green // count, blue // count)
+
+
+def _reduced_image(handle, box):
+    """A copy of the image no larger than ``box`` in either dimension, made without a full decode if possible
+
+    :rtype: wand.image.Image
+    """
+    if handle._image is not None and handle._image() is not None:
+        image = handle._image().clone()
+    else:
+        the_bytes = handle.encoded_bytes()
+        if the_bytes is None:
+            raise RepositoryFailure("Unable to obtain image data")
+        header = ImageHeaders.probe_bytes(the_bytes)
+        image = wand.image.Image()
+        # Lets the JPEG decoder scale down in the DCT domain, other decoders ignore it
+        image.options['jpeg:size'] = "{}x{}".format(box, box)
+        with Resources.governed(header):
+            image.read(blob = the_bytes)
+    if image.sequence is not None and len(image.sequence) > 1:
+        first = wand.image.Image(image = image.sequence[0])
+        image.close()
+        image = first
+    scale = min(1.0, float(box) / max(image.width, image.height))
+    image.resize(max(1, int(round(image.width * scale))), max(1, int(round(image.height * scale))), filter = 'box')
+    image.alpha_channel = 'remove'
+    image.depth = 8
+    return image
+
+
+def compute(handle, configuration):
+    """Compute the placeholders of an image
+
+    :param handle: The image
+    :type handle: ImageType.ImageHandle
+    :param configuration: Configuration of placeholders
+    :type configuration: Configuration.PlaceholderConfig
+    :rtype: dict
+    :raises: RepositoryFailure
+    """
+    image = _reduced_image(handle, configuration.lqip_size)
+    try:
+        pixels = image.make_blob("RGB")
+        x_components, y_components = configuration.blurhash_components
+        entry = {"blurhash" : blurhash(pixels, image.width, image.height, x_components, y_components),
+                 "colour" : dominant_colour(pixels),
+                 "width" : image.width, "height" : image.height}
+        image.format = "jpeg"
+        image.compression_quality = configuration.lqip_quality
+        image.strip()
+        entry["lqip"] = "data:image/jpeg;base64," + base64.b64encode(image.make_blob())
+    finally:
+        image.close()
+    return entry
+
+
+class PlaceholderIndex(object):
+    """The placeholders of every original image, by base name
+    """
+
+    def __init__(self, configuration, store = None):
+        """Load the placeholder index
+
+        :param configuration: Configuration of placeholders
+        :type configuration: Configuration.PlaceholderConfig
+        :param store: Swift store holding the originals, beside which the index is kept
+        :type store: Stores.SwiftImageStore or None
+        """
+        self._configuration = configuration
+        self._store = store if configuration.use_swift else None
+        self._lock = RLock()
+        self._save_lock = Lock()    # held while the index is written, so that writes never overlap
+        self._entries = {}
+        self._changed = Event()     # set when the index holds changes not yet written
+        self._writer = None
+        self._load()
+
+    def _load(self):
+        the_bytes = None
+        if os.path.exists(self._configuration.index_path):
+            with open(self._configuration.index_path, 'rb') as the_file:
+                the_bytes = the_file.read()
+        elif self._store is not None:
+            try:
+                the_bytes = self._store.get_object(index_object)
+            except RepositoryError:
+                logger.exception("Placeholder index cannot be read from Swift")
+        if the_bytes is None:
+            return
+        try:
+            self._entries = json.loads(gzip.GzipFile(fileobj = cStringIO.StringIO(the_bytes)).read())
+        except (IOError, ValueError):
+            logger.exception("Placeholder index is unreadable, starting afresh")
+            self._entries = {}
+        logger.info("Placeholder index holds {} images".format(len(self._entries)))
+
+    def _start_writer(self):
+        """Start the thread writing the index"""
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._writer = Thread(target = self._write_changes, name = "placeholders")
+            self._writer.daemon = True
+        self._writer.start()
+
+    def _write_changes(self):
+        while True:
+            self._changed.wait()
+            time.sleep(self._configuration.save_interval)    # Gather the changes made meanwhile into one write
+            self.save()
+
+    def save(self):
+        """Write the index locally and to the Swift store"""
+        with self._save_lock:
+            with self._lock:
+                self._changed.clear()
+                document = json.dumps(self._entries, separators = (',', ':'), sort_keys = True)
+            buffer = cStringIO.StringIO()
+            with gzip.GzipFile(fileobj = buffer, mode = 'wb') as the_file:
+                the_file.write(document)
+            the_bytes = buffer.getvalue()
+            # Worker processes on a host share the local copy, each writes its own temporary file
+            temporary = "{}.{}.tmp".format(self._configuration.index_path, os.getpid())
+            try:
+                with open(temporary, 'wb') as the_file:
+                    the_file.write(the_bytes)
+                os.rename(temporary, self._configuration.index_path)
+            except (IOError, OSError):
+                logger.exception("Placeholder index cannot be written to {}".format(self._configuration.index_path))
+            if self._store is not None:
+                try:
+                    self._store.store_image(cStringIO.StringIO(the_bytes), index_object)
+                except RepositoryError:
+                    logger.exception("Placeholder index cannot be written to Swift")
+
+    def get(self, name):
+        """:rtype: dict or None"""
+        with self._lock:
+            return self._entries.get(name)
+
+    def add(self, name, handle):
+        """Compute and record the placeholders of an image, the index being written in the background
+
+        :param name: Base name of the image
+        :type name: string
+        :param handle: The image
+        :type handle: ImageType.ImageHandle
+        :rtype: dict or None
+        """
+        try:
+            entry = compute(handle, self._configuration)
+        except (RepositoryError, RepositoryFailure, wand.exceptions.WandException):
+            logger.exception("Placeholders of {} cannot be computed".format(name))
+            return None
+        with self._lock:
+            self._entries[name] = entry
+        self._start_writer()
+        self._changed.set()
+        return entry
+
+    def backfill(self, originals):
+        """Compute, in the background, the placeholders of every original that lacks them
+
+        :param originals: Original images by base name
+        :type originals: dict of name : ImageType.OriginalImage
+        """
+        with self._lock:
+            missing = [name for name in originals if name not in self._entries]
+        if len(missing) == 0:
+            return
+        def background():
+            logger.info("Backfilling placeholders of {} images".format(len(missing)))
+            for name in missing:
+                self.add(name, originals[name].get_image_handle())
+        worker = Thread(target = background, name = "placeholders")
+        worker.daemon = True
+        worker.start()
@@ -0,0 +1,78 @@
+"""
+Promotion
+---------
+
+Rules for promoting images found in the lower levels of the cache hierarchy to the levels above, so that hot
+images are served from memory or local files rather than fetched from Swift again.
+
+Hits on the levels below the memory cache are counted for each image within a window of time.  An image hit often
+enough within the window is promoted:
+
+* file_hits = hits on the peer or Swift levels that promote an image to the local file cache
+* memory_hits = hits on the shared memory, file, peer or Swift levels that promote an image to the memory cache
+
+Counts are kept for a bounded number of images, those hit least recently being forgotten first.
+
+Each level of the hierarchy is either inclusive, keeping its copy of an image promoted from it, or exclusive,
+giving up its copy so that the image is not paid for twice, and receiving the image back when it is evicted from
+the level above.  The hits on each level, misses, promotions and demotions are counted in the metrics as
+``hierarchy.hit.<level>``, ``hierarchy.miss``, ``hierarchy.promote.<from>.<to>`` and ``hierarchy.demote.<level>``.
+"""
+
+import time
+from threading import Lock
+from collections import OrderedDict
+
+# Levels of the hierarchy from which images are promoted to each level
+_promoted_from = {"file" : ("peer", "swift_cache", "swift_store"),
+                  "memory" : ("shared_memory", "file", "peer", "swift_cache", "swift_store")}
+
+
+class PromotionPolicy(object):
+    """Counts of the hits on the lower levels of the hierarchy, deciding which images to promote
+    """
+
+    def __init__(self, configuration):
+        """
+        :param configuration: Configuration of promotion
+        :type configuration: Configuration.PromotionConfig
+        """
+        self._enabled = configuration.enabled
+        self._file_hits = configuration.file_hits
+        self._memory_hits = configuration.memory_hits
+        self._window = configuration.window
+        self._max_tracked = configuration.max_tracked
+        self._lock = Lock()
+        self._hits = OrderedDict()    # name : [hits, start of window], least recently hit first
+
+    def hit(self, name, level):
+        """Count a hit on a level below the memory cache, and decide whether to promote the image
+
+        :param name: Name of the image
+        :type name: string
+        :param level: Level the image is found on, one of ``shared_memory``, ``file``, ``peer``, ``swift_cache``,
+                      ``swift_store``
+        :type level: string
+        :rtype: string level to promote the image to, ``memory`` or ``file``, or None
+        """
+        if not self._enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            counted = self._hits.pop(name, None)
+            if counted is None or now - counted[1] > self._window:
+                counted = [0, now]
+            counted[0] += 1
+            self._hits[name] = counted
+            while len(self._hits) > self._max_tracked:
+                self._hits.popitem(last = False)
+            hits = counted[0]
+        if self._memory_hits > 0 and hits >= self._memory_hits and level in _promoted_from["memory"]:
+            target = "memory"
+        elif self._file_hits > 0 and hits >= self._file_hits and level in _promoted_from["file"]:
+            target = "file"
+        else:
+            return None
+        with self._lock:
+            self._hits.pop(name, None)
+        return target
@@ -0,0 +1,103 @@
+"""
+Resource Governance
+-------------------
+
+Control of the resources ImageMagick may consume.
+
+ImageMagick sizes its thread pool to the machine and will allocate as much memory as an image asks for.  Inside a
+server that runs several worker processes per host this both oversubscribes the CPUs and allows a single hostile
+upload (a decompression bomb) to exhaust the memory of the host.
+
+Limits are applied once at startup.  ImageMagick resource limits are process wide, so they are never changed while
+images are being decoded in other threads.  Each decode is then checked against the image's header dimensions before
+any pixel data is read, and oversized images are refused.  Images above the ``area`` limit are decoded by ImageMagick
+into a disk backed pixel cache in a dedicated scratch directory.
+"""
+
+import os
+import logging
+from contextlib import contextmanager
+
+import wand.resource
+
+from Exceptions import RepositoryError
+from Exceptions import RepositoryFailure
+
+logger = logging.getLogger("image_repository")
+
+_configuration = None
+
+# The configuration fields that map directly onto ImageMagick resource types
+limit_names = ('memory', 'map', 'disk', 'area', 'width', 'height', 'thread', 'time')
+
+
+def _set_limit(name, value):
+    """Set a single ImageMagick resource limit, tolerating library versions that do not know the resource
+
+    :rtype: boolean
+    """
+    try:
+        wand.resource.limits[name] = value
+        return True
+    except (KeyError, TypeError, ValueError, AttributeError):
+        logger.warning("ImageMagick resource limit '{}' is not supported by this library version".format(name))
+        return False
+
+
+def apply_limits(configuration):
+    """Apply the configured resource limits to ImageMagick and prepare the scratch directory.
+
+    :param configuration: The resource limit configuration
+    :type configuration: Configuration.ResourceLimitsConfig
+    :raises: RepositoryError
+    """
+    global _configuration
+    _configuration = configuration
+
+    scratch = configuration.scratch_path
+    if scratch is not None:
+        try:
+            if not os.path.isdir(scratch):
+                os.makedirs(scratch, 0700)
+        except OSError:
+            logger.exception("Unable to create ImageMagick scratch directory {}".format(scratch))
+            raise RepositoryError("Unable to create ImageMagick scratch directory {}".format(scratch))
+        # ImageMagick consults this each time it creates a temporary file, which includes disk pixel caches
+        os.environ['MAGICK_TEMPORARY_PATH'] = scratch
+
+    for name in limit_names:
+        value = getattr(configuration, name)
+        if value:
+            if _set_limit(name, value):
+                logger.info("ImageMagick resource limit {} = {}".format(name, value))
+
+
+def check_dimensions(header):
+    """Refuse images whose header dimensions exceed the configured limits
+
+    :param header: The probed header of the image, or None if it could not be probed
+    :type header: ImageHeaders.ImageHeader or None
+    :raises: RepositoryFailure
+    """
+    if _configuration is None or header is None:
+        return
+    too_big = ((_configuration.width and header.width > _configuration.width) or
+               (_configuration.height and header.height > _configuration.height) or
+               (_configuration.max_pixels and header.pixels() > _configuration.max_pixels))
+    if too_big:
+        logger.warning("Refusing to decode {} image, exceeds configured resource limits".format(header))
+        raise RepositoryFailure("Image of {} x {} pixels exceeds repository limits".format(header.width, header.height), 413)
+
+
+@contextmanager
+def governed(header):
+    """Context within which an image with the given header may be decoded or derived
+
+    The limits applied at startup govern the decode, none are changed for it.
+
+    :param header: The probed header of the image, or None if it could not be probed
+    :type header: ImageHeaders.ImageHeader or None
+    :raises: RepositoryFailure
+    """
+    check_dimensions(header)
+    yield
@@ -16,20 +16,34 @@ import os.path
 import tempfile
 import zipfile
 import logging
+import json
+import cStringIO
+import mimetypes
 from flask import Flask
 from flask_restful import reqparse, abort, Api, Resource
 from flask_restful import fields
 from flask_restful import inputs
 from flask_restful import request
 from flask import send_file
+from flask import Response
+from flask import redirect
 
 from marshmallow import Schema, fields, ValidationError, pre_load, validates
 
 from ImageNames import ImageName
+from ImageNames import resample_qualities
+from ImageNames import normalised_kind
 import ImageType
 import Caches
 import Configuration
 import Stores
+import Tiles
+import IIIF
+import Negotiation
+import Metrics
+import Startup
+import Peers
+from SizeLadder import SizeLadder
 from Exceptions import RepositoryError, RepositoryFailure
 
 
@@ -38,39 +52,78 @@ from Exceptions import RepositoryError, RepositoryFailure
 master = None
 repo = None
 repo_logger = None
+ladder = SizeLadder([])
 
 # TODO - make this list complete - use Wand's definitions
-valid_image_formats = ["jpg","tif","png", "bmp","bpg"]
+valid_image_formats = ["jpg","tif","png", "bmp","bpg"] + sorted(kind for kind in Negotiation.negotiable_formats if Negotiation.writable(kind))
+
+max_image_size = 10000    # Requested sizes must be less than this
+
+def unreasonable(the_name):
+    """Returns why a derived image name describes an image that may not be made, or None
+
+    The sizes in the name are held to the same bounds as those of requests, see ``ImageSchema``.
+
+    :param the_name: Name of a derived image
+    :type the_name: ImageName
+    :rtype: string or None
+    """
+    if not the_name.is_derived() or the_name.is_metadata():
+        return "{} is not a derived image".format(the_name)
+    if normalised_kind(the_name.image_kind()) not in valid_image_formats:
+        return "{} is not a valid image format".format(the_name.image_kind())
+    try:
+        for operation, parameters in the_name.derivations():
+            if operation in ("size", "scale", "thumbnail", "crop"):
+                sizes = [int(value) for value in parameters[:2] if value != "None"]
+                if any(value <= 0 or value >= max_image_size for value in sizes):
+                    return "Image size in {} is unreasonable".format(the_name)
+            if operation == "crop":
+                if any(int(value) < 0 or int(value) >= max_image_size for value in parameters[2:4]):
+                    return "Crop origin in {} is unreasonable".format(the_name)
+            elif operation == "rotate":
+                float(parameters[0])
+    except (ValueError, IndexError):
+        return "{} is not a valid image name".format(the_name)
+    return None
 
 class ImageSchema(Schema):
     """Schema for requests for an image within the repository including derived images
     """
     xsize = fields.Int(missing = None, default = None)
     ysize = fields.Int(missing = None)
-    kind = fields.Str(missing = 'jpg')
+    kind = fields.Str(missing = None)
     thumbnail = fields.Boolean(missing = False)
     url = fields.Boolean(missing = False)
     meta = fields.Boolean(missing = False)
     regex = fields.Str(missing = None)
+    quality = fields.Str(missing = None)
 
     @validates('kind')
     def validate_kind(self, value):
-        if value.lower() not in valid_image_formats:
+        if value is not None and normalised_kind(value) not in valid_image_formats:
             raise ValidationError("{} is not a valid image format".format(value))
     
     @validates('xsize')
     def validate_x_size(self, value):
         if value is None:
             return True
-        if value <= 0 or value >= 10000:
+        if value <= 0 or value >= max_image_size:
             raise ValidationError("Image xsize {} is unreasonable".format(value))
 
     @validates('ysize')
     def validate_y_size(self, value):
         if value is None:
             return True
-        if value <= 0 or value >= 10000:
+        if value <= 0 or value >= max_image_size:
             raise ValidationError("Image ysize {} is unreasonable".format(value))
+
+    @validates('quality')
+    def validate_quality(self, value):
+        if value is None:
+            return True
+        if value.lower() not in resample_qualities:
+            raise ValidationError("{} is not a valid resampling quality, use one of {}".format(value, ", ".join(resample_qualities)))
         
 class ImageUpload(Schema):
     """Schema for requests to upload an image to the repository
@@ -89,6 +142,9 @@ class Image(Resource):
         except ValidationError as ex:
             abort(400, message = ex.messages)
 #            return ex.messages, 500
+
+        if not Startup.ready():
+            return self._while_loading(image_name, args)
         
         # Find if the original image exists
 
@@ -122,6 +178,9 @@ class Image(Resource):
                 return [ ( str(image.name), image._get_metadata()) for image in master.get_original_images(image_names, regexp) ]
 
             # Otherwise it is an image request
+            # Without a requested format or size, negotiate them from the request headers
+            vary = self._negotiate(args)
+
             # Name includes desired image format
             new_names = [ImageName(the_name, kind = args['kind']) for the_name in image_names]
             
@@ -141,15 +200,26 @@ class Image(Resource):
             
             repo_logger.debug("Using x={} and y={} as dimensions".format(x_size, y_size))
             
+            exact_size = None
+            found = None
             if args['thumbnail']:
-                for the_name in new_names:
-                    the_name.apply_thumbnail((args['xsize'], args['ysize']), kind = args['kind'])
+                new_names = [the_name.apply_thumbnail((args['xsize'], args['ysize']), kind = args['kind'], quality = args['quality'])
+                             for the_name in new_names]
             else:
                 if x_size is not None or y_size is not None:
-                    for the_name in new_names:
-                        the_name.apply_resize((x_size, y_size), kind = args['kind'])
-
-            new_images = [ master.get_as_defined(the_name) for the_name in new_names ]
+                    if ladder.enabled():
+                        rung = ladder.snap((x_size, y_size))
+                        if ladder.exact and rung != (x_size, y_size):
+                            exact_size = (x_size, y_size)
+                        x_size, y_size = rung
+                        found = lambda hit: ladder.record(rung, hit)
+                    new_names = [the_name.apply_resize((x_size, y_size), kind = args['kind'], quality = args['quality'])
+                                 for the_name in new_names]
+
+            if exact_size is not None:
+                new_images = [ master.get_resized_from(the_name, exact_size, args['quality'], found) for the_name in new_names ]
+            else:
+                new_images = [ master.get_as_defined(the_name, found) for the_name in new_names ]
             
             # If a URL is requested we generate that and return it
             if args['url']:
@@ -157,7 +227,7 @@ class Image(Resource):
 
             # Otherwise we return the actual image
             if len(new_images) == 1:        
-                return send_file(new_images[0].as_filelike(), mimetype = new_images[0].mimetype())
+                return self._negotiated(send_file(new_images[0].as_filelike(), mimetype = new_images[0].mimetype()), vary)
             else:
                 # Only way to return multiple files is to create a zip archive and send that
                 the_uuid = str(uuid.uuid1())
@@ -170,11 +240,66 @@ class Image(Resource):
                     
                     zf.write(filename = filename, arcname = imagename)
                 zf.close()
-                return send_file(the_temp_file, mimetype = 'application/zip')
+                return self._negotiated(send_file(the_temp_file, mimetype = 'application/zip'), vary)
         except (RepositoryError, RepositoryFailure) as ex:
             return ex.http_error()
 
         
+    @staticmethod
+    def _negotiate(args):
+        """Choose the format and size of the image from the request headers, where the request does not fix them
+
+        :param args: The arguments of the request, updated with the negotiated format and size
+        :type args: dict
+        :rtype: string ``Vary`` header of the response, or None
+        """
+        configuration = repo.configuration()
+        negotiated = args['kind'] is None
+        if negotiated:
+            args['kind'] = Negotiation.negotiate_kind(request.headers.get('Accept'), configuration.negotiation_formats,
+                                                      configuration.image_default_format)
+        hinted = configuration.client_hints and not (args['thumbnail'] and args['xsize'] is None and args['ysize'] is None)
+        if hinted:
+            args['xsize'], args['ysize'] = Negotiation.hinted_size(args['xsize'], args['ysize'], request.headers,
+                                                                   configuration.client_hint_max_dpr, max_image_size)
+        return Negotiation.vary(negotiated, hinted)
+
+    @staticmethod
+    def _while_loading(image_name, args):
+        """Serve a request while the caches load, by reading an image already in Swift directly
+
+        Only a single image, in a format or as a thumbnail, can be found without the indexes of the caches.
+        Other requests are refused until the caches are loaded.
+        """
+        if args['regex'] is not None or args['meta'] or args['url'] or image_name is None or len(image_name) == 0 or image_name[-1] == u'/':
+            return Startup.unavailable()
+        vary = Image._negotiate(args)
+        kind = args['kind']
+        the_name = ImageName(image_name, kind = kind)
+        if args['thumbnail']:
+            candidates = [the_name.apply_thumbnail((args['xsize'], args['ysize']), kind = kind, quality = args['quality'])]
+        elif args['xsize'] is None and args['ysize'] is None:
+            # An image in the format in which it was uploaded is held only under the name of the original
+            candidates = [the_name, the_name.make_original(), the_name.apply_convert(the_name.image_kind())]
+        else:
+            return Startup.unavailable()
+        for candidate in candidates:
+            candidate = candidate.normalised()
+            the_bytes = Startup.direct_get(candidate)
+            if the_bytes is not None:
+                mimetype = mimetypes.guess_type("image." + candidate.image_kind())[0]
+                return Image._negotiated(send_file(cStringIO.StringIO(the_bytes), mimetype = mimetype), vary)
+        return Startup.unavailable()
+
+    @staticmethod
+    def _negotiated(response, vary):
+        """Mark a response with the request headers it depends upon, and invite client hints"""
+        if vary is not None:
+            response.headers['Vary'] = vary
+        if repo.configuration().client_hints:
+            response.headers['Accept-CH'] = ", ".join(Negotiation.client_hint_headers)
+        return response
+
     @staticmethod
     def _allowed_file(filename):
         """Sanity check that the only file types we operate upon are images or metadata from images
@@ -198,6 +323,7 @@ class Image(Resource):
         return None, 201
 
     
+    @Startup.when_ready
     def post(self, image_name):
         """POST operation
         
@@ -235,11 +361,12 @@ class Image(Resource):
                     # use the suffix of the input file - which has already been checked
                     image_name += "." + file_req.filename.rsplit('.', 1)[1]
             try:
-                the_name = ImageName.from_raw((image_name))
+                the_name = ImageName.from_raw((image_name)).set_original(True)
                 image = ImageType.OriginalImage.from_filelike(file_req, name = the_name, full_name = True)
-                the_name.set_original(True)
                 master.add(the_name, image)
                 master.make_persistent(the_name)
+                master.add_placeholders(the_name.base_name(), image.get_image_handle())
+                master.tile_on_upload(the_name.base_name(), image.get_image_handle().header())
             except (RepositoryError, RepositoryFailure) as ex:
                 return ex.http_error()
             return "{}".format(image.name.base_name())  # Return the name by which the repository addresses the image
@@ -250,19 +377,226 @@ class Image1(Image):
         return super(Image1, self).get(None)
         
         
+class ImageTile(Resource):
+    """Interface provides deep zoom tiles at ``/images/<name>/tiles/<level>/<x>_<y>.<format>``
+
+    The same tiles are found below ``/images/<name>/tiles_files/``, where DZI viewers look for them given the
+    descriptor at ``/images/<name>/tiles.dzi``.  Each level of the pyramid is generated on the first request for one
+    of its tiles.
+    """
+    @Startup.when_ready
+    def get(self, image_name, level, column, row, kind):
+        if kind not in valid_image_formats:
+            return 'Tile format {} is not supported'.format(kind), 415
+        try:
+            the_bytes = master.get_tile(image_name, level, column, row, kind)
+        except (RepositoryError, RepositoryFailure) as ex:
+            return ex.http_error()
+        return send_file(cStringIO.StringIO(the_bytes), mimetype = Tiles.TilePyramidCache.mimetype(kind))
+
+
+class ImageTileDescriptor(Resource):
+    """Interface provides the DZI descriptor of an image's tile pyramid at ``/images/<name>/tiles.dzi``
+    """
+    @Startup.when_ready
+    def get(self, image_name):
+        kind = repo.configuration().tile_configuration.default_format
+        try:
+            descriptor = master.get_tile_descriptor(image_name, kind)
+        except (RepositoryError, RepositoryFailure) as ex:
+            return ex.http_error()
+        return Response(descriptor, mimetype = 'application/xml')
+
+
+def _iiif_response(response):
+    """Add the headers every IIIF response carries"""
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Link'] = '<http://iiif.io/api/image/3/level1.json>;rel="profile"'
+    return response
+
+
+class IIIFInfo(Resource):
+    """Interface provides the IIIF Image API ``info.json`` of an image at ``/iiif/<identifier>/info.json``
+
+    The dimensions are read from the header of the original image, which is not decoded.
+    """
+    @Startup.when_ready
+    def get(self, identifier):
+        configuration = repo.configuration()
+        try:
+            header = master.original_header(identifier)
+        except (RepositoryError, RepositoryFailure) as ex:
+            return ex.http_error()
+        base_url = request.url_root + configuration.iiif_base_pathname
+        info = IIIF.info(identifier, base_url, header, configuration.tile_configuration.tile_size)
+        return _iiif_response(Response(json.dumps(info), mimetype = 'application/ld+json'))
+
+
+class IIIFBase(Resource):
+    """Interface redirects the IIIF base URI of an image, ``/iiif/<identifier>``, to its ``info.json``
+    """
+    def get(self, identifier):
+        return redirect("{}/{}/info.json".format(request.script_root + "/" + repo.configuration().iiif_base_pathname, identifier), 303)
+
+
+class IIIFImage(Resource):
+    """Interface provides IIIF Image API 3.0 image requests at ``/iiif/<identifier>/<region>/<size>/<rotation>/<quality>.<format>``
+
+    The request is translated into the name of a derived image, see IIIF, which is found or created as any
+    other derived image is.
+    """
+    @Startup.when_ready
+    def get(self, identifier, region, size, rotation, quality, kind):
+        try:
+            header = master.original_header(identifier)
+            name = IIIF.image_name(identifier, header, region, size, rotation, quality, kind)
+            image = master.get_as_defined(name)
+        except (RepositoryError, RepositoryFailure) as ex:
+            return ex.http_error()
+        return _iiif_response(send_file(image.as_filelike(), mimetype = image.mimetype()))
+
+
+class SpriteSchema(Schema):
+    """Schema for requests for a sprite of the thumbnails of a selection of images
+    """
+    path = fields.Str(missing = None)
+    regex = fields.Str(missing = None)
+    xsize = fields.Int(missing = None)
+    ysize = fields.Int(missing = None)
+    kind = fields.Str(missing = None)
+    quality = fields.Str(missing = None)
+    columns = fields.Int(missing = None)
+
+    @validates('kind')
+    def validate_kind(self, value):
+        if value is not None and normalised_kind(value) not in valid_image_formats:
+            raise ValidationError("{} is not a valid image format".format(value))
+
+    @validates('xsize')
+    def validate_x_size(self, value):
+        if value is not None and (value <= 0 or value >= 1000):
+            raise ValidationError("Thumbnail xsize {} is unreasonable".format(value))
+
+    @validates('ysize')
+    def validate_y_size(self, value):
+        if value is not None and (value <= 0 or value >= 1000):
+            raise ValidationError("Thumbnail ysize {} is unreasonable".format(value))
+
+    @validates('quality')
+    def validate_quality(self, value):
+        if value is not None and value.lower() not in resample_qualities:
+            raise ValidationError("{} is not a valid resampling quality, use one of {}".format(value, ", ".join(resample_qualities)))
+
+    @validates('columns')
+    def validate_columns(self, value):
+        if value is not None and (value <= 0 or value > 1000):
+            raise ValidationError("Sprite columns {} is unreasonable".format(value))
+
+
+class Sprite(Resource):
+    """Interface provides a sprite of the thumbnails of many images at ``/sprites``, and its map at ``/sprites/map``
+
+    Images are selected by ``path`` and ``regex`` exactly as for a listing.  The map gives the name of the sprite,
+    and the cell of each image within it, so that a gallery needs only two requests.
+    """
+    @Startup.when_ready
+    def get(self, what = None):
+        if what is not None and what != 'map':
+            abort(404, message = "Sprites have no '{}'".format(what))
+        try:
+            args, errors = SpriteSchema(strict=True).load(request.args)
+        except ValidationError as ex:
+            abort(400, message = ex.messages)
+        configuration = repo.configuration()
+        regexp = args['regex'] if args['regex'] is not None else '\S+'
+        size = (args['xsize'], args['ysize'])
+        if size[0] is None and size[1] is None:
+            size = tuple(configuration.thumbnail_default_size)
+        size = (size[0] if size[0] is not None else size[1], size[1] if size[1] is not None else size[0])
+        kind = args['kind'] if args['kind'] is not None else configuration.thumbnail_default_format
+        columns = args['columns'] if args['columns'] is not None else configuration.sprite_columns
+        try:
+            names = sorted(master.list_base_images(args['path'], regexp))
+            if len(names) == 0:
+                abort(404, message = "No images match '{}  regex={}'".format(args['path'] or '', regexp))
+            sprite, cells = master.get_sprite(names, size, kind, args['quality'], columns)
+        except (RepositoryError, RepositoryFailure) as ex:
+            return ex.http_error()
+        if what == 'map':
+            return {"sprite" : str(sprite.name), "width" : size[0], "height" : size[1], "columns" : columns, "images" : cells}
+        return send_file(sprite.as_filelike(), mimetype = sprite.mimetype())
+
+
+class Health(Resource):
+    """Liveness probe at ``/healthz``, answered while the caches load
+    """
+    def get(self):
+        return {"status" : "alive", "uptime" : Startup.report()["uptime"]}
+
+
+class Readiness(Resource):
+    """Readiness probe at ``/readyz``, reporting the progress of loading the caches until they are loaded
+    """
+    def get(self):
+        report = Startup.report()
+        return report, 200 if report["ready"] else 503
+
+
+class PeerImage(Resource):
+    """Interface serving the images this replica owns to its peers, at ``/<base_pathname>/<image name>``
+
+    The image is found in the caches, or derived when ``derive`` is set, without asking any other peer.  Only the
+    replicas are served, and only images whose names would be accepted in requests.
+    """
+    @Startup.when_ready
+    def get(self, image_name):
+        if not master.is_peer(request.remote_addr):
+            abort(403, message = "Only peers are served")
+        try:
+            the_name = ImageName(image_name)
+            reason = unreasonable(the_name)
+            if reason is not None:
+                abort(400, message = reason)
+            with Peers.ServingPeer():
+                if request.args.get('derive') is not None:
+                    image = master.get_as_defined(the_name)
+                else:
+                    image = master.get(the_name)
+        except (RepositoryError, RepositoryFailure) as ex:
+            return ex.http_error()
+        if image is None:
+            abort(404, message = "Image '{}' not held".format(image_name))
+        the_bytes = image.get_image_handle().encoded_bytes()
+        if the_bytes is None:
+            abort(404, message = "Image '{}' not held".format(image_name))
+        Metrics.increment("peer.served")
+        return send_file(cStringIO.StringIO(the_bytes), mimetype = image.mimetype())
+
+
+class MetricsList(Resource):
+    """Interface provides a snapshot of the repository's counters at ``/metrics``
+    """
+    def get(self):
+        return Metrics.snapshot()
+
+
 class ListSchema(Schema):
     regex = fields.Str(missing = None)
+    placeholders = fields.Boolean(missing = False)
     
 class ImageList(Resource):
     """Interface provides an endpoint at ``/images`` which allows listing and upload
 
     """
+    @Startup.when_ready
     def get(self):
         """GET operation
 
         GET requests can either list the entire repository from ``../images`` down, or
         a regexp can be provided that allows for filtering the traverse - essentially allowing for
         traversal of sub-directories, and for some other useful searches
+
+        With ``placeholders`` set each image is listed with its BlurHash, tiny placeholder image and dominant colour
         """
         try:
             args, errors = ListSchema(strict=True).load(request.args)
@@ -271,7 +605,10 @@ class ImageList(Resource):
         regexp = args['regex']
         #  Some sanity checking on the regexp here?
         try:
-            return master.list_base_images(regexp = regexp)
+            names = master.list_base_images(regexp = regexp)
+            if args['placeholders']:
+                return master.placeholders(names)
+            return names
         except (RepositoryError, RepositoryFailure) as ex:
             return ex.http_error()
             
@@ -296,19 +633,37 @@ def startup(app):
     :param app: the Flask application instance that will control us
     :type app: Instance of Flask
     """
-    global master, repo, repo_logger
+    global master, repo, repo_logger, ladder
 
     repo = Configuration.ImageRepository()
     repo.repository_server()    # perform instantiation of static components
     repo_logger = logging.getLogger("image_repository")    
+    ladder = SizeLadder(repo.configuration().size_ladder, repo.configuration().size_ladder_exact)
     path_base = repo.configuration().repository_base_pathname
 
     api = Api(app)
     api.add_resource(ImageList, '/{}'.format(path_base), methods = ['GET'])
+    api.add_resource(ImageTile, '/{}/<path:image_name>/tiles/<int:level>/<int:column>_<int:row>.<kind>'.format(path_base),
+                     '/{}/<path:image_name>/tiles_files/<int:level>/<int:column>_<int:row>.<kind>'.format(path_base), methods = ['GET'])
+    api.add_resource(ImageTileDescriptor, '/{}/<path:image_name>/tiles.dzi'.format(path_base), methods = ['GET'])
     api.add_resource(Image, '/{}/<path:image_name>'.format(path_base), methods = ['GET', 'POST', 'DELETE'])
+    api.add_resource(MetricsList, '/metrics', methods = ['GET'])
+    if repo.configuration().peer_configuration.enabled:
+        peer_base = repo.configuration().peer_configuration.base_pathname
+        api.add_resource(PeerImage, '/{}/<path:image_name>'.format(peer_base), methods = ['GET'])
+    sprite_base = repo.configuration().sprite_base_pathname
+    api.add_resource(Sprite, '/{}'.format(sprite_base), '/{}/<what>'.format(sprite_base), methods = ['GET'])
+    iiif_base = repo.configuration().iiif_base_pathname
+    api.add_resource(IIIFInfo, '/{}/<path:identifier>/info.json'.format(iiif_base), methods = ['GET'])
+    api.add_resource(IIIFImage, '/{}/<path:identifier>/<region>/<size>/<rotation>/<quality>.<kind>'.format(iiif_base), methods = ['GET'])
+    api.add_resource(IIIFBase, '/{}/<path:identifier>'.format(iiif_base), methods = ['GET'])
     api.add_resource(Image1, '/{}/'.format(path_base), methods = ['GET'])
 
-    app.before_first_request(prestart) # defer startup until we need to load the caches etc. 
+    api.add_resource(Health, '/healthz', methods = ['GET'])
+    api.add_resource(Readiness, '/readyz', methods = ['GET'])
+
+    # Load the caches in the background, so that requests are answered while they load
+    Startup.start(prestart, repo.configuration(), then = lambda: master.after_start())
 
 def createapp():
     app = Flask('image_repo')
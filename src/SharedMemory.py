@@ -0,0 +1,213 @@
+"""
+Shared Memory
+-------------
+
+An arena of encoded images in a memory mapped file, normally under ``/dev/shm``, shared by every worker process of
+the server on a host.  An image encoded by one worker is found by all the others, and the arena outlives the
+recycling of workers, so a restarted worker starts warm.
+
+The file holds three parts:
+
+* header = identifies the layout, and holds the position at which the next image is written
+* index = a fixed number of slots, each holding the hash of a name, the position of its record and its length
+* arena = records of a name and its encoded image, written one after another around a ring
+
+Records are written at ever increasing positions, wrapping around the ring, so the oldest images are overwritten
+by the newest.  Writers take a lock on the file, reserve space by advancing the write position before writing, then
+fill a slot of the index.  Readers take no lock.  A reader copies the record a slot refers to, and keeps it only if
+the record holds the name looked up and the write position shows the record was not overwritten while it was read.
+
+A process configured with a different layout builds a new file and renames it over the old one, so processes still
+using the old layout keep their mapping of the old file until they are recycled.
+"""
+
+import os
+import mmap
+import zlib
+import fcntl
+import struct
+import logging
+
+logger = logging.getLogger("image_repository")
+
+_magic = "IRSHM001"
+_header = struct.Struct("<8sIIQQQ")    # magic, version, slots, arena size, write position, writes
+_head_offset = 24
+_writes_offset = 32
+_header_size = 4096
+_slot = struct.Struct("<QQII")         # hash, position, length, unused
+_record = struct.Struct("<QQIH")       # position, hash, image length, name length
+_probes = 8                            # slots searched for a name
+_version = 1
+
+
+def _hash(key):
+    """A 64 bit hash of a name, never 0, which marks an empty slot"""
+    return (((zlib.crc32(key) & 0xffffffff) << 32) | (zlib.adler32(key) & 0xffffffff)) or 1
+
+
+class SharedArena(object):
+    """Encoded images by name, in a memory mapped file shared between processes
+    """
+
+    def __init__(self, path, size, slots):
+        """Open the arena, creating it if it does not exist or has a different layout
+
+        An arena with a different layout is replaced by a new file, never changed in place under the processes
+        using it.
+
+        :param path: Path of the file, normally under ``/dev/shm``
+        :type path: string
+        :param size: Size of the ring of records (bytes)
+        :type size: integer
+        :param slots: Number of slots in the index, the most images held
+        :type slots: integer
+        :raises: OSError, IOError
+        """
+        self._path = path
+        self._size = size
+        self._slots = slots
+        self._index_offset = _header_size
+        self._arena_offset = _header_size + ((slots * _slot.size + mmap.PAGESIZE - 1) // mmap.PAGESIZE) * mmap.PAGESIZE
+        length = self._arena_offset + size
+
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                    continue    # Replaced by another process while waiting for the lock
+                existing = os.fstat(fd).st_size
+                header = os.read(fd, _header.size) if existing >= _header.size else None
+                if existing == length and header is not None and _header.unpack(header)[:4] == (_magic, _version, slots, size):
+                    logger.info("Shared memory arena {} reused".format(path))
+                    self._map = mmap.mmap(fd, length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+                    self._fd = fd
+                    fd = None
+                    break
+                self._create(length)
+            finally:
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _create(self, length):
+        """Create an empty arena in a new file, replacing the file at the path
+
+        Processes that mapped the file replaced keep their mapping of it, and never see the new file truncated or
+        partly written.
+        """
+        temporary = "{}.{}.tmp".format(self._path, os.getpid())
+        fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.ftruncate(fd, length)
+            os.write(fd, _header.pack(_magic, _version, self._slots, self._size, 0, 0))
+        finally:
+            os.close(fd)
+        os.rename(temporary, self._path)
+        logger.info("Shared memory arena {} created, {} bytes, {} slots".format(self._path, self._size, self._slots))
+
+    def _head(self):
+        return struct.unpack_from("<Q", self._map, _head_offset)[0]
+
+    def writes(self):
+        """:rtype: integer count of images written by every process"""
+        return struct.unpack_from("<Q", self._map, _writes_offset)[0]
+
+    def _slot_offsets(self, key_hash):
+        first = key_hash % self._slots
+        return [self._index_offset + ((first + probe) % self._slots) * _slot.size for probe in range(_probes)]
+
+    def get(self, key):
+        """Find an image
+
+        :param key: Cannonical name of the image
+        :type key: string
+        :rtype: bytes, the encoded image, or None
+        """
+        key_hash = _hash(key)
+        for offset in self._slot_offsets(key_hash):
+            slot_hash, position, length, unused = _slot.unpack_from(self._map, offset)
+            if slot_hash != key_hash or position + self._size < self._head():
+                continue
+            start = self._arena_offset + position % self._size
+            record = self._map[start:start + length]
+            if len(record) < _record.size:
+                continue
+            record_position, record_hash, image_length, key_length = _record.unpack_from(record)
+            if (record_position != position or record_hash != key_hash or
+                _record.size + key_length + image_length != length or
+                record[_record.size:_record.size + key_length] != key):
+                continue
+            # The copy is good only if no writer reserved the space while it was read
+            if self._head() > position + self._size:
+                return None
+            return record[_record.size + key_length:]
+        return None
+
+    def contains(self, key):
+        """:rtype: boolean"""
+        key_hash = _hash(key)
+        head = self._head()
+        for offset in self._slot_offsets(key_hash):
+            slot_hash, position, length, unused = _slot.unpack_from(self._map, offset)
+            if slot_hash == key_hash and position + self._size >= head:
+                return True
+        return False
+
+    def put(self, key, the_bytes):
+        """Write an image, overwriting the oldest images if need be
+
+        :param key: Cannonical name of the image
+        :type key: string
+        :param the_bytes: The encoded image
+        :type the_bytes: bytes
+        :rtype: boolean, whether the image is written
+        """
+        length = _record.size + len(key) + len(the_bytes)
+        if length > self._size // 4:
+            return False
+        key_hash = _hash(key)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            head = self._head()
+            if head % self._size + length > self._size:
+                head += self._size - head % self._size    # Records do not wrap, start again at the beginning
+            position = head
+            # Reserve the space before overwriting it, so readers of the records it held discard them
+            struct.pack_into("<Q", self._map, _head_offset, position + length)
+            start = self._arena_offset + position % self._size
+            self._map[start:start + length] = _record.pack(position, key_hash, len(the_bytes), len(key)) + key + the_bytes
+
+            chosen = None
+            oldest = None
+            for offset in self._slot_offsets(key_hash):
+                slot_hash, slot_position, slot_length, unused = _slot.unpack_from(self._map, offset)
+                if slot_hash == key_hash or slot_hash == 0 or slot_position + self._size < position + length:
+                    chosen = offset
+                    break
+                if oldest is None or slot_position < oldest[1]:
+                    oldest = (offset, slot_position)
+            if chosen is None:
+                chosen = oldest[0]
+            _slot.pack_into(self._map, chosen, key_hash, position, length, 0)
+            struct.pack_into("<Q", self._map, _writes_offset, self.writes() + 1)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return True
+
+    def discard(self, key):
+        """Forget an image"""
+        key_hash = _hash(key)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for offset in self._slot_offsets(key_hash):
+                if _slot.unpack_from(self._map, offset)[0] == key_hash:
+                    _slot.pack_into(self._map, offset, 0, 0, 0, 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
@@ -0,0 +1,62 @@
+"""
+Size Ladder
+-----------
+
+Snapping of requested image sizes to a fixed ladder of rungs, so that nearly identical requests share one
+derived image, one cache entry and one stored object.
+
+Each requested dimension is raised to the smallest rung at or above it.  Dimensions larger than the top rung are
+left as requested.  In exact mode the image is still delivered at the requested size, but it is derived from the
+cached image at the snapped rung rather than from the base image, which is far cheaper.
+
+Hits and misses are counted per rung in Metrics, as ``ladder.<x>x<y>.hit`` and ``ladder.<x>x<y>.miss``.
+"""
+
+import bisect
+
+import Metrics
+
+
+class SizeLadder(object):
+    """A ladder of sizes
+    """
+
+    def __init__(self, rungs, exact = False):
+        """
+        :param rungs: Sizes of the rungs in pixels, an empty list disables snapping
+        :type rungs: list of integers
+        :param exact: Whether to deliver the requested size, derived from the snapped rung
+        :type exact: boolean
+        """
+        self._rungs = sorted(set(int(rung) for rung in rungs))
+        self.exact = exact
+
+    def enabled(self):
+        """:rtype: boolean"""
+        return len(self._rungs) > 0
+
+    def _snap_dimension(self, size):
+        if size is None:
+            return None
+        index = bisect.bisect_left(self._rungs, size)
+        return self._rungs[index] if index < len(self._rungs) else size
+
+    def snap(self, size):
+        """The rung a requested size is snapped to
+
+        :param size: The requested size
+        :type size: tuple (x_size, y_size)
+        :rtype: tuple (x_size, y_size)
+        """
+        return self._snap_dimension(size[0]), self._snap_dimension(size[1])
+
+    @staticmethod
+    def record(rung, hit):
+        """Count a request for a rung
+
+        :param rung: The snapped size
+        :type rung: tuple (x_size, y_size)
+        :param hit: Whether the rung was already cached
+        :type hit: boolean
+        """
+        Metrics.increment("ladder.{}x{}.{}".format(rung[0], rung[1], "hit" if hit else "miss"))
@@ -0,0 +1,108 @@
+"""
+Sprites
+-------
+
+Contact sheets, or sprites, combining the thumbnails of many images into one image.
+
+A sprite is a grid of equal cells, one per image in name order, each holding the image's thumbnail centred within
+it.  The map of cells is therefore determined by the selected names and the layout alone, and is returned alongside
+the sprite so that a client can show each thumbnail by its offset within the sprite.
+
+Sprites are cached as images whose name is derived from the selected names, the version of each selected image,
+and the layout, so a sprite is reused for as long as the selection is unchanged, and a new sprite is made when images
+are added to it, leave it or are replaced.  Sprites are not originals, and are never listed as images.
+"""
+
+import hashlib
+import logging
+
+import wand.image
+import wand.color
+import wand.exceptions
+
+from ImageNames import ImageName
+from ImageType import ImageHandle
+from Exceptions import RepositoryFailure
+
+logger = logging.getLogger("image_repository")
+
+# Sprites are named within this pseudo directory, which never holds originals
+name_prefix = "_sprites/"
+
+
+def is_sprite_object(name):
+    """Returns whether an image is a sprite
+
+    :param name: Name of the image
+    :type name: string
+    :rtype: boolean
+    """
+    return name.startswith(name_prefix)
+
+
+def sprite_name(names, versions, size, kind, quality, columns):
+    """The name of the sprite of the given images and layout
+
+    :param names: Base names of the images, in sprite order
+    :type names: list of strings
+    :param versions: Version of each image, changed when the image is replaced
+    :type versions: list of strings
+    :param size: Size of a cell
+    :type size: tuple (x_size, y_size)
+    :param kind: Format of the sprite and its thumbnails
+    :type kind: string
+    :param quality: Resampling tier of the thumbnails
+    :type quality: string
+    :param columns: Number of cells across the sprite
+    :type columns: integer
+    :rtype: ImageName
+    """
+    hasher = hashlib.md5()
+    hasher.update("{},{},{},{}\n".format(size[0], size[1], quality, columns))
+    for name, version in zip(names, versions):
+        for part in (name, version):
+            hasher.update(part.encode("utf-8") if isinstance(part, unicode) else part)
+            hasher.update("\n")
+    return ImageName(name_prefix + hasher.hexdigest(), kind = kind)
+
+
+def layout(names, size, columns):
+    """The cell of each image within the sprite
+
+    :param names: Base names of the images, in sprite order
+    :type names: list of strings
+    :param size: Size of a cell
+    :type size: tuple (x_size, y_size)
+    :param columns: Number of cells across the sprite
+    :type columns: integer
+    :rtype: dict of name : {"x", "y", "width", "height"}
+    """
+    return dict((name, {"x" : (index % columns) * size[0], "y" : (index // columns) * size[1],
+                        "width" : size[0], "height" : size[1]})
+                for index, name in enumerate(names))
+
+
+def compose(thumbnails, cells, size, columns, kind, background):
+    """Place thumbnails, centred in their cells, into a new sprite
+
+    :param thumbnails: Thumbnail of each image, by base name
+    :type thumbnails: dict of name : ImageInstance
+    :param cells: The layout of the sprite
+    :type cells: dict, see layout()
+    :param background: Colour of the cell area not covered by a thumbnail
+    :type background: string
+    :rtype: ImageHandle
+    """
+    rows = max(1, (len(cells) + columns - 1) // columns)
+    across = min(columns, max(1, len(cells)))
+    sprite = wand.image.Image(width = across * size[0], height = rows * size[1], background = wand.color.Color(background))
+    for name, thumbnail in thumbnails.iteritems():
+        cell = cells[name]
+        try:
+            with wand.image.Image(blob = thumbnail.get_image_handle().encoded_bytes()) as image:
+                sprite.composite(image, left = cell["x"] + (size[0] - image.width) // 2,
+                                 top = cell["y"] + (size[1] - image.height) // 2)
+        except (wand.exceptions.WandException, RepositoryFailure):
+            logger.exception("Thumbnail of {} cannot be placed in sprite".format(name))
+    sprite.format = kind
+    return ImageHandle(image = sprite, kind = kind)
@@ -0,0 +1,167 @@
+"""
+Startup
+-------
+
+Loading of the cache hierarchy in the background, so that the server answers requests from the moment it starts.
+
+Loading proceeds in phases, one per cache level, each recording how many objects it has indexed.  Until loading
+completes, requests for images already held in Swift are served by reading the object directly from the Swift cache
+or store, and requests that need the indexes, such as listings or new derivations, are refused with ``503`` and a
+``Retry-After`` header.
+
+Two endpoints report progress, for use as Kubernetes probes:
+
+* ``/healthz`` = the server is running, answered even while loading
+* ``/readyz`` = the caches are loaded and all requests can be served, otherwise ``503`` with the progress so far
+
+Work that is not needed to serve requests, such as reading the retention times of cached objects, continues in
+the background once the server is ready.
+"""
+
+import time
+import logging
+import threading
+import traceback
+import functools
+from collections import OrderedDict
+
+import Stores
+from Exceptions import RepositoryError
+from Exceptions import RepositoryFailure
+
+logger = logging.getLogger("image_repository")
+
+_lock = threading.RLock()
+_phases = OrderedDict()    # phase : {"state", "objects", "seconds"}
+_started = time.time()
+_ready = False
+_error = None
+_direct_stores = None
+
+
+def begin(phase):
+    """Record the start of a phase of loading
+
+    :param phase: Name of the phase
+    :type phase: string
+    """
+    with _lock:
+        _phases[phase] = {"state" : "loading", "objects" : 0, "seconds" : time.time()}
+    logger.info("Startup: {} loading".format(phase))
+
+
+def advance(phase, objects):
+    """Record the number of objects a phase has loaded so far"""
+    with _lock:
+        if phase in _phases:
+            _phases[phase]["objects"] = objects
+
+
+def complete(phase):
+    """Record the end of a phase of loading"""
+    with _lock:
+        if phase in _phases:
+            _phases[phase]["state"] = "ready"
+            _phases[phase]["seconds"] = time.time() - _phases[phase]["seconds"]
+    logger.info("Startup: {} ready".format(phase))
+
+
+def ready():
+    """:rtype: boolean"""
+    return _ready
+
+
+def report():
+    """The progress of loading
+
+    :rtype: dict
+    """
+    with _lock:
+        phases = OrderedDict()
+        for phase, progress in _phases.iteritems():
+            phases[phase] = dict(progress)
+            if progress["state"] == "loading":
+                phases[phase]["seconds"] = time.time() - progress["seconds"]
+        return {"ready" : _ready, "error" : _error, "uptime" : time.time() - _started, "phases" : phases}
+
+
+def start(load, configuration, then = None):
+    """Load the caches in a background thread
+
+    :param load: Loads the caches
+    :type load: function
+    :param configuration: The system configuration, from which direct store access is made while loading
+    :type configuration: Configuration
+    :param then: Called, in the same thread, once the caches are loaded and the server is ready
+    :type then: function or None
+    :rtype: threading.Thread
+    """
+    global _direct_stores
+
+    try:
+        _direct_stores = [Stores.SwiftImageStore(configuration.swift_cache_configuration, None),
+                          Stores.SwiftImageStore(configuration.persistent_store_configuration, None)]
+    except Exception:
+        logger.exception("Startup: no direct store access while loading")
+        _direct_stores = []
+
+    def background():
+        global _ready, _error
+        try:
+            load()
+            _ready = True
+            logger.info("Startup: ready after {:.1f} seconds".format(time.time() - _started))
+        except Exception as ex:
+            _error = "{}".format(ex) or ex.__class__.__name__
+            logger.error("Startup: loading fails\n{}".format(traceback.format_exc()))
+            return
+        if then is not None:
+            then()
+
+    worker = threading.Thread(target = background, name = "startup")
+    worker.daemon = True
+    worker.start()
+    return worker
+
+
+def direct_get(name):
+    """Read an image directly from the Swift cache or store, while the caches are loading
+
+    :param name: Name of the image
+    :type name: ImageName or string
+    :rtype: bytes or None if neither holds the image
+    """
+    for store in _direct_stores or []:
+        try:
+            the_bytes = store.get_object(str(name))
+        except (RepositoryError, RepositoryFailure):
+            logger.exception("Startup: direct read of {} fails".format(name))
+            continue
+        if the_bytes is not None:
+            return the_bytes
+    return None
+
+
+def unavailable():
+    """The error to return for requests that cannot be served until the caches are loaded
+
+    :rtype: tuple (body, status, headers)
+    """
+    if _error is not None:
+        return {"message" : "Repository failed to start", "error" : _error}, 503
+    return {"message" : "Repository is starting", "progress" : report()["phases"]}, 503, {"Retry-After" : "5"}
+
+
+def when_ready(method):
+    """Decorate a request method that needs the caches, so that it is refused until they are loaded
+
+    :param method: The request method
+    :type method: function
+    :rtype: function
+    """
+    @functools.wraps(method)
+    def checked(*args, **kwargs):
+        if not _ready:
+            return unavailable()
+        return method(*args, **kwargs)
+    return checked
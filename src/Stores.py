@@ -4,7 +4,9 @@ import os
 import logging
 import traceback
 import time
+import mimetypes
 
+import Manifest
 from Exceptions import RepositoryError
 from Exceptions import RepositoryFailure
 from ImageNames import ImageName
@@ -37,6 +39,12 @@ class ImageStore(object):
     def store_image(self, image):
         pass
 
+    def get_object(self, name, offset = None, length = None):
+        """
+        Read an object, or a range of bytes within it, directly from the store, if the store supports it.
+        """
+        return None
+
     def delete_image(self, image):
         """
         Delete an image by name from the store
@@ -85,6 +93,9 @@ class SwiftImageStore(ImageStore):
 
         self._health_attempts = 0
         self._health_operations = 0
+
+        # Only stores of the caches keep the manifest, not those reading directly while the caches load
+        self._manifest = Manifest.ContainerManifest(self, configuration) if configuration.use_manifest and cache is not None else None
     
         try:
             options = {}
@@ -137,19 +148,83 @@ class SwiftImageStore(ImageStore):
         self._file_cache_path = cache._file_cache_path
     
     def list_images(self):
+        """
+        Returns a list of all objects in the store, other than those of its manifest.
+        The manifest is read, rather than the container listed, where it is kept.
+        :rtype: list of tuples (name, size, content type)
+        """
+        if self._manifest is not None:
+            if not self._manifest.loaded():
+                try:
+                    self._manifest.load()
+                except RepositoryError:
+                    self._logger.exception("Manifest of {} cannot be read, listing the container".format(self._store))
+                    self._manifest = None
+            if self._manifest is not None:
+                return self._manifest.listing()
+
         options = {"long" : True}
         results = self._swift.list(self._store, options)
         listing = []
         for result in results:  # In principle it seems we could have more than one, although it doesn't seem to happen.
             if result["success"]:
                 for element in result["listing"]:
-                    listing.append((element["name"], element["bytes"], element["content_type"]))
+                    if not Manifest.is_manifest_object(element["name"]):
+                        listing.append((element["name"], element["bytes"], element["content_type"]))
             else:
                 self._logger.error("Failure in Swift container listing : {}".format(result["error"]))
                 raise RepositoryError
 
         return listing
 
+    def list_objects(self, prefix = None, marker = None):
+        """
+        List the objects of the container, or those with a prefix or after a marker, and the container's statistics.
+        :param prefix: Prefix of the names of the objects to list
+        :type prefix: string
+        :param marker: List only the objects whose names follow this
+        :type marker: string
+        :rtype: tuple (dict of container headers, list of dicts with name, bytes, content_type)
+        :raises: RepositoryError
+        """
+        try:
+            headers, listing = self._swift_connection.get_container(self._store, prefix = prefix, marker = marker or None,
+                                                                    full_listing = True)
+        except swiftclient.client.ClientException as ex:
+            self._logger.exception("Swift Client Exception in listing of {}".format(self._store))
+            raise RepositoryError("Swift Client Exception in listing of {}".format(self._store))
+        self._health()
+        return headers, listing
+
+    def follow(self, listener):
+        """
+        Follow the changes other servers make to the store, where a manifest is kept.
+        :param listener: Called with the operation, object name and recorded value of each change
+        :type listener: function
+        :rtype: boolean, whether the changes are followed
+        """
+        if self._manifest is None:
+            return False
+        self._manifest.follow(listener)
+        return True
+
+    def lifetimes(self, names):
+        """
+        Find the retention times of objects, from the manifest where it is kept.
+        :param names: Names of the objects
+        :type names: list
+        :rtype: list of pairs (name, retain until)
+        """
+        if self._manifest is not None and self._manifest.loaded():
+            return self._manifest.lifetimes(names)
+        results = []
+        for name, meta in self.find_metadata(names, ['lifetime']):
+            try:
+                results.append((name, float(meta['lifetime'])))
+            except (KeyError, ValueError):
+                continue
+        return results
+
 
     def download_images(self, image_names, path):
         """
@@ -192,6 +267,55 @@ class SwiftImageStore(ImageStore):
             
         return image_paths
 
+    def get_object(self, name, offset = None, length = None):
+        """
+        Read an object, or a range of bytes within it, directly from the store.
+        :param name: Name of the object in the store
+        :type name: string
+        :param offset: Offset of the first byte to read, or None for the whole object
+        :type offset: integer
+        :param length: Number of bytes to read from the offset
+        :type length: integer
+        :rtype: bytes, or None if there is no such object
+        """
+        headers = {}
+        if offset is not None:
+            headers["Range"] = "bytes={}-{}".format(offset, offset + length - 1)
+        try:
+            result, the_bytes = self._swift_connection.get_object(container = self._store, obj = name, headers = headers)
+        except swiftclient.client.ClientException as ex:
+            if ex.http_status == 404:
+                return None
+            self._logger.exception("Swift Client Exception in read of {}".format(name))
+            raise RepositoryError("Swift Client Exception in read of {}".format(name))
+        self._health()
+        return the_bytes
+
+
+    def create_object(self, name, the_bytes, delete_after = None):
+        """
+        Write an object only if there is no object of the name, so that only one server writing it succeeds.
+        :param name: Name of the object in the store
+        :type name: string
+        :param the_bytes: Content of the object
+        :type the_bytes: bytes
+        :param delete_after: Seconds after which the store removes the object, or None
+        :type delete_after: integer
+        :rtype: boolean, whether the object is written
+        :raises: RepositoryError
+        """
+        headers = {"If-None-Match" : "*"}
+        if delete_after is not None:
+            headers["X-Delete-After"] = str(int(delete_after))
+        try:
+            self._swift_connection.put_object(self._store, name, the_bytes, headers = headers)
+        except swiftclient.client.ClientException as ex:
+            if ex.http_status == 412:
+                return False
+            self._logger.exception("Swift Client Exception in creation of {}".format(name))
+            raise RepositoryError("Swift Client Exception in creation of {}".format(name))
+        self._health()
+        return True
 
     def get_images(self, image_names):
         if self._use_file_cache:
@@ -268,6 +392,7 @@ class SwiftImageStore(ImageStore):
         """        
         try:
             options = {}
+            size = self._object_size(image)
             swift_upload = [swiftclient.service.SwiftUploadObject(image, object_name = name)]
 
             response = self._swift.upload(self._store, swift_upload, options)
@@ -287,6 +412,8 @@ class SwiftImageStore(ImageStore):
                     continue
 
             self._logger.info("{}   Image uploaded {}".format(self.__class__.__name__, name))
+            if self._manifest is not None and size is not None:
+                self._manifest.put(name, size, mimetypes.guess_type(name)[0] or "application/octet-stream")
             return name
         except (swiftclient.client.ClientException, swiftclient.service.SwiftError) as ex:
             self._logger.exception("Exception in upload of images {}".format(image))
@@ -295,6 +422,19 @@ class SwiftImageStore(ImageStore):
             self._logger.exception("Unhandled exception during upload of images {}".format(images))
             raise RepositoryError
 
+    @staticmethod
+    def _object_size(image):
+        """The size of an object to be uploaded, from a file like object or the path of a file, or None"""
+        try:
+            if isinstance(image, basestring):
+                return os.path.getsize(image)
+            position = image.tell()
+            image.seek(0, os.SEEK_END)
+            size = image.tell() - position
+            image.seek(position)
+            return size
+        except (AttributeError, IOError, OSError):
+            return None
     
     def delete_images(self, image_names):
        try:
@@ -303,6 +443,8 @@ class SwiftImageStore(ImageStore):
             for result in response:
                 if result["success"]:
                     self._logger.debug("Deleted image {}".format(image_names))
+                    if self._manifest is not None and "object" in result:
+                        self._manifest.delete(result["object"])
                 else:
                     if "error" in result:
                         if isinstance(result["error"], Exception):
@@ -549,6 +691,8 @@ class SwiftImageStore(ImageStore):
         #        self._url_expiry = now + seconds
 
         self._write_metadata(name, [ u'lifetime:{}'.format(lifetime) ] )
+        if self._manifest is not None:
+            self._manifest.retain(str(name), float(lifetime))
 #        metadata = self._read_metadata(name)
         return self._configuration.server_url + url
 
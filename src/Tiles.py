@@ -0,0 +1,509 @@
+"""
+Tile Pyramids
+-------------
+
+Deep zoom (DZI) tile pyramids of very large images, so that viewers fetch only the tiles they display.
+
+A pyramid has a level for each halving of the image, from the full resolution image at the highest level down to
+a single pixel at level 0.  Each level is cut into square tiles of ``tile_size`` pixels, overlapping their
+neighbours by ``overlap`` pixels, as described by the DZI descriptor.
+
+Each level is stored compactly as a single packed object holding every tile of the level end to end, plus an
+index giving the offset and length of each tile within it.  Levels are kept in a local directory and copied to
+the Swift cache, from which a single tile is fetched with a ranged read of the packed object.
+
+Images with fewer than ``min_pixels`` pixels are not tiled, viewers being better served by the image itself.  Each
+level is generated when a tile of it is first asked for, from the image scaled to the size of the level, so a viewer
+that looks at a few levels does not wait for the whole pyramid.  When a large image is uploaded the whole pyramid is
+generated in the background, in a single pass.  The levels kept in the local directory are limited to ``max_size``
+bytes, those least recently read being removed first.
+
+A pass over the whole pyramid streams through the image in strips of tile rows.  The base image is decoded under the configured
+resource limits, so a very large image is held in a disk backed pixel cache rather than in memory, and only one
+strip at a time is read from it.  Tiles are cut from the strip, and the strip is halved and placed into the next
+level down, which is then tiled in the same way.
+"""
+
+import os
+import json
+import math
+import logging
+import cStringIO
+import mimetypes
+from threading import RLock
+from threading import Thread
+from collections import OrderedDict
+
+import wand.image
+
+from ImageNames import ImageName
+from Exceptions import RepositoryError
+from Exceptions import RepositoryFailure
+
+logger = logging.getLogger("image_repository")
+
+# Objects in the Swift cache with names starting with this are tile levels, not images
+object_prefix = "_tiles/"
+
+
+def is_tile_object(name):
+    """Returns whether a Swift object is part of a tile pyramid
+
+    :param name: Name of the object
+    :type name: string
+    :rtype: boolean
+    """
+    return name.startswith(object_prefix)
+
+
+class PyramidGeometry(object):
+    """The levels and tiles of a pyramid over an image of given dimensions
+
+    * width, height = dimensions of the full resolution image
+    * tile_size = width and height of a tile, excluding overlap
+    * overlap = pixels each tile shares with each of its neighbours
+    * max_level = the full resolution level
+    """
+
+    def __init__(self, width, height, tile_size, overlap):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.max_level = int(math.ceil(math.log(max(width, height, 1), 2)))
+
+    def level_size(self, level):
+        """:rtype: tuple (width, height)"""
+        scale = float(2 ** (self.max_level - level))
+        return max(1, int(math.ceil(self.width / scale))), max(1, int(math.ceil(self.height / scale)))
+
+    def tile_count(self, level):
+        """:rtype: tuple (columns, rows)"""
+        width, height = self.level_size(level)
+        return int(math.ceil(width / float(self.tile_size))), int(math.ceil(height / float(self.tile_size)))
+
+    def tile_span(self, index, length):
+        """The pixel range along one axis of the tile at ``index``, including its overlap
+
+        :rtype: tuple (start, end)
+        """
+        start = index * self.tile_size - (self.overlap if index > 0 else 0)
+        return start, min(length, (index + 1) * self.tile_size + self.overlap)
+
+    def dzi(self, kind):
+        """The DZI descriptor of the pyramid
+
+        :rtype: string
+        """
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{}" Overlap="{}" TileSize="{}">'
+                '<Size Width="{}" Height="{}"/></Image>\n').format(kind, self.overlap, self.tile_size, self.width, self.height)
+
+
+class _LevelWriter(object):
+    """Writes the tiles of a level into a packed file and its index"""
+
+    def __init__(self, pack_path, index_path, geometry, level):
+        self._pack_path = pack_path
+        self._index_path = index_path
+        self._pack = open(pack_path + ".tmp", 'wb')
+        self._offset = 0
+        self._index = {"width" : geometry.width, "height" : geometry.height, "level" : level, "tiles" : {}}
+
+    def add(self, column, row, the_bytes):
+        self._pack.write(the_bytes)
+        self._index["tiles"]["{}_{}".format(column, row)] = [self._offset, len(the_bytes)]
+        self._offset += len(the_bytes)
+
+    def close(self):
+        """Complete the level, making it visible to readers
+
+        :rtype: dict, the index
+        """
+        self._pack.close()
+        with open(self._index_path + ".tmp", 'w') as the_file:
+            json.dump(self._index, the_file, separators = (',', ':'))
+        os.rename(self._pack_path + ".tmp", self._pack_path)
+        os.rename(self._index_path + ".tmp", self._index_path)
+        return self._index
+
+    def abandon(self):
+        """Discard a level that could not be completed"""
+        self._pack.close()
+        os.remove(self._pack_path + ".tmp")
+
+
+class TilePyramidCache(object):
+    """Generates, stores and serves the tile pyramids of images
+
+    Pyramids are keyed by base name and tile format.  The tiling parameters form part of the key, so a change of
+    configuration yields new pyramids rather than serving stale ones.
+
+    Levels are generated when first asked for, each on its own, except when a large image is uploaded, when the
+    whole pyramid is generated in the background.  The levels kept locally are limited to ``max_size`` bytes, those
+    least recently read being removed first, to be read again from Swift, or generated again.
+    """
+
+    def __init__(self, configuration, store = None):
+        """Construct the tile pyramid cache
+
+        :param configuration: Configuration for tile pyramids
+        :type configuration: Configuration.TileConfig
+        :param store: Swift store in which to keep copies of the levels, if any
+        :type store: Stores.SwiftImageStore or None
+        :raises: RepositoryError if the configuration is invalid or the directory cannot be made
+        """
+        if configuration.tile_size < 2 or configuration.tile_size % 2 != 0:
+            raise RepositoryError("Tile size {} must be even and at least 2".format(configuration.tile_size))
+        if configuration.overlap < 0 or configuration.overlap * 2 >= configuration.tile_size:
+            raise RepositoryError("Tile overlap {} must be at least 0 and less than half the tile size".format(
+                configuration.overlap))
+        self._configuration = configuration
+        self._cache_path = configuration.cache_path
+        self._store = store if configuration.use_swift else None
+        self._indexes = {}        # (key, level) : index
+        self._remote = set()      # (key, level) whose pack is only in Swift
+        self._geometries = {}     # key : PyramidGeometry
+        self._levels = OrderedDict()    # (key, level) : bytes held locally, least recently read first
+        self._size = 0
+        self._lock = RLock()
+        self._generating = {}     # key : RLock held while its levels are generated
+        if not os.path.isdir(self._cache_path):
+            try:
+                os.makedirs(self._cache_path, 0700)
+            except OSError:
+                logger.exception("Unable to create tile directory {}".format(self._cache_path))
+                raise RepositoryError("Unable to create tile directory {}".format(self._cache_path))
+        self._scan()
+
+    def _key(self, base_name, kind):
+        return "{}/{}_{}_{}".format(ImageName.safe_name(base_name), self._configuration.tile_size,
+                                    self._configuration.overlap, kind)
+
+    def _paths(self, key, level):
+        """:rtype: tuple (pack path, index path)"""
+        directory = os.path.join(self._cache_path, key)
+        return os.path.join(directory, "{}.pack".format(level)), os.path.join(directory, "{}.idx".format(level))
+
+    @staticmethod
+    def _object_names(key, level):
+        """:rtype: tuple (pack object name, index object name)"""
+        return "{}{}/{}.pack".format(object_prefix, key, level), "{}{}/{}.idx".format(object_prefix, key, level)
+
+    def _scan(self):
+        """Find the levels kept locally by an earlier run, least recently read first"""
+        found = []
+        for directory, subdirectories, files in os.walk(self._cache_path):
+            for name in files:
+                if not name.endswith(".idx"):
+                    continue
+                level = name[:-len(".idx")]
+                if not level.isdigit():
+                    continue
+                try:
+                    pack = os.stat(os.path.join(directory, level + ".pack"))
+                    index = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                key = os.path.relpath(directory, self._cache_path)
+                found.append((pack.st_atime, (key, int(level)), pack.st_size + index.st_size))
+        for accessed, level, size in sorted(found):
+            self._levels[level] = size
+            self._size += size
+        self._evict()
+
+    def _held(self, key, level):
+        """Account for a level written locally, and remove the least recently read levels beyond the limit"""
+        pack_path, index_path = self._paths(key, level)
+        size = os.path.getsize(pack_path) + os.path.getsize(index_path)
+        with self._lock:
+            self._size += size - self._levels.pop((key, level), 0)
+            self._levels[(key, level)] = size
+        self._evict()
+
+    def _touch(self, key, level):
+        with self._lock:
+            size = self._levels.pop((key, level), None)
+            if size is not None:
+                self._levels[(key, level)] = size
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self._configuration.max_size or len(self._levels) <= 1:
+                    return
+                (key, level), size = self._levels.popitem(last = False)
+                self._size -= size
+                self._indexes.pop((key, level), None)
+            for path in self._paths(key, level):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            logger.debug("Tile level {} of {} removed from the local tile cache".format(level, key))
+
+    def _index(self, key, level):
+        """Find the index of a level, locally or in Swift
+
+        :rtype: dict or None
+        """
+        with self._lock:
+            if (key, level) in self._indexes:
+                return self._indexes[(key, level)]
+        index = None
+        pack_path, index_path = self._paths(key, level)
+        try:
+            with open(index_path, 'r') as the_file:
+                index = json.load(the_file)
+        except IOError:
+            if self._store is not None:
+                the_bytes = self._store.get_object(self._object_names(key, level)[1])
+                if the_bytes is not None:
+                    index = json.loads(the_bytes)
+                    with self._lock:
+                        self._remote.add((key, level))
+        if index is not None:
+            with self._lock:
+                self._indexes[(key, level)] = index
+        return index
+
+    def _generation_lock(self, key):
+        with self._lock:
+            return self._generating.setdefault(key, RLock())
+
+    def _make_directory(self, key):
+        directory = os.path.join(self._cache_path, key)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0700)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def generate(self, base_name, base_image, kind):
+        """Generate the complete pyramid of an image, unless it already exists
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param base_image: Function returning the base image to tile
+        :type base_image: callable returning ImageType.BaseImageInstance
+        :param kind: Tile format
+        :type kind: string
+        :raises: RepositoryError, RepositoryFailure
+        """
+        key = self._key(base_name, kind)
+        geometry = self.geometry(base_name, base_image, kind)
+        with self._generation_lock(key):
+            if all(self._index(key, level) is not None for level in range(geometry.max_level + 1)):
+                return
+            # Decoded under the resource limits, disk backed if very large
+            image = base_image().get_image_handle()._get_image()
+            logger.info("Generating {} level tile pyramid for {}".format(geometry.max_level + 1, base_name))
+            self._make_directory(key)
+            source = self._scaled(image, geometry.level_size(geometry.max_level))
+            try:
+                for level in range(geometry.max_level, -1, -1):
+                    below = self._tile_level(source, geometry, level, kind, key, level > 0)
+                    if source is not image:
+                        source.close()    # An intermediate level, no longer needed
+                    source = below
+                    self._upload(key, level)
+            finally:
+                if source is not None and source is not image:
+                    source.close()
+
+    def _generate_level(self, base_name, base_image, kind, geometry, level):
+        """Generate a single level of the pyramid of an image, unless it already exists
+
+        The level is cut from the image scaled to the size of the level, so no other level need be generated.
+
+        :raises: RepositoryError, RepositoryFailure
+        """
+        key = self._key(base_name, kind)
+        with self._generation_lock(key):
+            if self._index(key, level) is not None:
+                return
+            image = base_image().get_image_handle()._get_image()
+            logger.info("Generating level {} of the tile pyramid of {}".format(level, base_name))
+            self._make_directory(key)
+            source = self._scaled(image, geometry.level_size(level))
+            try:
+                self._tile_level(source, geometry, level, kind, key, False)
+            finally:
+                if source is not image:
+                    source.close()
+            self._upload(key, level)
+
+    @staticmethod
+    def _scaled(image, size):
+        """The image, or a copy of it scaled to the size if it is not that size
+
+        :rtype: wand.image.Image
+        """
+        if (image.width, image.height) == size:
+            return image
+        scaled = image.clone()
+        scaled.resize(*size)
+        return scaled
+
+    def _tile_level(self, source, geometry, level, kind, key, halve):
+        """Cut one level into tiles, strip by strip, and build the level below it if asked to
+
+        :param source: The image at this level's resolution
+        :type source: wand.image.Image
+        :param halve: Whether to build the image of the level below
+        :type halve: boolean
+        :rtype: wand.image.Image, the image of the level below, or None
+        """
+        width, height = geometry.level_size(level)
+        columns, rows = geometry.tile_count(level)
+        below = None
+        if halve:
+            below_width, below_height = geometry.level_size(level - 1)
+            below = wand.image.Image(width = below_width, height = below_height)
+
+        pack_path, index_path = self._paths(key, level)
+        writer = _LevelWriter(pack_path, index_path, geometry, level)
+        try:
+            for row in range(rows):
+                top, bottom = geometry.tile_span(row, height)
+                with source[0:width, top:bottom] as strip:
+                    for column in range(columns):
+                        left, right = geometry.tile_span(column, width)
+                        with strip[left:right, 0:bottom-top] as tile:
+                            writer.add(column, row, tile.make_blob(kind))
+                    if below is not None:
+                        # Halve the rows of the strip that belong to this row of tiles, excluding the overlap
+                        core_top = row * geometry.tile_size
+                        core_bottom = min(height, core_top + geometry.tile_size)
+                        with strip[0:width, core_top-top:core_bottom-top] as core:
+                            core.resize(max(1, (width + 1) // 2), max(1, (core_bottom - core_top + 1) // 2))
+                            below.composite(core, 0, core_top // 2)
+        except Exception:
+            writer.abandon()
+            if below is not None:
+                below.close()
+            raise
+        index = writer.close()
+        with self._lock:
+            self._indexes[(key, level)] = index
+            self._remote.discard((key, level))
+        self._held(key, level)
+        return below
+
+    def _upload(self, key, level):
+        """Copy a level to the Swift cache, its index last so that its presence marks completion"""
+        if self._store is None:
+            return
+        for path, name in zip(self._paths(key, level), self._object_names(key, level)):
+            try:
+                with open(path, 'rb') as the_file:
+                    self._store.store_image(the_file, name)
+            except (IOError, RepositoryError):
+                logger.exception("Upload of tile level {} fails".format(name))
+                return
+
+    def _read(self, key, level, offset, length):
+        pack_path = self._paths(key, level)[0]
+        try:
+            with open(pack_path, 'rb') as the_file:
+                the_file.seek(offset)
+                the_bytes = the_file.read(length)
+            self._touch(key, level)
+            return the_bytes
+        except IOError:
+            pass
+        if self._store is not None:
+            return self._store.get_object(self._object_names(key, level)[0], offset, length)
+        return None
+
+    def geometry(self, base_name, base_image, kind):
+        """The geometry of an image's pyramid, from a level already generated or the header of the image
+
+        :rtype: PyramidGeometry
+        :raises: RepositoryFailure if the image is too small to tile, or its dimensions are unavailable
+        """
+        key = self._key(base_name, kind)
+        with self._lock:
+            geometry = self._geometries.get(key)
+        if geometry is not None:
+            return geometry
+        index = self._index(key, 0)
+        if index is not None:
+            geometry = PyramidGeometry(index["width"], index["height"], self._configuration.tile_size,
+                                       self._configuration.overlap)
+            with self._lock:
+                self._geometries[key] = geometry
+            return geometry
+        header = base_image().get_image_handle().header()
+        if header is None:
+            raise RepositoryFailure("Dimensions of image '{}' unavailable".format(base_name))
+        if header.pixels() < self._configuration.min_pixels:
+            raise RepositoryFailure("Image '{}' is too small to tile".format(base_name), 404)
+        geometry = PyramidGeometry(header.width, header.height, self._configuration.tile_size, self._configuration.overlap)
+        with self._lock:
+            self._geometries[key] = geometry
+        return geometry
+
+    def get_tile(self, base_name, base_image, level, column, row, kind):
+        """Return a single tile, generating its level if need be
+
+        :param base_name: Base name of the image
+        :type base_name: string
+        :param base_image: Function returning the base image, called only if the level must be generated
+        :type base_image: callable returning ImageType.BaseImageInstance
+        :param level: Pyramid level
+        :type level: integer
+        :param column: Tile column
+        :type column: integer
+        :param row: Tile row
+        :type row: integer
+        :param kind: Tile format
+        :type kind: string
+        :rtype: bytes
+        :raises: RepositoryFailure
+        """
+        geometry = self.geometry(base_name, base_image, kind)
+        if level < 0 or level > geometry.max_level:
+            raise RepositoryFailure("No level {} in tile pyramid of {}".format(level, base_name), 404)
+        key = self._key(base_name, kind)
+        for attempt in range(2):
+            index = self._index(key, level)
+            if index is None:
+                self._generate_level(base_name, base_image, kind, geometry, level)
+                index = self._index(key, level)
+                if index is None:
+                    raise RepositoryFailure("Tile level {} of {} unavailable".format(level, base_name), 404)
+            try:
+                offset, length = index["tiles"]["{}_{}".format(column, row)]
+            except KeyError:
+                raise RepositoryFailure("No tile {}_{} in level {} of {}".format(column, row, level, base_name), 404)
+            the_bytes = self._read(key, level, offset, length)
+            if the_bytes is not None:
+                return the_bytes
+            with self._lock:
+                self._indexes.pop((key, level), None)    # Removed from the local tile cache while being read
+        raise RepositoryFailure("Tile {}_{} of {} unavailable".format(column, row, base_name), 404)
+
+    def consider(self, base_name, base_image, header):
+        """Generate the pyramid of a newly uploaded image in the background, if it is large enough
+
+        :param header: Header of the uploaded image
+        :type header: ImageHeaders.ImageHeader or None
+        """
+        threshold = self._configuration.upload_pixels
+        if threshold == 0 or header is None or header.pixels() < threshold:
+            return
+        def background():
+            try:
+                self.generate(base_name, base_image, self._configuration.default_format)
+            except (RepositoryError, RepositoryFailure, IOError, OSError):
+                logger.exception("Background tile pyramid generation fails for {}".format(base_name))
+        worker = Thread(target = background, name = "tiles")
+        worker.daemon = True
+        worker.start()
+
+    @staticmethod
+    def mimetype(kind):
+        """:rtype: string"""
+        return mimetypes.guess_type("tile." + kind)[0] or "application/octet-stream"
@@ -0,0 +1,91 @@
+"""Tests of the compact index of the Swift backed cache levels, and of the mapping of base images"""
+
+import gc
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import CacheIndex
+
+
+class Image(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class TestCompactIndex(unittest.TestCase):
+
+    def setUp(self):
+        objects = [("dir/b.jpg", 10, False, False), ("dir/a+size(40,30).jpg", 20, False, False),
+                   ("dir/a.jpg", 30, False, True), ("dir/ab.jpg", 40, False, False), ("other/a.jpg", 50, False, False)]
+        self.index = CacheIndex.CompactIndex(objects, Image)
+
+    def test_prefix_finds_only_names_with_prefix(self):
+        self.assertEqual(list(self.index.iterprefix("dir/a")), ["dir/a+size(40,30).jpg", "dir/a.jpg", "dir/ab.jpg"])
+        self.assertEqual(list(self.index.iterprefix("dir/c")), [])
+        self.assertEqual(list(self.index.iterprefix("")), sorted(self.index.keys()))
+
+    def test_prefix_skips_deleted_and_covers_added_names(self):
+        del self.index["dir/a.jpg"]
+        self.index["dir/a+rotate(90).jpg"] = object()
+        self.assertEqual(sorted(self.index.iterprefix("dir/a")), ["dir/a+rotate(90).jpg", "dir/a+size(40,30).jpg", "dir/ab.jpg"])
+
+
+class TestLazyImages(unittest.TestCase):
+
+    def setUp(self):
+        self.images = CacheIndex.LazyImages()
+        self.made = []
+
+    def make(self, name):
+        def function():
+            self.made.append(name)
+            return Image(name)
+        return function
+
+    def test_images_are_made_when_first_looked_up(self):
+        self.images.defer("a", self.make("a"))
+        self.assertIn("a", self.images)
+        self.assertEqual(self.made, [])
+        image = self.images["a"]
+        self.assertIs(self.images["a"], image)
+        self.assertEqual(self.made, ["a"])
+
+    def test_images_are_not_held_once_unused(self):
+        self.images.defer("a", self.make("a"))
+        self.images["a"]
+        gc.collect()
+        self.assertEqual(len(self.images._images), 0)
+        self.assertEqual(self.images["a"].name, "a")
+        self.assertEqual(self.made, ["a", "a"])
+        self.assertEqual(self.images.keys(), ["a"])
+
+    def test_images_given_are_used_until_unused(self):
+        image = Image("a")
+        self.images.defer("a", self.make("a"), image)
+        self.assertIs(self.images["a"], image)
+        del image
+        gc.collect()
+        self.assertEqual(self.images["a"].name, "a")
+        self.assertEqual(self.made, ["a"])
+
+    def test_removed_names_are_forgotten(self):
+        self.images.defer("a", self.make("a"))
+        del self.images["a"]
+        self.assertNotIn("a", self.images)
+        self.assertIsNone(self.images.get("a"))
+
+    def test_copy_shares_images(self):
+        image = Image("a")
+        self.images.defer("a", self.make("a"), image)
+        self.images.defer("b", self.make("b"))
+        the_copy = self.images.copy()
+        self.assertIs(the_copy["a"], image)
+        self.assertEqual(sorted(the_copy.keys()), ["a", "b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
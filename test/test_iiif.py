@@ -0,0 +1,59 @@
+"""Tests of the translation of IIIF Image API requests into image names"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import IIIF
+from ImageNames import ImageName
+from ImageHeaders import ImageHeader
+from Exceptions import RepositoryFailure
+
+
+class Configuration(object):
+    resample_default_quality = "best"
+
+
+class TestIIIF(unittest.TestCase):
+
+    def setUp(self):
+        ImageName.set_configuration(Configuration())
+        self.header = ImageHeader("JPEG", 4000, 3000)
+
+    def test_region(self):
+        self.assertIsNone(IIIF.region("full", 4000, 3000))
+        self.assertEqual(IIIF.region("square", 4000, 3000), (500, 0, 3000, 3000))
+        self.assertEqual(IIIF.region("pct:50,50,50,50", 4000, 3000), (2000, 1500, 2000, 1500))
+        self.assertEqual(IIIF.region("3000,2000,2000,2000", 4000, 3000), (3000, 2000, 1000, 1000))
+        self.assertRaises(RepositoryFailure, IIIF.region, "5000,0,10,10", 4000, 3000)
+
+    def test_size(self):
+        self.assertEqual(IIIF.size("max", 4000, 3000), (4000, 3000))
+        self.assertEqual(IIIF.size("400,", 4000, 3000), (400, 300))
+        self.assertEqual(IIIF.size(",300", 4000, 3000), (400, 300))
+        self.assertEqual(IIIF.size("!400,400", 4000, 3000), (400, 300))
+        self.assertEqual(IIIF.size("pct:10", 4000, 3000), (400, 300))
+        self.assertEqual(IIIF.size("400,400", 4000, 3000), (400, 400))
+        self.assertRaises(RepositoryFailure, IIIF.size, "5000,", 4000, 3000)
+        self.assertEqual(IIIF.size("^5000,", 4000, 3000), (5000, 3750))
+
+    def test_image_name_scales_region_to_exact_size(self):
+        name = IIIF.image_name("dir/image", self.header, "0,0,2000,2000", "400,200", "90", "default", "jpg")
+        self.assertEqual(str(name), "dir/image+crop(2000,2000,0,0)+scale(400,200)+rotate(90).jpg")
+        self.assertTrue(name.is_scale())
+
+    def test_unchanged_parameters_add_no_operations(self):
+        name = IIIF.image_name("dir/image", self.header, "full", "max", "0", "default", "png")
+        self.assertEqual(str(name), "dir/image.png")
+
+    def test_info_advertises_exact_sizes(self):
+        info = IIIF.info("dir%2Fimage", "http://host/iiif/", self.header, 254)
+        self.assertEqual(info["profile"], "level1")
+        self.assertIn("sizeByWh", info["extraFeatures"])
+        self.assertEqual(info["id"], "http://host/iiif/dir%2Fimage")
+
+
+if __name__ == '__main__':
+    unittest.main()
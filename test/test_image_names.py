@@ -0,0 +1,87 @@
+"""Tests of the normalisation of image names"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from ImageNames import ImageName
+
+
+class Configuration(object):
+    resample_default_quality = "best"
+    thumbnail_default_size = (100, 100)
+    thumbnail_default_format = "jpg"
+    thumbnail_equalise = False
+    thumbnail_sharpen = False
+    thumbnail_liquid_resize = False
+
+
+class TestNormalised(unittest.TestCase):
+
+    def setUp(self):
+        ImageName.set_configuration(Configuration())
+
+    def normalised(self, name):
+        return str(ImageName(name).normalised())
+
+    def test_format_spellings_are_folded(self):
+        self.assertEqual(self.normalised("dir/image+size(400,300).JPEG"), "dir/image+size(400,300).jpg")
+        self.assertEqual(self.normalised("dir/image+size(400,300).tiff"), "dir/image+size(400,300).tif")
+
+    def test_default_parameters_are_implicit(self):
+        self.assertEqual(self.normalised("dir/image+size(400,300,best).jpg"), "dir/image+size(400,300).jpg")
+        self.assertEqual(self.normalised("dir/image+size(400,300,fast).jpg"), "dir/image+size(400,300,fast).jpg")
+
+    def test_thumbnail_options_are_ordered(self):
+        self.assertEqual(self.normalised("dir/image+thumbnail(50,50,sle).png"), "dir/image+thumbnail(50,50,els).png")
+
+    def test_open_sizes_pass_through(self):
+        self.assertEqual(self.normalised("dir/image+size(400,None).jpg"), "dir/image+size(400,None).jpg")
+        self.assertEqual(self.normalised("dir/image+size(None,300).jpeg"), "dir/image+size(None,300).jpg")
+
+    def test_null_rotations_and_redundant_conversions_are_removed(self):
+        self.assertEqual(self.normalised("dir/image+rotate(360).jpg"), "dir/image.jpg")
+        self.assertEqual(self.normalised("dir/image+rotate(0,m).jpg"), "dir/image+rotate(0,m).jpg")
+        self.assertEqual(self.normalised("dir/image+convert(png).png"), "dir/image+convert(png).png")
+        self.assertEqual(self.normalised("dir/image+size(40,30)+convert(png).png"), "dir/image+size(40,30).png")
+
+    def test_malformed_names_are_unchanged(self):
+        self.assertEqual(self.normalised("dir/image+size(wide,300).jpg"), "dir/image+size(wide,300).jpg")
+        self.assertEqual(self.normalised("dir/image+rotate(left).jpg"), "dir/image+rotate(left).jpg")
+
+    def test_original_and_metadata_names_are_unchanged(self):
+        original = ImageName("dir/image+original(photo.JPEG).JPEG")
+        self.assertIs(original.normalised(), original)
+        metadata = ImageName("dir/image+metadata(jsn).jsn")
+        self.assertIs(metadata.normalised(), metadata)
+
+    def test_normalised_names_are_fixed_points(self):
+        for name in ("dir/image+thumbnail(50,50,els,fast).webp", "dir/image+crop(10,10,5,5)+scale(40,20)+rotate(90,m).jpg"):
+            normalised = ImageName(name).normalised()
+            self.assertEqual(str(normalised.normalised()), str(normalised))
+
+
+class TestConvertedFrom(unittest.TestCase):
+
+    def setUp(self):
+        ImageName.set_configuration(Configuration())
+
+    def converted(self, name, base_kind):
+        return str(ImageName(name).normalised().converted_from(base_kind))
+
+    def test_request_in_spelling_of_base_format_is_not_converted(self):
+        self.assertEqual(self.converted("dir/image.jpg", "JPEG"), "dir/image.jpg")
+        self.assertEqual(self.converted("dir/image.jpeg", "jpeg"), "dir/image.jpg")
+        self.assertEqual(self.converted("dir/image.tif", "TIFF"), "dir/image.tif")
+
+    def test_request_in_other_format_is_converted(self):
+        self.assertEqual(self.converted("dir/image.png", "JPEG"), "dir/image+convert(png).png")
+
+    def test_derived_names_are_unchanged(self):
+        self.assertEqual(self.converted("dir/image+size(40,30).png", "JPEG"), "dir/image+size(40,30).png")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Tests of image handles that hold their image only in encoded form"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import wand.image
+import wand.color
+
+import JpegTransform
+from ImageType import ImageHandle, ImageInstance, OriginalImage
+from ImageNames import ImageName
+
+
+class ResourceLimits(object):
+    max_pixels = 0
+
+
+class Configuration(object):
+    strip_lossless = True
+    strip_keep_icc_profile = False
+    jpeg_lossless_transforms = True
+    jpeg_lossless_crop_snap = False
+    jpegtran_path = "jpegtran"
+    thumbnail_liquid_max_carves = 2
+    cannonical_format_used = False
+    cannonical_format = "png"
+    resource_limits_configuration = ResourceLimits()
+
+
+def jpeg(width = 64, height = 48):
+    with wand.image.Image(width = width, height = height, background = wand.color.Color("red")) as image:
+        image.format = "jpeg"
+        return image.make_blob()
+
+
+class TestEncodedHandles(unittest.TestCase):
+
+    def setUp(self):
+        ImageHandle.set_configuration(Configuration())
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stripped_image_is_served_twice(self):
+        stripped = ImageHandle(bytes = jpeg(), kind = "JPEG").stripped()
+        first = stripped.as_filelike().read()
+        self.assertTrue(first.startswith("\xff\xd8"))
+        self.assertEqual(stripped.as_filelike().read(), first)
+        self.assertIsNone(stripped._image)       # Served without being decoded
+
+    def test_stripped_image_is_read_back_from_the_file_written(self):
+        stripped = ImageHandle(bytes = jpeg(), kind = "JPEG").stripped()
+        path = stripped.as_file("image.jpg", self.directory)
+        with open(path, "rb") as the_file:
+            written = the_file.read()
+        self.assertEqual(stripped.as_filelike().read(), written)
+        self.assertEqual(stripped.as_filelike().read(), written)
+
+    @unittest.skipUnless(JpegTransform.available(Configuration.jpegtran_path), "jpegtran is not installed")
+    def test_lossless_crop_is_served_twice(self):
+        cropped = ImageHandle(bytes = jpeg(), kind = "JPEG").crop(16, 16, 16, 16)
+        first = cropped.as_filelike().read()
+        self.assertTrue(first.startswith("\xff\xd8"))
+        self.assertEqual(cropped.as_filelike().read(), first)
+
+    @unittest.skipUnless(JpegTransform.available(Configuration.jpegtran_path), "jpegtran is not installed")
+    def test_lossless_rotation_is_served_twice(self):
+        rotated = ImageHandle(bytes = jpeg(), kind = "JPEG").rotate(90)
+        first = rotated.as_filelike().read()
+        self.assertTrue(first.startswith("\xff\xd8"))
+        self.assertEqual(rotated.as_filelike().read(), first)
+
+
+class TestBaseImages(unittest.TestCase):
+
+    def setUp(self):
+        ImageHandle.set_configuration(Configuration())
+        ImageInstance.set_configuration(Configuration())
+
+    def test_base_image_is_made_without_decoding_the_original(self):
+        name = ImageName("0123456789abcdef0123456789abcdef.jpg")
+        original = OriginalImage.from_cache(name.make_original(str(name)), ImageHandle(bytes = jpeg(), kind = "JPEG"))
+        base = original.baseimage(full_name = True).get_image_handle()
+        self.assertIsNone(original.get_image_handle()._image)
+        first = base.as_filelike().read()
+        self.assertEqual(base.as_filelike().read(), first)
+        self.assertIsNone(base._image)
+
+
+if __name__ == '__main__':
+    unittest.main()
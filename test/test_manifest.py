@@ -0,0 +1,204 @@
+"""Tests of the manifest of a Swift container, its log objects and their compaction"""
+
+import os
+import sys
+import json
+import time
+import unittest
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import Manifest
+
+
+class Configuration(object):
+    manifest_log_batch = 100
+    manifest_flush_interval = 0
+    manifest_compact_after = 1000
+    manifest_poll_interval = 0
+    manifest_log_horizon = 600
+    manifest_lease_time = 300
+
+
+class FakeStore(object):
+    """A container held in a dictionary, shared by the manifests of several servers"""
+
+    def __init__(self):
+        self._store = "container"
+        self.objects = {}
+        self.hidden = set()     # names left out of listings, as by a listing that lags
+        self.writers = []       # names of the threads writing objects
+
+    def list_objects(self, prefix = None, marker = None):
+        names = sorted(name for name in self.objects if name not in self.hidden and
+                       (prefix is None or name.startswith(prefix)) and (marker is None or name > marker))
+        listing = [{"name" : name, "bytes" : len(self.objects[name]), "content_type" : "image/jpeg"} for name in names]
+        headers = {"x-container-object-count" : str(len(self.objects)),
+                   "x-container-bytes-used" : str(sum(len(the_bytes) for the_bytes in self.objects.values()))}
+        return headers, listing
+
+    def get_object(self, name):
+        return self.objects.get(name)
+
+    def store_image(self, image, name):
+        self.writers.append(threading.current_thread().name)
+        self.objects[name] = image.read()
+        return name
+
+    def create_object(self, name, the_bytes, delete_after = None):
+        if name in self.objects:
+            return False
+        self.objects[name] = the_bytes
+        return True
+
+    def delete_images(self, names):
+        for name in names:
+            self.objects.pop(name, None)
+
+    def find_metadata(self, names, keys):
+        return []
+
+
+def write_log(store, written, changes):
+    """Write a log object as another server would, at a time by its clock"""
+    name = "{}{:017.6f}-{}".format(Manifest.log_prefix, written, "0123abcd")
+    store.objects[name] = Manifest._compress(changes)
+    return name
+
+
+class TestManifestEntries(unittest.TestCase):
+
+    def test_changes_beside_columns(self):
+        entries = Manifest.ManifestEntries([("b", 2, "image/jpeg", None), ("a", 1, "image/png", 5.0)])
+        self.assertEqual(entries.get("a"), (1, "image/png", 5.0))
+        entries.put("c", 3, "image/jpeg")
+        entries.delete("b")
+        entries.retain("c", 7.0)
+        entries.put("a", 10, "image/png")
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries.total_size(), 13)
+        self.assertIsNone(entries.get("b"))
+        self.assertEqual(entries.get("c"), (3, "image/jpeg", 7.0))
+        rebuilt = entries.rebuilt()
+        self.assertEqual(rebuilt.changes(), 0)
+        self.assertEqual(sorted(rebuilt.iteritems()), sorted(entries.iteritems()))
+
+    def test_document(self):
+        entries = Manifest.ManifestEntries([(u"b\u00e9", 2, "image/jpeg", None), ("a", 1, "image/png", 5.0)])
+        document = json.loads(json.dumps(entries.document()))
+        loaded = Manifest.ManifestEntries.from_document(document)
+        self.assertEqual(sorted(loaded.iteritems()), sorted(entries.iteritems()))
+        self.assertEqual(loaded.get(u"b\u00e9"), (2, "image/jpeg", None))
+
+
+class TestLogOrdering(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeStore()
+        self.manifest = Manifest.ContainerManifest(self.store, Configuration())
+        self.manifest.load()
+
+    def test_log_named_before_applied_logs_is_applied(self):
+        now = time.time()
+        write_log(self.store, now, [["put", "a.jpg", [1, "image/jpeg", None]]])
+        self.manifest.poll()
+        # A server whose clock runs a minute behind
+        write_log(self.store, now - 60, [["put", "b.jpg", [2, "image/jpeg", None]]])
+        self.manifest.poll()
+        self.assertEqual(sorted(name for name, size, kind in self.manifest.listing()), ["a.jpg", "b.jpg"])
+
+    def test_log_listed_late_is_applied(self):
+        late = write_log(self.store, time.time() - 30, [["put", "late.jpg", [3, "image/jpeg", None]]])
+        self.store.hidden.add(late)
+        write_log(self.store, time.time(), [["put", "a.jpg", [1, "image/jpeg", None]]])
+        self.manifest.poll()
+        self.store.hidden.clear()
+        self.manifest.poll()
+        self.assertIn("late.jpg", [name for name, size, kind in self.manifest.listing()])
+
+    def test_changes_are_passed_to_listeners_once(self):
+        changes = []
+        self.manifest.follow(lambda operation, name, value: changes.append((operation, name)))
+        write_log(self.store, time.time(), [["put", "a.jpg", [1, "image/jpeg", None]], ["delete", "b.jpg", None]])
+        self.manifest.poll()
+        self.manifest.poll()
+        self.assertEqual(changes, [("put", "a.jpg"), ("delete", "b.jpg")])
+
+
+class TestCompaction(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeStore()
+        self.manifest = Manifest.ContainerManifest(self.store, Configuration())
+        self.manifest.load()
+
+    def logs(self):
+        return [name for name in self.store.objects if name.startswith(Manifest.log_prefix)]
+
+    def test_removes_only_applied_logs_older_than_horizon(self):
+        old = write_log(self.store, time.time() - 1000, [["put", "old.jpg", [1, "image/jpeg", None]]])
+        recent = write_log(self.store, time.time() - 10, [["put", "recent.jpg", [1, "image/jpeg", None]]])
+        late = write_log(self.store, time.time() - 2000, [["put", "late.jpg", [1, "image/jpeg", None]]])
+        self.store.hidden.add(late)
+        self.manifest.compact()
+        self.assertNotIn(old, self.store.objects)
+        self.assertIn(recent, self.store.objects)
+        # Never applied, as not yet listed, so kept
+        self.assertIn(late, self.store.objects)
+        self.assertNotIn(Manifest.lease_object, self.store.objects)
+
+    def test_new_server_loads_snapshot_and_unincluded_logs(self):
+        write_log(self.store, time.time() - 10, [["put", "a.jpg", [1, "image/jpeg", None]]])
+        self.manifest.compact()
+        # Written after the snapshot, but named before the logs it includes
+        write_log(self.store, time.time() - 20, [["put", "b.jpg", [2, "image/jpeg", None]], ["delete", "a.jpg", None]])
+        self.store.objects["b.jpg"] = "bb"
+        other = Manifest.ContainerManifest(self.store, Configuration())
+        other.load()
+        self.assertEqual([name for name, size, kind in other.listing()], ["b.jpg"])
+
+    def test_included_logs_are_not_applied_again(self):
+        write_log(self.store, time.time() - 10, [["put", "a.jpg", [1, "image/jpeg", None]]])
+        self.manifest.compact()
+        write_log(self.store, time.time(), [["delete", "a.jpg", None]])
+        self.manifest.compact()
+        other = Manifest.ContainerManifest(self.store, Configuration())
+        other.load()
+        self.assertEqual(other.listing(), [])
+
+    def test_one_server_compacts_at_a_time(self):
+        self.store.create_object(Manifest.lease_object, json.dumps({"holder" : "other", "expires" : time.time() + 100}))
+        write_log(self.store, time.time() - 1000, [["put", "a.jpg", [1, "image/jpeg", None]]])
+        self.manifest.compact()
+        self.assertNotIn(Manifest.snapshot_object, self.store.objects)
+        self.assertEqual(len(self.logs()), 1)
+        self.assertIn(Manifest.lease_object, self.store.objects)
+
+    def test_lapsed_lease_is_taken(self):
+        self.store.create_object(Manifest.lease_object, json.dumps({"holder" : "other", "expires" : time.time() - 1}))
+        self.manifest.compact()
+        self.assertIn(Manifest.snapshot_object, self.store.objects)
+        self.assertNotIn(Manifest.lease_object, self.store.objects)
+
+
+class TestWriting(unittest.TestCase):
+
+    def test_changes_are_written_in_the_background(self):
+        store = FakeStore()
+        configuration = Configuration()
+        configuration.manifest_log_batch = 2
+        manifest = Manifest.ContainerManifest(store, configuration)
+        manifest.load()
+        manifest.put("a+thumbnail().jpg", 1, "image/jpeg")
+        manifest.put("b+thumbnail().jpg", 1, "image/jpeg")
+        for attempt in range(100):
+            if len(store.writers) > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(store.writers, ["manifest"])
+        self.assertEqual(len([name for name in store.objects if name.startswith(Manifest.log_prefix)]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
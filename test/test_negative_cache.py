@@ -0,0 +1,80 @@
+"""Tests of the record of lookups that found nothing and derivations that failed"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import NegativeCache
+
+
+class Configuration(object):
+    enabled = True
+    max_entries = 10
+    lifetime = 60
+    error_lifetime = 300
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = NegativeCache.NegativeCache(Configuration())
+
+    def test_missing_images_and_refused_derivations_are_recorded(self):
+        self.assertTrue(self.cache.record("a.jpg", "a", 404, "not found"))
+        self.assertTrue(self.cache.record("b+crop(1,1,900,900).jpg", "b", 400, "crop outside image"))
+        self.assertEqual(self.cache.lookup("a.jpg"), (404, "not found"))
+        self.assertEqual(self.cache.lookup("b+crop(1,1,900,900).jpg"), (400, "crop outside image"))
+        self.assertIsNone(self.cache.lookup("c.jpg"))
+
+    def test_server_failures_are_not_recorded(self):
+        for code in (500, 501, 503):
+            self.assertFalse(self.cache.record("a+thumbnail(50,50).jpg", "a", code, "store unavailable"))
+        self.assertIsNone(self.cache.lookup("a+thumbnail(50,50).jpg"))
+
+    def test_lifetime_depends_on_code(self):
+        now = time.time()
+        self.cache.record("a.jpg", "a", 404)
+        self.cache.record("b+rotate(x).jpg", "b", 400)
+        self.assertAlmostEqual(self.cache._entries["a.jpg"][0], now + Configuration.lifetime, delta = 5)
+        self.assertAlmostEqual(self.cache._entries["b+rotate(x).jpg"][0], now + Configuration.error_lifetime, delta = 5)
+
+    def test_expired_entries_are_forgotten(self):
+        self.cache.record("a.jpg", "a", 404)
+        expiry, base_name, code, description = self.cache._entries["a.jpg"]
+        self.cache._entries["a.jpg"] = (time.time() - 1, base_name, code, description)
+        self.assertIsNone(self.cache.lookup("a.jpg"))
+        self.assertEqual(len(self.cache._entries), 0)
+
+    def test_oldest_entries_are_dropped(self):
+        configuration = Configuration()
+        configuration.max_entries = 3
+        cache = NegativeCache.NegativeCache(configuration)
+        for name in ("a", "b", "c", "d"):
+            cache.record(name + ".jpg", name, 404)
+        self.assertIsNone(cache.lookup("a.jpg"))
+        self.assertIsNotNone(cache.lookup("d.jpg"))
+
+    def test_adding_original_invalidates_its_entries_and_searches(self):
+        self.cache.record("a.jpg", "a", 404)
+        self.cache.record("a+thumbnail(50,50).png", "a", 400)
+        self.cache.record("b.jpg", "b", 404)
+        self.cache.record("search:dir/\\S+", None)
+        self.cache.invalidate("a")
+        self.assertIsNone(self.cache.lookup("a.jpg"))
+        self.assertIsNone(self.cache.lookup("a+thumbnail(50,50).png"))
+        self.assertIsNone(self.cache.lookup("search:dir/\\S+"))
+        self.assertIsNotNone(self.cache.lookup("b.jpg"))
+
+    def test_disabled_cache_records_nothing(self):
+        configuration = Configuration()
+        configuration.enabled = False
+        cache = NegativeCache.NegativeCache(configuration)
+        self.assertFalse(cache.record("a.jpg", "a", 404))
+        self.assertIsNone(cache.lookup("a.jpg"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""Tests of the choice of format and size of a delivered image from the request headers"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import Negotiation
+
+
+class TestKind(unittest.TestCase):
+
+    def setUp(self):
+        Negotiation._writable.update({"AVIF" : False, "JXL" : True, "WEBP" : True})
+
+    def test_preferred_accepted_format_is_chosen(self):
+        accept = "image/webp,image/jxl,image/*;q=0.8"
+        self.assertEqual(Negotiation.negotiate_kind(accept, ["avif", "jxl", "webp"], "jpg"), "jxl")
+        self.assertEqual(Negotiation.negotiate_kind(accept, ["webp", "jxl"], "jpg"), "webp")
+
+    def test_unwritable_refused_and_wildcard_formats_are_not_chosen(self):
+        self.assertEqual(Negotiation.negotiate_kind("image/avif", ["avif", "webp"], "jpg"), "jpg")
+        self.assertEqual(Negotiation.negotiate_kind("image/webp;q=0", ["webp"], "jpg"), "jpg")
+        self.assertEqual(Negotiation.negotiate_kind("*/*", ["webp"], "jpg"), "jpg")
+        self.assertEqual(Negotiation.negotiate_kind(None, ["webp"], "jpg"), "jpg")
+
+
+class TestSize(unittest.TestCase):
+
+    def test_dpr_scales_requested_size(self):
+        self.assertEqual(Negotiation.hinted_size(300, 200, {"DPR" : "2"}, 3.0, 10000), (600, 400))
+        self.assertEqual(Negotiation.hinted_size(300, None, {"DPR" : "4"}, 3.0, 10000), (900, None))
+        self.assertEqual(Negotiation.hinted_size(300, 200, {"DPR" : "2", "Save-Data" : "on"}, 3.0, 10000), (300, 200))
+
+    def test_width_sizes_unsized_request(self):
+        self.assertEqual(Negotiation.hinted_size(None, None, {"Width" : "640"}, 3.0, 10000), (640, None))
+        self.assertEqual(Negotiation.hinted_size(None, None, {"Width" : "1200", "DPR" : "4"}, 3.0, 10000), (900, None))
+        self.assertEqual(Negotiation.hinted_size(None, None, {"DPR" : "2"}, 3.0, 10000), (None, None))
+
+    def test_hinted_size_stays_within_bounds(self):
+        self.assertEqual(Negotiation.hinted_size(9000, 4500, {"DPR" : "2"}, 3.0, 10000), (9999, 5000))
+        self.assertEqual(Negotiation.hinted_size(None, None, {"Width" : "50000"}, 3.0, 10000), (9999, None))
+
+    def test_malformed_hints_are_ignored(self):
+        self.assertEqual(Negotiation.hinted_size(300, 200, {"DPR" : "-1", "Width" : "wide"}, 3.0, 10000), (300, 200))
+
+
+class TestVary(unittest.TestCase):
+
+    def test_vary_names_the_headers_consulted(self):
+        self.assertEqual(Negotiation.vary(True, True), "Accept, DPR, Width, Save-Data")
+        self.assertEqual(Negotiation.vary(False, True), "DPR, Width, Save-Data")
+        self.assertEqual(Negotiation.vary(True, False), "Accept")
+        self.assertIsNone(Negotiation.vary(False, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""Tests of the consistent hash ring of replicas, and of fetching images from the replica owning them"""
+
+import os
+import sys
+import socket
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import Peers
+
+
+class Configuration(object):
+
+    def __init__(self, self_address, peers):
+        self.enabled = True
+        self.peers = peers
+        self.dns_name = None
+        self.self_address = self_address
+        self.port = 80
+        self.base_pathname = "_peer"
+        self.virtual_nodes = 64
+        self.timeout = 2.0
+        self.failure_backoff = 30
+        self.refresh_interval = 3600
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path, self.headers.get(Peers.peer_header), self.client_address[1]))
+        if "derive=1" in self.path:
+            body = "image"
+            self.send_response(200)
+        else:
+            body = ""
+            self.send_response(404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+names = ["dir/image{}+thumbnail(50,50).jpg".format(index) for index in range(2000)]
+
+
+class TestRing(unittest.TestCase):
+
+    def test_replicas_agree_on_owners(self):
+        peers = ["127.0.0.1:8001", "127.0.0.1:8002", "127.0.0.1:8003"]
+        rings = [Peers.PeerRing(Configuration(peer, peers)) for peer in peers]
+        for name in names:
+            owners = [ring.owner(name) or peer for ring, peer in zip(rings, peers)]
+            self.assertEqual(len(set(owners)), 1)
+        shares = [sum(1 for name in names if rings[0].owner(name) == peer) for peer in peers[1:]]
+        self.assertTrue(all(share > len(names) // 6 for share in shares))
+
+    def test_replica_recognises_itself_by_host_name(self):
+        ring = Peers.PeerRing(Configuration("localhost:8001", ["127.0.0.1:8001"]))
+        self.assertTrue(all(ring.owner(name) is None for name in names))
+
+    def test_is_peer(self):
+        ring = Peers.PeerRing(Configuration("127.0.0.1:8001", ["127.0.0.1:8001", "127.0.0.2:8001"]))
+        self.assertTrue(ring.is_peer("127.0.0.2"))
+        self.assertFalse(ring.is_peer("10.0.0.1"))
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        Handler.requests = []
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.peer = "127.0.0.1:{}".format(self.server.server_address[1])
+        self.ring = Peers.PeerRing(Configuration("127.0.0.1:1", [self.peer]))
+        self.owned = [name for name in names if self.ring.owner(name) == self.peer]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_derives_only_when_asked(self):
+        self.assertIsNone(self.ring.fetch(self.owned[0]))
+        self.assertEqual(self.ring.fetch(self.owned[0], derive = True), "image")
+        self.assertTrue(all(header == "127.0.0.1:1" for path, header, port in Handler.requests))
+
+    def test_connections_are_reused(self):
+        for name in self.owned[:5]:
+            self.ring.fetch(name, derive = True)
+        self.assertEqual(len(set(port for path, header, port in Handler.requests)), 1)
+
+    def test_requests_from_peers_are_not_forwarded(self):
+        with Peers.ServingPeer():
+            self.assertIsNone(self.ring.fetch(self.owned[0], derive = True))
+        self.assertEqual(Handler.requests, [])
+
+    def test_peer_not_answering_leaves_ring(self):
+        ring = Peers.PeerRing(Configuration("127.0.0.1:1", ["127.0.0.1:2"]))
+        name = [name for name in names if ring.owner(name) is not None][0]
+        self.assertIsNone(ring.fetch(name, derive = True))
+        self.assertIsNone(ring.owner(name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Tests of the arena of encoded images shared between processes"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import SharedMemory
+
+
+def image(key, length):
+    """Bytes that can only be found under their own key"""
+    return (hashlib.md5(key).digest() * (length // 16 + 1))[:length]
+
+
+def write(path, size, slots, rounds):
+    arena = SharedMemory.SharedArena(path, size, slots)
+    for index in range(rounds):
+        key = "dir/image{}+thumbnail(50,50).jpg".format(index % 300)
+        arena.put(key, image(key, 500 + index % 2000))
+    arena.close()
+
+
+def read(path, size, slots, rounds, results):
+    arena = SharedMemory.SharedArena(path, size, slots)
+    found = 0
+    for index in range(rounds):
+        key = "dir/image{}+thumbnail(50,50).jpg".format(index % 300)
+        the_bytes = arena.get(key)
+        if the_bytes is not None:
+            if the_bytes != image(key, len(the_bytes)):
+                results.put("corrupt {}".format(key))
+                return
+            found += 1
+    arena.close()
+    results.put(found)
+
+
+class TestSharedArena(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "arena")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_images_are_shared_between_openings(self):
+        writer = SharedMemory.SharedArena(self.path, 64 * 1024, 64)
+        writer.put("a.jpg", "aaa")
+        reader = SharedMemory.SharedArena(self.path, 64 * 1024, 64)
+        self.assertEqual(reader.get("a.jpg"), "aaa")
+        self.assertTrue(reader.contains("a.jpg"))
+        reader.discard("a.jpg")
+        self.assertIsNone(writer.get("a.jpg"))
+        self.assertEqual(writer.writes(), 1)
+
+    def test_oldest_images_are_overwritten(self):
+        arena = SharedMemory.SharedArena(self.path, 16 * 1024, 64)
+        for index in range(40):
+            arena.put("image{}".format(index), image("image{}".format(index), 1000))
+        self.assertIsNone(arena.get("image0"))
+        self.assertEqual(arena.get("image39"), image("image39", 1000))
+
+    def test_layout_change_leaves_old_arena_intact(self):
+        old = SharedMemory.SharedArena(self.path, 64 * 1024, 64)
+        old.put("a.jpg", "aaa")
+        new = SharedMemory.SharedArena(self.path, 128 * 1024, 64)
+        self.assertEqual(old.get("a.jpg"), "aaa")
+        self.assertIsNone(new.get("a.jpg"))
+        new.put("b.jpg", "bbb")
+        self.assertEqual(SharedMemory.SharedArena(self.path, 128 * 1024, 64).get("b.jpg"), "bbb")
+        self.assertEqual(os.listdir(self.directory), ["arena"])
+
+    def test_concurrent_readers_never_see_overwritten_images(self):
+        SharedMemory.SharedArena(self.path, 256 * 1024, 128).close()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target = write, args = (self.path, 256 * 1024, 128, 3000))
+                     for writer in range(2)]
+        processes += [multiprocessing.Process(target = read, args = (self.path, 256 * 1024, 128, 20000, results))
+                      for reader in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        for reader in range(2):
+            self.assertIsInstance(results.get(timeout = 5), int)
+
+    def test_concurrent_openings_with_new_layout_agree(self):
+        SharedMemory.SharedArena(self.path, 64 * 1024, 64).close()
+        processes = [multiprocessing.Process(target = write, args = (self.path, 128 * 1024, 64, 200))
+                     for writer in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(SharedMemory.SharedArena(self.path, 128 * 1024, 64).writes(), 800)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+"""
+Image Name Benchmark
+--------------------
+
+Compare the parsing and string representation of image names with those of the parser used before names were
+immutable and interned.  Both parsers are timed on the same names, those of ``ImageNames.benchmark_forms``::
+
+    python tools/name_benchmark.py [count [rounds]]
+"""
+
+import os
+import re
+import sys
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import ImageNames
+
+
+class BaselineName(object):
+    """The parser and string representation of image names before names were immutable and interned
+
+    Unchanged apart from the names no longer needed, and parse failures being raised rather than printed.
+    """
+
+    def __init__(self, image_name, kind = None):
+        self._is_thumbnail = False
+        self._is_derived = False
+        self._is_base = False
+        self._is_original = False
+        self._liquid = False
+        self._equalise = False
+        self._sharpen = False
+        self._clone = False
+        self._is_metadata = False
+        self._is_resize = False
+        self._is_convert = False
+        self._is_crop = False
+        self._is_rotate = False
+        self._quality = "best"
+        self._base_name = None
+        self._original_name = None
+        self._image_kind = kind
+        self._image_size = (None, None)
+        self._operations = []
+        self._image_name = image_name
+        if image_name is not None:
+            self._parse_name(image_name, kind)
+
+    def _parse_name(self, image_name, kind = None):
+        if kind is None:
+            try:
+                head, ext = os.path.splitext(image_name)
+                kind = ext[1:]
+            except ValueError:
+                head = image_name
+                kind = None
+        else:
+            head = image_name
+        try:
+            components = re.split("\+", head)
+        except TypeError:
+            components = [head]
+        self._base_name = components[0]
+        self._image_kind = kind
+        self._is_base = True
+        x_size = 0
+        y_size = 0
+        if len(components) <= 1:
+            return
+        for op in components[1:]:
+            self._is_base = False
+            try:
+                operation, parameters = re.split("\(", op)
+            except ValueError:
+                continue
+            if operation == "clone":
+                self._clone = True
+                continue
+            if operation == "original":
+                self._is_original = True
+                self._is_derived = False
+                self._original_name = urllib.quote(parameters[:-1], safe = "")
+            elif operation == "size":
+                self._is_derived = True
+                self._is_resize = True
+                size_parameters = re.split(",", parameters[:-1])
+                x_size, y_size = size_parameters[:2]
+                if len(size_parameters) > 2:
+                    self._quality = size_parameters[2]
+            elif operation == "crop":
+                self._is_derived = True
+                self._is_crop = True
+                x_size, y_size, x_offset, y_offset = re.split(",", parameters[:-1])
+            elif operation == "rotate":
+                self._is_derived = True
+                self._is_rotate = True
+            elif operation == "thumbnail":
+                self._is_derived = True
+                self._thumbnail = True
+                thumbnail_parameters = re.split(",", parameters[:-1])
+                x_size, y_size, options = thumbnail_parameters[:3]
+                if len(thumbnail_parameters) > 3:
+                    self._quality = thumbnail_parameters[3]
+                self._liquid = "l" in options
+                self._equalise = "e" in options
+                self._sharpen = "s" in options
+            elif operation == "convert":
+                self._is_derived = True
+                self._is_original = False
+                self._is_convert = True
+            elif operation == "metadata":
+                self._is_derived = True
+                self._is_original = False
+                self._is_metadata = True
+            else:
+                continue
+            self._operations.append(op)
+        self._image_size = (x_size, y_size)
+
+    def __str__(self):
+        the_string = "{}".format(self._base_name)
+        if self._clone:
+            the_string += "+clone()"
+        if len(self._operations) != 0:
+            for op in self._operations:
+                the_string += "+{}".format(op)
+        else:
+            if self._original_name is not None or self._is_original:
+                the_string += "+original({})".format(self._original_name)
+        the_string += ".{}".format(self._image_kind)
+        return the_string
+
+
+def main(count = 5000, rounds = 20):
+    """Print the timings of both parsers, each form timed before and after"""
+    print "Image name benchmark, microseconds per name over {} names".format(count)
+    print "{:56s}{:>8s}{:>10s}{:>10s}{:>10s}{:>10s}".format("name", "", "parse", "reparse", "str", "str again")
+    before = ImageNames.time_names(BaselineName, count, rounds)
+    after = ImageNames.time_names(ImageNames.ImageName, count, rounds)
+    for baseline, current in zip(before, after):
+        for version, result in (("before", baseline), ("after", current)):
+            print "{:56s}{:>8s}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(result[0], version, *result[1:])
+
+
+if __name__ == "__main__":
+    main(*[int(argument) for argument in sys.argv[1:3]])